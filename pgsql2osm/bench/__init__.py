@@ -0,0 +1,7 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks on synthetic data: bench.generate creates an osm2pgsql database of
+a given size and its flatnodes file, bench.run times each phase of an export of
+it. Run as python3 -m pgsql2osm.bench (or pgsql2osm-bench), see --help
+"""
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+
+from . import generate
+from . import run
+
+def parse_option(option:str)->tuple :
+    ''' key=value, where value is json if it parses, a string otherwise
+    '''
+    k,_,v=option.partition('=')
+    try :
+        return k,json.loads(v)
+    except ValueError :
+        return k,v
+
+def main() :
+    parser=argparse.ArgumentParser(prog='pgsql2osm-bench')
+    sub=parser.add_subparsers(dest='command',required=True)
+
+    gen_p=sub.add_parser('generate',
+        help='Create a synthetic osm2pgsql database and its flatnodes file')
+    gen_p.add_argument('nodes_file',
+        help='Path where the flatnodes file is written')
+    gen_p.add_argument('-d','--dsn',dest='postgres_dsn',default='dbname=gis_bench',
+        help="""Database to create the tables in, it needs the postgis and hstore extensions.
+One database per layout: the tables are autodetected by name, default '%(default)s'""")
+    gen_p.add_argument('--ways',dest='ways',default=100_000,type=int,
+        help="""Size of the data: number of ways, with 7 nodes per way and a relation
+per 50 ways, default %(default)s""")
+    gen_p.add_argument('--layout',dest='layout',default='jsonb',choices=('jsonb','legacy'),
+        help="Middle tables layout: osm2pgsql's jsonb one, or the legacy text[] one, default %(default)s")
+    gen_p.add_argument('--prefix',dest='prefix',default='planet_osm',
+        help="Prefix of the table names, default '%(default)s'")
+    gen_p.add_argument('--replace',dest='replace',default=False,action='store_true',
+        help='Drop the tables first if they exist')
+
+    run_p=sub.add_parser('run',
+        help='Time each phase of an export, several times, and write the results as json')
+    run_p.add_argument('nodes_file',
+        help='Path to the flatnodes file')
+    run_p.add_argument('-d','--dsn',dest='postgres_dsn',default='dbname=gis_bench',
+        help="Database to export from, default '%(default)s'")
+    run_p.add_argument('-o','--output',dest='results_file',required=True,
+        help='Where to write the results json')
+    run_p.add_argument('-b','--bbox',dest='bounds_box',default=None,
+        help='Boundary lon_from,lat_from,lon_to,lat_to, default the center quarter of the generated data')
+    run_p.add_argument('-f','--format',dest='out_format',default='pbf',choices=('xml','pbf'),
+        help='Output format, default %(default)s')
+    run_p.add_argument('--repeat',dest='repeat',default=3,type=int,
+        help='Timed runs, the results keep each one and their median, default %(default)s')
+    run_p.add_argument('--warmup',dest='warmup',default=1,type=int,
+        help='Untimed runs first, default %(default)s')
+    run_p.add_argument('--option',dest='options',default=[],action='append',type=parse_option,
+        metavar='KEY=VALUE',
+        help="""Setting passed to the export (a settings.ModuleSettings key), the value is
+read as json if it can be, eg --option jobs=4 --option stage_ids=true""")
+
+    cmp_p=sub.add_parser('compare',
+        help='Print the median of each phase of several results side by side')
+    cmp_p.add_argument('results_files',nargs='+',
+        help='Results json files, the first one is the reference')
+    cmp_p.add_argument('--key',dest='key',default='wall_s',choices=run.PHASE_KEYS,
+        help='What to compare, default %(default)s')
+
+    args=parser.parse_args()
+    if args.command=='generate' :
+        info=generate.generate(args.postgres_dsn,args.ways,args.layout,args.nodes_file,
+            prefix=args.prefix,replace=args.replace)
+        print(json.dumps(info))
+    elif args.command=='run' :
+        results=run.run(args.postgres_dsn,args.nodes_file,bbox=args.bounds_box,
+            out_format=args.out_format,repeat=args.repeat,warmup=args.warmup,
+            options=dict(args.options))
+        run.save(results,args.results_file)
+        print(run.compare([args.results_file]))
+    else :
+        print(run.compare(args.results_files,args.key))
+
+if __name__=='__main__' :
+    main()
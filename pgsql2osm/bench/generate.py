@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+import array
+import json
+import math
+import os
+import time
+import typing
+
+import psycopg2
+
+from .. import flatnodes
+from .. import log
+
+"""
+Synthetic osm2pgsql database for benchmarks: the _point, _line, _polygon output
+tables and the _ways, _rels middle tables in either layout, with the functions and
+indexes osm2pgsql creates, plus a matching flatnodes file. Everything is derived
+from the number of ways, so the same size gives the same data every time.
+"""
+
+UNDEFINED=2**31-1 #osmium undefined location, for both coordinates
+
+class World :
+    """ Sizes and node locations of the synthetic data: way w is a chain of NODES_PER_WAY
+    nodes, sharing its first node with the last node of way w-1. Nodes are laid out row
+    by row on a grid over EXTENT. Every 10th way is instead a closed square of 4 nodes,
+    every 10th way +5 is untagged (only a relation member), every 20th node is a point.
+    There are ways/50 relations, each of 5 consecutive ways and 1 node:
+    multipolygons, routes and sites (no geometry) in turn, every 10th also has the
+    previous relation as member.
+    """
+    NODES_PER_WAY=8
+    WAYS_PER_REL=5
+    EXTENT=(5.9,45.8,10.5,47.8) #lon_from,lat_from,lon_to,lat_to: about Switzerland
+
+    def __init__(self,ways:int) :
+        self.ways=ways
+        self.nodes=ways*(self.NODES_PER_WAY-1)+1
+        self.rels=max(1,ways//50)
+        self.cols=math.ceil(math.sqrt(self.nodes))
+        self.rows=math.ceil((self.nodes+1)/self.cols)
+        lon_from,lat_from,lon_to,lat_to=(int(i*flatnodes.COORDINATE_PRECISION) for i in self.EXTENT)
+        self.x0,self.y0=lon_from,lat_from
+        self.dx=(lon_to-lon_from)//self.cols
+        self.dy=(lat_to-lat_from)//self.rows
+
+    def location(self,osm_id:int)->typing.Tuple[int,int] :
+        ''' x,y of node osm_id, in units of 1e-7 degrees like the flatnodes file
+        '''
+        return self.x0+(osm_id%self.cols)*self.dx,self.y0+(osm_id//self.cols)*self.dy
+
+    def center_bbox(self)->str :
+        ''' The middle quarter of the data, as a --bbox
+        '''
+        lon_from,lat_from,lon_to,lat_to=self.EXTENT
+        w,h=(lon_to-lon_from)/4,(lat_to-lat_from)/4
+        return ','.join(f'{i:.4f}' for i in (lon_from+w,lat_from+h,lon_to-w,lat_to-h))
+
+    def info(self)->dict :
+        return {'ways':self.ways,'nodes':self.nodes,'rels':self.rels,
+            'extent':','.join(str(i) for i in self.EXTENT),'bbox':self.center_bbox()}
+
+def write_flatnodes(world:World,nodes_file:str,step=1_000_000) :
+    ''' All the node locations of world, written the way osm2pgsql --flat-nodes does
+    '''
+    tmp=nodes_file+'.tmp'
+    with open(tmp,'wb') as f :
+        array.array('i',(UNDEFINED,UNDEFINED)).tofile(f) #there is no node 0
+        for start in range(1,world.nodes+1,step) :
+            locations=array.array('i')
+            for osm_id in range(start,min(world.nodes+1,start+step)) :
+                locations.extend(world.location(osm_id))
+            locations.tofile(f)
+            log.l.log(log.n(start+len(locations)//2-1),'nodes written',clearline=True)
+    log.l.save_clearedline()
+    os.replace(tmp,nodes_file)
+
+def sql_functions(world:World)->str :
+    ''' Node locations and way node lists, as session functions: the same formulas as World
+    '''
+    return f'''
+    CREATE FUNCTION pg_temp.bench_point(osm_id bigint) RETURNS geometry AS $$
+        SELECT ST_Transform(ST_SetSRID(ST_MakePoint(
+            ({world.x0}+(osm_id%{world.cols})*{world.dx})/1e7,
+            ({world.y0}+(osm_id/{world.cols})*{world.dy})/1e7),4326),3857)
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE FUNCTION pg_temp.bench_line(nodes bigint[]) RETURNS geometry AS $$
+        SELECT ST_MakeLine(pg_temp.bench_point(n) ORDER BY i) FROM unnest(nodes) WITH ORDINALITY AS u(n,i)
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE FUNCTION pg_temp.bench_way_nodes(w bigint) RETURNS bigint[] AS $$
+        SELECT CASE WHEN w%10=0 AND s+{world.cols}+1<={world.nodes}
+            THEN ARRAY[s,s+1,s+1+{world.cols},s+{world.cols},s]
+            ELSE ARRAY(SELECT generate_series(s,s+{world.NODES_PER_WAY-1})) END
+        FROM (SELECT (w-1)*{world.NODES_PER_WAY-1}+1 AS s) AS start
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE FUNCTION pg_temp.bench_way_tags(w bigint) RETURNS text[] AS $$
+        SELECT CASE WHEN w%10=0 THEN ARRAY['building','yes']
+            WHEN w%10=5 THEN ARRAY[]::text[]
+            ELSE ARRAY['highway',(ARRAY['residential','primary','footway','track'])[w%4+1],
+                'name','Street '||w] END
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE FUNCTION pg_temp.bench_rel_ways(r bigint) RETURNS bigint[] AS $$
+        SELECT ARRAY(SELECT generate_series((r-1)*{world.WAYS_PER_REL}+1,
+            least(r*{world.WAYS_PER_REL},{world.ways})))
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE FUNCTION pg_temp.bench_rel_tags(r bigint) RETURNS text[] AS $$
+        SELECT CASE r%3 WHEN 0 THEN ARRAY['type','multipolygon','landuse','forest']
+            WHEN 1 THEN ARRAY['type','route','route','bus']
+            ELSE ARRAY['type','site'] END||ARRAY['name','Relation '||r]
+    $$ LANGUAGE SQL IMMUTABLE;
+    '''
+
+def create_middle(c:psycopg2.extensions.cursor,world:World,prefix:str,layout:str) :
+    if layout=='jsonb' :
+        c.execute(f'''CREATE TABLE {prefix}_ways (id int8 PRIMARY KEY,nodes int8[] NOT NULL,tags jsonb);
+        CREATE TABLE {prefix}_rels (id int8 PRIMARY KEY,members jsonb NOT NULL,tags jsonb);
+        INSERT INTO {prefix}_ways SELECT w,pg_temp.bench_way_nodes(w),
+                CASE WHEN w%10=5 THEN NULL ELSE jsonb_object(pg_temp.bench_way_tags(w)) END
+            FROM generate_series(1::int8,{world.ways}) AS w;
+        INSERT INTO {prefix}_rels SELECT r,
+                jsonb_build_array(jsonb_build_object('type','N','ref',r*7,'role','stop'))
+                ||(SELECT jsonb_agg(jsonb_build_object('type','W','ref',w,'role','outer') ORDER BY w)
+                    FROM unnest(pg_temp.bench_rel_ways(r)) AS w)
+                ||CASE WHEN r%10=0 THEN jsonb_build_array(jsonb_build_object('type','R','ref',r-1,'role',''))
+                    ELSE '[]'::jsonb END,
+                jsonb_object(pg_temp.bench_rel_tags(r))
+            FROM generate_series(1::int8,{world.rels}) AS r;''')
+    else :
+        c.execute(f'''CREATE TABLE {prefix}_ways (id int8 PRIMARY KEY,nodes int8[] NOT NULL,tags text[]);
+        CREATE TABLE {prefix}_rels (id int8 PRIMARY KEY,way_off int2,rel_off int2,
+            parts int8[],members text[],tags text[]);
+        INSERT INTO {prefix}_ways SELECT w,pg_temp.bench_way_nodes(w),
+                CASE WHEN w%10=5 THEN NULL ELSE pg_temp.bench_way_tags(w) END
+            FROM generate_series(1::int8,{world.ways}) AS w;
+        INSERT INTO {prefix}_rels SELECT r,1,1+cardinality(ways),
+                ARRAY[r*7]||ways||CASE WHEN r%10=0 THEN ARRAY[r-1] ELSE ARRAY[]::int8[] END,
+                ARRAY['n'||r*7,'stop']
+                ||ARRAY(SELECT m FROM unnest(ways) WITH ORDINALITY AS u(w,i),
+                    unnest(ARRAY['w'||w,'outer']) WITH ORDINALITY AS v(m,j) ORDER BY i,j)
+                ||CASE WHEN r%10=0 THEN ARRAY['r'||(r-1),''] ELSE ARRAY[]::text[] END,
+                pg_temp.bench_rel_tags(r)
+            FROM generate_series(1::int8,{world.rels}) AS r,pg_temp.bench_rel_ways(r) AS ways;''')
+    # functions and indexes as osm2pgsql creates them
+    c.execute(f'''CREATE OR REPLACE FUNCTION planet_osm_index_bucket(i_x bigint[]) RETURNS bigint[] AS $$
+        SELECT ARRAY(SELECT DISTINCT unnest(i_x)>>5)
+    $$ LANGUAGE SQL IMMUTABLE;
+    CREATE INDEX ON {prefix}_ways USING GIN (planet_osm_index_bucket(nodes)) WITH (fastupdate=off);''')
+    if layout=='jsonb' :
+        c.execute(f'''CREATE OR REPLACE FUNCTION planet_osm_member_ids(members jsonb,type char(1)) RETURNS bigint[] AS $$
+            SELECT array_agg((el->>'ref')::int8) FROM jsonb_array_elements(members) AS el WHERE el->>'type'=type
+        $$ LANGUAGE SQL IMMUTABLE;
+        CREATE INDEX ON {prefix}_rels USING GIN (planet_osm_member_ids(members,'N'::char(1))) WITH (fastupdate=off);
+        CREATE INDEX ON {prefix}_rels USING GIN (planet_osm_member_ids(members,'W'::char(1))) WITH (fastupdate=off);''')
+    else :
+        c.execute(f'CREATE INDEX ON {prefix}_rels USING GIN (parts) WITH (fastupdate=off);')
+
+def create_output(c:psycopg2.extensions.cursor,world:World,prefix:str) :
+    c.execute(f'''CREATE TABLE {prefix}_point (osm_id int8,amenity text,name text,tags hstore,
+            way geometry(Point,3857));
+        CREATE TABLE {prefix}_line (osm_id int8,highway text,route text,name text,tags hstore,
+            way geometry(LineString,3857));
+        CREATE TABLE {prefix}_polygon (osm_id int8,building text,landuse text,name text,tags hstore,
+            way_area real,way geometry(Geometry,3857));
+        INSERT INTO {prefix}_point SELECT n,(ARRAY['bench','restaurant','post_box'])[n/20%3+1],
+                'Point '||n,hstore('amenity',(ARRAY['bench','restaurant','post_box'])[n/20%3+1]),
+                pg_temp.bench_point(n)
+            FROM generate_series(20::int8,{world.nodes},20) AS n;
+        INSERT INTO {prefix}_line SELECT id,tags->'highway',NULL,tags->'name',tags,pg_temp.bench_line(nodes)
+            FROM (SELECT id,nodes,hstore(pg_temp.bench_way_tags(id)) AS tags FROM {prefix}_ways
+                WHERE id%10 NOT IN (0,5)) AS ways;
+        INSERT INTO {prefix}_polygon SELECT id,'yes',NULL,NULL,hstore('building','yes'),
+                ST_Area(way),way
+            FROM (SELECT id,ST_MakePolygon(pg_temp.bench_line(nodes)) AS way FROM {prefix}_ways
+                WHERE id%10=0 AND nodes[1]=nodes[cardinality(nodes)]) AS ways;''')
+    # relations: the line from the first node of their first way to the last node of their last way
+    c.execute(f'''CREATE TEMP TABLE bench_rel_lines AS SELECT r,hstore(pg_temp.bench_rel_tags(r)) AS tags,
+            ST_MakeLine(pg_temp.bench_point((ways[1]-1)*{world.NODES_PER_WAY-1}+1),
+                pg_temp.bench_point(ways[cardinality(ways)]*{world.NODES_PER_WAY-1}+1)) AS line
+        FROM generate_series(1::int8,{world.rels}) AS r,pg_temp.bench_rel_ways(r) AS ways;
+    INSERT INTO {prefix}_line SELECT -r,NULL,tags->'route',tags->'name',tags-'type'::text,line
+        FROM bench_rel_lines WHERE r%3=1;
+    INSERT INTO {prefix}_polygon SELECT -r,NULL,tags->'landuse',tags->'name',tags-'type'::text,
+            ST_Area(ST_Buffer(line,50)),ST_Buffer(line,50)
+        FROM bench_rel_lines WHERE r%3=0;''')
+    for key in ('_point','_line','_polygon') :
+        c.execute(f'''CREATE INDEX ON {prefix}{key} USING GIST (way);
+        CREATE INDEX ON {prefix}{key} USING BTREE (osm_id);''')
+
+def generate(dsn:str,ways:int,layout:str,nodes_file:str,prefix='planet_osm',replace=False)->dict :
+    """ Create the tables {prefix}_* in the database at dsn, write nodes_file and return
+    World.info(). Also recorded in the table pgsql2osm_bench, for bench.run.
+    The database needs the postgis and hstore extensions (created if missing).
+    """
+    world=World(ways)
+    log.l.set_phases(['tables','flatnodes'])
+    start=time.time()
+    access=psycopg2.connect(dsn)
+    c=access.cursor()
+    c.execute('CREATE EXTENSION IF NOT EXISTS postgis;CREATE EXTENSION IF NOT EXISTS hstore;')
+    if replace :
+        for key in ('_point','_line','_polygon','_ways','_rels') :
+            c.execute(f'DROP TABLE IF EXISTS {prefix}{key};')
+    c.execute(sql_functions(world))
+    log.l.log(f'{log.n(world.ways)} ways, {log.n(world.rels)} relations, {layout} middle layout')
+    create_middle(c,world,prefix,layout)
+    create_output(c,world,prefix)
+    info=world.info()
+    info.update({'layout':layout,'prefix':prefix,'seconds':round(time.time()-start,1)})
+    c.execute('CREATE TABLE IF NOT EXISTS pgsql2osm_bench (prefix text PRIMARY KEY,info jsonb);')
+    c.execute('''INSERT INTO pgsql2osm_bench VALUES (%s,%s)
+        ON CONFLICT (prefix) DO UPDATE SET info=excluded.info;''',(prefix,json.dumps(info)))
+    access.commit()
+    access.autocommit=True
+    for key in ('_point','_line','_polygon','_ways','_rels') :
+        c.execute(f'ANALYZE {prefix}{key};')
+    access.close()
+    log.l.next_phase()
+    write_flatnodes(world,nodes_file)
+    log.l.log('done in',log.n(int(time.time()-start)),'s')
+    return info
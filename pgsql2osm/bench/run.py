@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+import psycopg2
+
+from .. import __version__
+from .. import log
+from .. import settings
+
+"""
+Benchmark runner: time each phase of stream_osm_xml() on a database made by
+bench.generate, repeated, and write the results as json that compare() can put
+side by side with the results of another commit, database layout or option.
+The phase timings are those of --metrics, see metrics.Metrics.
+"""
+
+PHASE_KEYS=('wall_s','cpu_s','queries','rows','bytes_written','peak_rss_bytes')
+
+def git_commit()->typing.Optional[str] :
+    try :
+        return subprocess.run(['git','describe','--always','--dirty'],capture_output=True,text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError) :
+        return None
+
+def database_info(dsn:str)->dict :
+    ''' Server version, and what bench.generate recorded about the data
+    '''
+    access=psycopg2.connect(dsn)
+    try :
+        c=access.cursor()
+        c.execute('SHOW server_version;')
+        info={'server_version':c.fetchone()[0]}
+        c.execute("SELECT to_regclass('pgsql2osm_bench') IS NOT NULL;")
+        if c.fetchone()[0] :
+            c.execute('SELECT prefix,info FROM pgsql2osm_bench ORDER BY prefix;')
+            info['generated']={prefix:data for prefix,data in c.fetchall()}
+    finally :
+        access.close()
+    return info
+
+def run_once(dsn:str,nodes_file:str,bbox:str,out_format:str,tmp_dir:str,options:dict)->dict :
+    out_file=os.path.join(tmp_dir,'bench.osm'+('.pbf' if out_format=='pbf' else ''))
+    metrics_file=os.path.join(tmp_dir,'metrics.json')
+    start=time.time()
+    s=settings.ModuleSettings(access=psycopg2.connect(dsn),postgres_dsn=dsn,nodes_file=nodes_file,
+        bounds_box=bbox,out_file=out_file,out_format=out_format,metrics_file=metrics_file,
+        has_suggested_out_filename=True,**options)
+    try :
+        s.main()
+    finally :
+        # the next run registers its own
+        log.l.phase_listeners.remove(s.metrics.phase)
+        s.access.close()
+    wall_s=time.time()-start
+    with open(metrics_file) as f :
+        m=json.load(f)
+    result={
+        'completed':m['completed'],
+        'wall_s':wall_s,
+        'output_bytes':os.path.getsize(out_file) if os.path.exists(out_file) else None,
+        'phases':[{'name':p['name'],**{k:p[k] for k in PHASE_KEYS}} for p in m['phases']],
+    }
+    for filename in (out_file,metrics_file) :
+        if os.path.exists(filename) :
+            os.remove(filename)
+    return result
+
+def medians(runs:typing.List[dict])->dict :
+    ''' {phase name:{key:median over the runs}}, and the total as phase 'total'
+    '''
+    values={}
+    for run in runs :
+        for p in run['phases'] :
+            for k in PHASE_KEYS :
+                if p[k] is not None :
+                    values.setdefault(p['name'],{}).setdefault(k,[]).append(p[k])
+        values.setdefault('total',{}).setdefault('wall_s',[]).append(run['wall_s'])
+    return {name:{k:statistics.median(v) for k,v in keys.items()} for name,keys in values.items()}
+
+def run(dsn:str,nodes_file:str,bbox:typing.Optional[str]=None,out_format='pbf',repeat=3,
+        warmup=1,options:typing.Optional[dict]=None)->dict :
+    """ Run the export repeat times (after warmup untimed runs, to fill the caches) and return
+    the results. bbox defaults to the center of the generated data, options are more
+    ModuleSettings keys (eg jobs, stage_ids, binary_copy).
+    """
+    options=options or {}
+    db=database_info(dsn)
+    if bbox is None :
+        generated=list(db.get('generated',{}).values())
+        assert len(generated)>0, 'No pgsql2osm_bench table: give a bbox, or use bench generate first'
+        bbox=generated[0]['bbox']
+    runs=[]
+    with tempfile.TemporaryDirectory(prefix='pgsql2osm_bench') as tmp_dir :
+        for i in range(warmup+repeat) :
+            result=run_once(dsn,nodes_file,bbox,out_format,tmp_dir,options)
+            if i>=warmup :
+                runs.append(result)
+            print(f"run {i+1}/{warmup+repeat}{' (warmup)' if i<warmup else ''}: {result['wall_s']:.1f}s",
+                file=sys.stderr)
+    return {
+        'started':time.strftime('%FT%T'),
+        'pgsql2osm':__version__,
+        'git':git_commit(),
+        'python':platform.python_version(),
+        'database':db,
+        'bbox':bbox,
+        'out_format':out_format,
+        'options':options,
+        'runs':runs,
+        'median':medians(runs),
+    }
+
+def save(results:dict,filename:str) :
+    with open(filename,'w') as f :
+        json.dump(results,f,indent=1)
+
+def compare(filenames:typing.List[str],key='wall_s')->str :
+    """ Table of the median key of each phase, one column per results file, with the
+    ratio to the first one
+    """
+    results=[]
+    for filename in filenames :
+        with open(filename) as f :
+            results.append(json.load(f))
+    names=[]
+    for r in results :
+        for name in r['median'] :
+            if name not in names :
+                names.append(name)
+    # 'total' last
+    names.sort(key=lambda name:name=='total')
+    width=max(len(name) for name in names)
+    lines=[' '*width+''.join(f'  {os.path.basename(f)[:20]:>20}' for f in filenames)]
+    lines.append(' '*width+''.join(f"  {str(r.get('git'))[:20]:>20}" for r in results))
+    for name in names :
+        row=[r['median'].get(name,{}).get(key) for r in results]
+        cells=[]
+        for value in row :
+            if value is None :
+                cells.append(f'{"-":>20}')
+            elif row[0] :
+                cells.append(f'{value:>12.2f} ({value/row[0]:4.2f}x)')
+            else :
+                cells.append(f'{value:>20.2f}')
+        lines.append(f'{name:<{width}}'+''.join('  '+cell for cell in cells))
+    return '\n'.join(lines)
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+import psycopg2
+import psycopg2.extras
+import typing
+import struct
+import json
+import queue
+import threading
+import weakref
+import decimal
+
+"""
+Decoder for COPY ... TO STDOUT WITH (FORMAT binary), see the PostgreSQL
+documentation of COPY, "Binary Format". All integers are network byte order.
+    header: 11 bytes signature, int32 flags, int32 extension length + extension
+    tuple: int16 field count (-1 for the trailer), then for each field
+        int32 length (-1 for NULL) and length bytes of the type's binary (send) format
+"""
+
+SIGNATURE=b'PGCOPY\n\377\r\n\0'
+
+unpack_int16=struct.Struct('>h').unpack_from
+unpack_int32=struct.Struct('>i').unpack_from
+unpack_int64=struct.Struct('>q').unpack_from
+
+def decode_float4(data:bytes)->float :
+    """ PostgreSQL prints float4 with the shortest representation that round-trips
+    at float4 precision (and psycopg2 parses that text): do the same, to get
+    eg 0.1 and not 0.10000000149011612.
+    """
+    v=struct.unpack('>f',data)[0]
+    for precision in range(1,10) :
+        shortest=float(f'{v:.{precision}g}')
+        if struct.pack('>f',shortest)==data :
+            return shortest
+    return v
+
+def decode_numeric(data:bytes)->decimal.Decimal :
+    ndigits,weight,sign,dscale=struct.unpack_from('>hhHh',data)
+    if sign==0xC000 :
+        return decimal.Decimal('NaN')
+    digits=struct.unpack_from(f'>{ndigits}H',data,8)
+    # base 10000 digits, the first one has weight 10000**weight
+    value=sum(decimal.Decimal(d)*(decimal.Decimal(10_000)**(weight-i)) for i,d in enumerate(digits))
+    value=value.quantize(decimal.Decimal(1).scaleb(-dscale)) if ndigits>0 else decimal.Decimal(0).scaleb(-dscale)
+    return -value if sign==0x4000 else value
+
+def decode_hstore(data:bytes)->dict :
+    """ hstore_send format: int32 count, then count times
+    int32 key length, key, int32 value length (-1 for NULL), value
+    """
+    count=unpack_int32(data,0)[0]
+    pos=4
+    result={}
+    for i in range(count) :
+        length=unpack_int32(data,pos)[0]
+        key=data[pos+4:pos+4+length].decode()
+        pos+=4+length
+        length=unpack_int32(data,pos)[0]
+        pos+=4
+        if length<0 :
+            result[key]=None
+        else :
+            result[key]=data[pos:pos+length].decode()
+            pos+=length
+    return result
+
+def decode_text(data:bytes)->str :
+    return data.decode()
+
+scalar_decoders={
+    16:lambda data:data==b'\x01', #bool
+    18:decode_text, #char
+    19:decode_text, #name
+    20:lambda data:unpack_int64(data)[0], #int8
+    21:lambda data:unpack_int16(data)[0], #int2
+    23:lambda data:unpack_int32(data)[0], #int4
+    25:decode_text, #text
+    26:lambda data:struct.unpack('>I',data)[0], #oid
+    114:json.loads, #json
+    700:decode_float4, #float4
+    701:lambda data:struct.unpack('>d',data)[0], #float8
+    1042:decode_text, #bpchar
+    1043:decode_text, #varchar
+    1700:decode_numeric, #numeric
+    3802:lambda data:json.loads(data[1:]), #jsonb: 1 byte version, then json text
+}
+
+def decode_array(data:bytes,element_decoders:typing.Dict[int,typing.Callable])->list :
+    """ array_send format: int32 ndim, int32 has_null flag, int32 element type oid,
+    ndim times (int32 dim size, int32 lower bound), then the elements
+    like tuple fields (int32 length, -1 for NULL, and data).
+    Multidimensional arrays are returned as nested lists.
+    """
+    ndim,_,element_oid=struct.unpack_from('>iiI',data)
+    if ndim==0 :
+        return []
+    dims=[unpack_int32(data,12+8*i)[0] for i in range(ndim)]
+    decoder=element_decoders[element_oid]
+    pos=12+8*ndim
+    flat=[]
+    for i in range(_product(dims)) :
+        length=unpack_int32(data,pos)[0]
+        pos+=4
+        if length<0 :
+            flat.append(None)
+        else :
+            flat.append(decoder(data[pos:pos+length]))
+            pos+=length
+    for dim in reversed(dims[1:]) :
+        flat=[flat[i:i+dim] for i in range(0,len(flat),dim)]
+    return flat
+
+def _product(dims:typing.Collection[int])->int :
+    p=1
+    for d in dims :
+        p*=d
+    return p
+
+def get_decoders(c:psycopg2.extensions.cursor,description:typing.Collection,
+        known:typing.Optional[dict]=None)->typing.Optional[typing.List[typing.Callable]] :
+    """ Return one decoder per column in description, or None if one of the
+    column types is not supported.
+    hstore is an extension type with no fixed oid: look it up. known caches the
+    decoders of looked up oids across calls (None for unsupported ones).
+    """
+    oids=[col.type_code for col in description]
+    decoders=dict(scalar_decoders)
+    if known is not None :
+        decoders.update(known)
+    unknown=[o for o in oids if o not in decoders]
+    if len(unknown)>0 :
+        c.execute('SELECT oid,typname,typelem FROM pg_type WHERE oid=ANY(%s::oid[]);',(unknown,))
+        for oid,typname,typelem in c.fetchall() :
+            if typname=='hstore' :
+                decoders[oid]=decode_hstore
+            elif typname.startswith('_') and typelem in scalar_decoders :
+                decoders[oid]=lambda data:decode_array(data,scalar_decoders)
+            else :
+                decoders[oid]=None
+        if known is not None :
+            known.update({o:decoders.get(o) for o in unknown})
+    if any(decoders.get(o) is None for o in oids) :
+        return None
+    return [decoders[o] for o in oids]
+
+class Descriptions :
+    """ Columns and decoders of the queries, resolved once per connection and query
+    template: g_query_ids() runs the same query with thousands of id lists, and the
+    LIMIT 0 query and the pg_type lookup would otherwise cost two more round trips
+    per batch.
+    """
+    def __init__(self) :
+        self.lock=threading.Lock()
+        # connection -> ({template:(columns,decoders)},{oid:decoder})
+        self.resolved=weakref.WeakKeyDictionary()
+
+    def get(self,c:psycopg2.extensions.cursor,query:str,
+            template:typing.Optional[str]=None)->typing.Tuple[list,typing.Optional[list]] :
+        ''' (column names, decoders or None) of query. template: the query without
+        the parts that change between calls, None to not cache
+        '''
+        with self.lock :
+            templates,known=self.resolved.setdefault(c.connection,({},{}))
+        if template is not None and template in templates :
+            return templates[template]
+        c.execute(query+' LIMIT 0;')
+        description=c.description
+        result=([col.name for col in description],get_decoders(c,description,known))
+        if template is not None :
+            templates[template]=result
+        return result
+
+# one cache for all connections, see Descriptions.get()
+descriptions=Descriptions()
+
+class QueueWriter :
+    """ File-like object for c.copy_expert(): psycopg2 writes about one row per
+    .write(), group them into chunk_size bytes before handing them to the queue.
+    """
+    def __init__(self,q:queue.Queue,stop:threading.Event,chunk_size=1<<18) :
+        self.q=q
+        self.stop=stop
+        self.chunk_size=chunk_size
+        self.buf=[]
+        self.buf_len=0
+    def write(self,data:bytes) :
+        if self.stop.is_set() :
+            raise InterruptedError('COPY reader has gone away')
+        self.buf.append(data)
+        self.buf_len+=len(data)
+        if self.buf_len>=self.chunk_size :
+            self.flush()
+    def flush(self) :
+        if self.buf_len>0 :
+            self.q.put(b''.join(self.buf))
+        self.buf=[]
+        self.buf_len=0
+
+def g_copy_binary(c:psycopg2.extensions.cursor,query:str,
+        template:typing.Optional[str]=None)->typing.Iterator[dict] :
+    """ Like c.execute(query) followed by g_from_cursor(c), but transfer the
+    results with a binary COPY, decoded while it streams in. The COPY runs in a
+    thread: c's connection must not be used by anything else until this generator
+    is exhausted.
+    Falls back to the text protocol if a column type has no binary decoder, still
+    returning hstore columns as dicts.
+    template: the query without its id list, to look up the columns and decoders
+    only once, see Descriptions.
+    """
+    query=query.strip().rstrip(';')
+    columns,decoders=descriptions.get(c,query,template)
+    if decoders is None :
+        try :
+            psycopg2.extras.register_hstore(c)
+        except psycopg2.ProgrammingError :
+            pass #hstore extension not installed
+        c.execute(query+';')
+        for row in c :
+            yield {k:v for k,v in zip(columns,row) if v!=None}
+        return
+
+    q=queue.Queue(maxsize=16)
+    stop=threading.Event()
+    def run_copy() :
+        try :
+            writer=QueueWriter(q,stop)
+            c.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT binary)',writer)
+            writer.flush()
+            q.put(None)
+        except BaseException as e :
+            q.put(e)
+    thread=threading.Thread(target=run_copy,daemon=True)
+    thread.start()
+
+    fields=list(zip(columns,decoders))
+    buf=b''
+    pos=0
+    header_done=False
+    try :
+        while True :
+            chunk=q.get()
+            if chunk is None :
+                break
+            if isinstance(chunk,BaseException) :
+                raise chunk
+            buf=buf[pos:]+chunk
+            pos=0
+            if not header_done :
+                if len(buf)<19 :
+                    continue
+                assert buf[:11]==SIGNATURE, 'Invalid binary COPY signature'
+                pos=19+unpack_int32(buf,15)[0] #skip the header extension
+                header_done=True
+            buf_len=len(buf)
+            while buf_len-pos>=2 :
+                nfields=unpack_int16(buf,pos)[0]
+                if nfields==-1 :
+                    break #trailer
+                p=pos+2
+                row={}
+                complete=True
+                for name,decoder in fields :
+                    if buf_len-p<4 :
+                        complete=False
+                        break
+                    length=unpack_int32(buf,p)[0]
+                    p+=4
+                    if length<0 :
+                        continue #NULL, like g_from_cursor drop it
+                    if buf_len-p<length :
+                        complete=False
+                        break
+                    row[name]=decoder(buf[p:p+length])
+                    p+=length
+                if not complete :
+                    break #wait for the next chunk
+                pos=p
+                yield row
+    finally :
+        stop.set()
+        # unblock the COPY thread if we stopped reading early
+        while thread.is_alive() :
+            try :
+                q.get(timeout=0.1)
+            except queue.Empty :
+                pass
+        thread.join()
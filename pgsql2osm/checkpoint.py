@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+import array
+import heapq
+import itertools
+import json
+import os
+import time
+import typing
+import zlib
+
+from . import log
+from . import writers
+
+"""
+Checkpoints of an extraction, to --resume it after a crash or a lost connection.
+A checkpoint directory contains
+    state.json: the last completed phase, the settings it was made with, and
+        during the write phase the output offset up to which the output is complete
+    *.ids: sorted id arrays, delta-coded int64 and zlib-compressed
+Every save writes new .ids files (numbered by generation) and then replaces
+state.json, which is the only file naming them: a crash during a save leaves the
+previous checkpoint intact.
+"""
+
+# keys of the accumulator that are saved after each phase
+ACCUMULATOR_KEYS=('nodes','nodes_within','ways','rels')
+# osm element name -> accumulator key
+ELEMENT_KEYS={'node':'nodes','way':'ways','relation':'rels'}
+# these have to be the same to resume
+SETTINGS_KEYS=('bounds_geojson','bounds_rel_id','bounds_iso','bounds_box','out_format','sorted')
+
+def encode_ids(ids:array.array)->bytes :
+    deltas=array.array('q',(b-a for a,b in zip(itertools.chain((0,),ids),ids)))
+    return zlib.compress(deltas.tobytes(),1)
+
+def decode_ids(data:bytes)->array.array :
+    deltas=array.array('q')
+    deltas.frombytes(zlib.decompress(data))
+    return array.array('q',itertools.accumulate(deltas))
+
+def subtract_sorted(ids:array.array,remove:array.array)->array.array :
+    ''' ids that are not in remove, both sorted
+    '''
+    result=array.array('q')
+    j=0
+    len_remove=len(remove)
+    for i in ids :
+        while j<len_remove and remove[j]<i :
+            j+=1
+        if j<len_remove and remove[j]==i :
+            continue
+        result.append(i)
+    return result
+
+class Checkpoint :
+    """ Save and restore the accumulator between phases, and the progress of the
+    write phase every interval_s seconds.
+    """
+    def __init__(self,s,directory:str,interval_s:float=60) :
+        self.s=s
+        self.directory=directory
+        self.interval_s=interval_s
+        self.state=None
+        self.generation=0
+        os.makedirs(directory,exist_ok=True)
+        # ids already written to the output, by accumulator key
+        self.written={k:array.array('q') for k in ELEMENT_KEYS.values()}
+        self.written_pending={k:[] for k in ELEMENT_KEYS.values()}
+        self.last_save=time.time()
+
+    def path(self,name:str)->str :
+        return os.path.join(self.directory,name)
+
+    def settings_dict(self)->dict :
+        settings={k:getattr(self.s,k) for k in SETTINGS_KEYS}
+        settings['out_file']=self.s.out_file if isinstance(self.s.out_file,str) else None
+        return settings
+
+    def save_ids(self,name:str,ids:array.array)->str :
+        filename=f'{name}.{self.generation}.ids'
+        with open(self.path(filename),'wb') as f :
+            f.write(encode_ids(ids))
+        return filename
+
+    def save_state(self,state:dict) :
+        tmp=self.path('state.json.tmp')
+        with open(tmp,'w') as f :
+            json.dump(state,f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp,self.path('state.json'))
+        self.state=state
+        # files of previous generations are not referenced anymore
+        referenced=set(state['files'].values())
+        for filename in os.listdir(self.directory) :
+            if filename.endswith('.ids') and filename not in referenced :
+                os.remove(self.path(filename))
+        self.generation+=1
+        self.last_save=time.time()
+
+    def save_phase(self,phase:str,a) :
+        """ Phase phase was completed: save the accumulator
+        """
+        files={k:self.save_ids(k,a.sequence(k)) for k in ACCUMULATOR_KEYS}
+        self.save_state({'phase':phase,'settings':self.settings_dict(),'files':files})
+        log.l.log('checkpoint saved after phase',phase)
+
+    def load(self,a)->typing.Optional[str] :
+        """ Restore the accumulator from the last checkpoint and return the last
+        completed phase, or None if there is no checkpoint.
+        Elements that were already written are removed from the accumulator.
+        """
+        if not os.path.exists(self.path('state.json')) :
+            log.l.log('no checkpoint to resume from in',self.directory)
+            return None
+        with open(self.path('state.json')) as f :
+            state=json.load(f)
+        if state['settings']!=self.settings_dict() :
+            raise BaseException(f'Checkpoint in {self.directory} was made with other settings: {state["settings"]}')
+        self.state=state
+        self.generation=1+max((int(filename.split('.')[-2]) for filename in state['files'].values()),default=0)
+        for k in ACCUMULATOR_KEYS :
+            with open(self.path(state['files'][k]),'rb') as f :
+                a.load_sorted(k,decode_ids(f.read()))
+        if 'write' in state :
+            for k in self.written :
+                with open(self.path(state['files']['written_'+k]),'rb') as f :
+                    self.written[k]=decode_ids(f.read())
+                a.load_sorted(k,subtract_sorted(a.sequence(k),self.written[k]))
+            log.l.log('resuming write phase at output offset',log.n(state['write']['offset']))
+        else :
+            log.l.log('resuming after phase',state['phase'])
+        return state['phase']
+
+    def output_offset(self)->typing.Optional[int] :
+        """ The output is complete up to that offset, None when it needs to be started over
+        """
+        if self.state is None or 'write' not in self.state :
+            return None
+        return self.state['write']['offset']
+
+    def before_write(self,el:writers.OsmElement,out,out_f) :
+        """ Call before each out.write(el) of the write phase. Save a checkpoint when
+        it is due, then remember el as written.
+        """
+        key=ELEMENT_KEYS.get(el.name)
+        if key is None :
+            return
+        if time.time()-self.last_save>=self.interval_s :
+            self.save_write(out,out_f)
+        self.written_pending[key].append(int(el.attrs['id']))
+
+    def save_write(self,out,out_f) :
+        # everything up to here needs to be on disk, complete
+        out.flush()
+        out_f.flush()
+        offset=out_f.tell()
+        files={k:v for k,v in self.state['files'].items() if k in ACCUMULATOR_KEYS}
+        for k,pending in self.written_pending.items() :
+            if len(pending)>0 :
+                pending.sort()
+                self.written[k]=array.array('q',heapq.merge(self.written[k],pending))
+                self.written_pending[k]=[]
+            files['written_'+k]=self.save_ids('written_'+k,self.written[k])
+        self.save_state({**self.state,'files':files,'write':{'offset':offset}})
+
+    def save_done(self) :
+        self.save_state({**self.state,'phase':'write'})
+        log.l.log('checkpoint: extraction complete')
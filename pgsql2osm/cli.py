@@ -1,16 +1,23 @@
 #!/usr/bin/python3
 
 import argparse
+import os
+from . import log
 from . import pgsql2osm
 from . import settings
 
 def main() :
     parser=argparse.ArgumentParser(prog='pgsql2osm')
 
-    parser.add_argument('get_lonlat_binary',
-        help="Path to the get_lonlat binary")
-    parser.add_argument('nodes_file',
-        help='Path to the nodes file created by osm2pgsql at import')
+    parser.add_argument('nodes_file',nargs='?',default=None,
+        help='Path to the nodes file created by osm2pgsql at import (not needed with --replay)')
+    # deprecated form 'pgsql2osm /path/to/get_lonlat /path/to/nodes_file ...', see below
+    parser.add_argument('legacy_nodes_file',nargs='?',default=None,
+        help=argparse.SUPPRESS)
+    parser.add_argument('--get-lonlat',dest='get_lonlat_binary',
+        default=None,
+        help="""Path to the get_lonlat binary. By default the nodes file is instead read
+directly (and only needs to be readable)""")
     parser.add_argument('-d','--dsn',dest='postgres_dsn',
         default='dbname=gis port=5432',
         help="The connection string to pass to psycopg2, default '%(default)s'")
@@ -27,14 +34,120 @@ Info: use quotes with negative numbers, eg --bbox='-180,-89,180,89'.''')
         help='Integer for the osm relation that should make the boundary')
     bounds_g.add_argument('-i','--iso',dest='bounds_iso',
         default=None,
-        help='Country or region code for looking up in regions.csv, to determine boundary')
+        help="""Country or region code for looking up in regions.csv, to determine boundary.
+A comma-separated list of codes extracts each of them in one run, see --output""")
+    bounds_g.add_argument('--regions-file',dest='regions_file',
+        default=None,
+        help="""File with one region code per line (# for comments), to extract each of them
+in one run like a comma-separated --iso list""")
     bounds_g.add_argument('-g','--geojson',dest='bounds_geojson',
         default=None,
         help='Geojson file for determining the boundary')
 
     parser.add_argument('-o','--output',dest='out_file',
-        help="Path where the output .osm should be written to. When '-', write to stdout",
+        help="""Path where the output .osm (or .osm.pbf) should be written to.
+Ending in .bz2, .gz or .zst compresses it (.zst needs the zstandard module).
+When '-', write to stdout. With several regions, a template where {iso} and {name}
+are replaced by each region's code and name, eg 'extracts/{iso}.osm.pbf'""",
         required=True)
+    parser.add_argument('-f','--format',dest='out_format',
+        default=None,choices=('xml','pbf'),
+        help="Output format, default is pbf when the output ends in .pbf, xml otherwise")
+
+    parser.add_argument('--compress-threads',dest='compress_threads',
+        default=None,type=int,
+        help="Threads compressing a .bz2, .gz or .zst output, default one per cpu")
+
+    parser.add_argument('--stage-ids',dest='stage_ids',default=False,
+        action='store_true',
+        help="""When writing, load each element type's ids into a temp table with COPY and
+run one query per table joined on it, instead of thousands of IN (...) queries""")
+
+    parser.add_argument('--binary-copy',dest='binary_copy',default=False,
+        action='store_true',
+        help="""When writing, transfer the elements with COPY ... (FORMAT binary) and decode
+them in-process, also reading hstore tags directly instead of through hstore_to_json()""")
+
+    parser.add_argument('--no-prepare',dest='prepare',default=True,
+        action='store_false',
+        help="""Send the ids inline in each query instead of EXECUTEing statements PREPAREd once
+per connection, eg behind a connection pooler in transaction mode""")
+
+    parser.add_argument('--itersize',dest='itersize',default=50_000,type=int,
+        help="""Rows fetched at a time from the server-side cursors of the big queries,
+default %(default)s""")
+
+    parser.add_argument('-j','--jobs',dest='jobs',default=1,type=int,
+        help="""Database connections used in parallel to find the parents of nodes and ways,
+all sharing the same snapshot, default %(default)s""")
+
+    parser.add_argument('--chunk-target-ms',dest='chunk_target_ms',default=250,type=int,
+        help="""Target time of each query finding the parents of a chunk of nodes or ways,
+the chunk size adapts to it, default %(default)s""")
+    parser.add_argument('--chunk-cache',dest='chunk_cache',
+        default=os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache')),
+            'pgsql2osm','chunk_sizes.json'),
+        help="""File where the chunk sizes learned for each table are kept, so that the next
+run starts from them, '' to disable, default %(default)s""")
+
+    parser.add_argument('--partitions',dest='partitions',default=1,type=int,
+        help="""Split the boundary into that many strips of longitude, and find the ids of
+each in its own process and connection. The results are merged before writing one output""")
+
+    parser.add_argument('--concurrent-write',dest='concurrent_write',default=False,
+        action='store_true',
+        help="""Query and write nodes, ways and relations at the same time on separate
+connections, into temporary files next to the output, joined at the end""")
+
+    parser.add_argument('--sorted',dest='sorted',default=False,
+        action='store_true',
+        help="""Write the elements of each type in ascending id order, like osmium sort would.
+Sorting spills to temporary files next to the output when over --sort-memory""")
+    parser.add_argument('--sort-memory',dest='sort_memory',default=1024,type=int,
+        help="Memory in MB for sorting each element type with --sorted, default %(default)s")
+
+    parser.add_argument('--checkpoint',dest='checkpoint_dir',default=None,
+        help="""Directory where to save the progress after each phase, and every minute
+while writing, to be able to --resume""")
+    parser.add_argument('--resume',dest='resume',default=False,
+        action='store_true',
+        help="""Continue from the last checkpoint in the --checkpoint directory, appending
+to the output written so far. Needs the same boundary and output options""")
+
+    parser.add_argument('--manifest',dest='manifest',default=False,
+        action='store_true',
+        help="""Also write <output>.manifest, the ids and a content hash of all exported elements,
+to be used by a later --since""")
+    parser.add_argument('--since',dest='since',default=None,
+        help="""Manifest of a previous extract of the same boundary: only write the elements
+created, modified or deleted since, as an osmChange (.osc). The database has no element
+versions: all of them get the manifest's version plus one (a plain extract has none),
+so that they replace those of the previous extract""")
+
+    parser.add_argument('--metrics',dest='metrics_file',default=None,
+        help="""Write metrics of each phase (wall and cpu time, queries, rows, bytes written,
+chunk sizes, peak RSS, query latency histograms) to this file at the end: json, or a
+Prometheus textfile if it ends in .prom""")
+
+    parser.add_argument('--profile-memory',dest='profile_memory',default=None,
+        nargs='?',const='-',metavar='FILE',
+        help="""Sample the RSS in the background, and at the end of each phase record its peak and
+the ids and bytes held by the accumulator. Print the summary at the end, or write it as json to FILE""")
+    parser.add_argument('--tracemalloc',dest='tracemalloc_top',default=0,type=int,metavar='N',
+        help="""With --profile-memory, also trace python allocations and report the top N
+allocation sites at the end of each phase. Slows everything down""")
+
+    parser.add_argument('--record',dest='record_dir',default=None,metavar='DIR',
+        help="""Save the results of every statement and the node locations read into DIR, for
+a later --replay. Runs with --jobs 1 --partitions 1 and a fixed chunk size""")
+    parser.add_argument('--replay',dest='replay_dir',default=None,metavar='DIR',
+        help="""Run without the database and nodes file, from what --record saved in DIR: to
+profile the python side. Needs the same boundary and options as the recording""")
+
+    parser.add_argument('--probe',dest='probe_only',default=False,
+        action='store_true',
+        help="""Only report the indexes found, the query plans and strategies chosen, and the
+indexes that are missing, then exit""")
 
     parser.add_argument('--debug',dest='debug',default=False,
         action='store_true',
@@ -42,5 +155,11 @@ Info: use quotes with negative numbers, eg --bbox='-180,-89,180,89'.''')
 
 
     args=parser.parse_args()
+    if args.legacy_nodes_file is not None :
+        if args.get_lonlat_binary is not None :
+            parser.error('only one positional nodes_file can be given with --get-lonlat')
+        log.l.log_start('WARNING: the get_lonlat binary as first positional argument is deprecated,'
+            ' use --get-lonlat /path/to/get_lonlat instead')
+        args.get_lonlat_binary,args.nodes_file=args.nodes_file,args.legacy_nodes_file
     s=settings.Settings(args)
     s.main()
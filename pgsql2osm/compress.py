@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import os
+import typing
+
+"""
+In-process compression of the output, chosen by the filename suffix. The output
+is cut into independent blocks that are compressed in parallel and written in
+order: one complete bz2/gzip/zstd stream per block. Concatenated streams are
+valid files for bzip2, gzip, zstd (and osmium) to read.
+"""
+
+def compress_zstd(data:bytes)->bytes :
+    try :
+        import zstandard
+    except ImportError :
+        raise BaseException('Writing .zst output needs the zstandard module: pip install zstandard')
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+# bz2, zlib and zstandard all release the GIL while compressing: threads are enough
+codecs={
+    '.bz2':lambda data:bz2.compress(data,9),
+    '.gz':lambda data:gzip.compress(data,6,mtime=0),
+    '.zst':compress_zstd,
+}
+
+def codec_suffix(filename:str)->typing.Optional[str] :
+    for suffix in codecs :
+        if filename.endswith(suffix) :
+            return suffix
+    return None
+
+def strip_suffix(filename:str)->str :
+    """ 'France.osm.bz2' -> 'France.osm'
+    """
+    suffix=codec_suffix(filename)
+    return filename if suffix is None else filename[:-len(suffix)]
+
+class ParallelCompressor :
+    """ Binary file-like object, compress everything written to it into f.
+    Data is split into blocks of block_size bytes, each compressed on a thread of
+    the pool. At most 2*threads blocks are in flight, the oldest is waited on and
+    written before a new one is submitted, so blocks are written in order.
+    """
+    def __init__(self,f:typing.BinaryIO,compress:typing.Callable[[bytes],bytes],
+            threads:typing.Optional[int]=None,block_size=1<<22) :
+        self.f=f
+        self.compress=compress
+        self.threads=threads if threads is not None else (os.cpu_count() or 1)
+        self.block_size=block_size
+        self.pool=concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.in_flight=collections.deque()
+        self.buf=[]
+        self.buf_len=0
+
+    def write(self,data:bytes)->int :
+        self.buf.append(data)
+        self.buf_len+=len(data)
+        if self.buf_len>=self.block_size :
+            block=b''.join(self.buf)
+            for i in range(0,len(block)-self.block_size+1,self.block_size) :
+                self.submit(block[i:i+self.block_size])
+            rest=block[len(block)-len(block)%self.block_size:]
+            self.buf=[rest]
+            self.buf_len=len(rest)
+        return len(data)
+
+    def submit(self,block:bytes) :
+        while len(self.in_flight)>=2*self.threads :
+            self.f.write(self.in_flight.popleft().result())
+        self.in_flight.append(self.pool.submit(self.compress,block))
+
+    def flush(self) :
+        """ Compress and write out everything written so far, this ends a stream:
+        don't call too often.
+        """
+        if self.buf_len>0 :
+            self.submit(b''.join(self.buf))
+        self.buf=[]
+        self.buf_len=0
+        while len(self.in_flight)>0 :
+            self.f.write(self.in_flight.popleft().result())
+        self.f.flush()
+
+    def tell(self)->int :
+        """ Position in the compressed output, only meaningful just after flush()
+        """
+        return self.f.tell()
+
+    def close(self) :
+        try :
+            self.flush()
+        finally :
+            self.pool.shutdown(cancel_futures=True)
+            self.f.close()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback) :
+        self.close()
+
+def open_output(out_file:typing.Union[str,typing.BinaryIO],
+        threads:typing.Optional[int]=None,offset:typing.Optional[int]=None)->typing.ContextManager[typing.BinaryIO] :
+    """ Open out_file for writing: a filename ending in .bz2, .gz or .zst gets a
+    ParallelCompressor, any other one a plain file. An already open file object
+    is used as-is and not closed.
+    With an offset, keep the existing file up to offset and append from there.
+    """
+    if not isinstance(out_file,str) :
+        return contextlib.nullcontext(out_file)
+    if offset is None :
+        f=open(out_file,'wb')
+    else :
+        f=open(out_file,'r+b')
+        f.truncate(offset)
+        f.seek(offset)
+    suffix=codec_suffix(out_file)
+    if suffix is None :
+        return f
+    return ParallelCompressor(f,codecs[suffix],threads)
@@ -3,9 +3,15 @@
 import psycopg2
 import typing
 import asyncio
+import itertools
+import json
 import os
+import re
+import threading
+import weakref
 
 from . import log
+from . import binarycopy
 
 
 def regions_lookup(isocode:str) :
@@ -26,9 +32,25 @@ def regions_lookup(isocode:str) :
     log.l.log_start(f'Error iso boundary not found: {isocode}')
     exit(1)
 
+def read_regions_file(regions_file:str)->typing.List[str] :
+    ''' One iso code (as for regions_lookup) per line, # starts a comment
+    '''
+    regions=[]
+    with open(regions_file) as f :
+        for line in f :
+            iso=line.split('#')[0].strip()
+            if iso :
+                regions.append(iso)
+    return regions
+
 async def get_latlon_str_from_flatnodes(osm_ids:typing.Collection[int],s)->typing.Iterator :
     """ s is a settings.Settings object
+    Without a get_lonlat_binary, read s.flatnodes (a flatnodes.FlatNodes) in-process.
     """
+    if s.get_lonlat_binary is None :
+        for i in s.flatnodes.get_latlon_str(osm_ids) :
+            yield i
+        return
     a=await asyncio.create_subprocess_exec(s.get_lonlat_binary,s.nodes_file,
         stdout=asyncio.subprocess.PIPE,stdin=asyncio.subprocess.PIPE)
     # some osm_ids may error out. in that case get_lonlat just ignores them.
@@ -50,10 +72,14 @@ async def get_latlon_str_from_flatnodes(osm_ids:typing.Collection[int],s)->typin
 def g_from_cursor(c:psycopg2.extensions.cursor,verbose=False,prefix_msg='')->typing.Iterator[dict]:
     ''' Assuming the query has already c.execute()d, return its results
     as a dict-generator'''
-    columns=[i.name for i in c.description]
+    columns=None
     tot_count=c.rowcount
     count=1 # for human display
-    while (row:=c.fetchone())!=None :
+    # iterating fetches rows one at a time, or c.itersize at a time for named cursors
+    for row in c :
+        if columns is None :
+            # named cursors only have a description after the first fetch
+            columns=[i.name for i in c.description]
         if verbose :
             log.l.simplerate(count,prefix_msg+'row',tot_count)
         yield {k:v for k,v in zip(columns,row) if v!=None}
@@ -63,14 +89,113 @@ def g_from_cursor(c:psycopg2.extensions.cursor,verbose=False,prefix_msg='')->typ
         #count-=1
         #l.log(prefix_msg+'row',n(count),'/',n(tot_count),'    ',percent(count,tot_count),clearline=True)
 
+# unique names for named cursors, they live as long as the transaction
+cursor_names=(f'pgsql2osm_cursor_{i}' for i in itertools.count())
+
+def g_stream(conn:psycopg2.extensions.connection,query:str,params=None,itersize=50_000,
+        verbose=False,prefix_msg='')->typing.Iterator[tuple] :
+    ''' Run query on a named (server-side) cursor of conn and yield its rows as plain tuples,
+    fetching itersize rows at a time. Unlike c.execute() on a client-side cursor, the whole
+    result set is never loaded into memory at once.
+    Needs to run inside a transaction (conn not in autocommit).
+    '''
+    named=conn.cursor(name=next(cursor_names))
+    try :
+        named.execute(query,params)
+        count=0
+        while len(rows:=named.fetchmany(itersize))>0 :
+            yield from rows
+            count+=len(rows)
+            if verbose and log.l.check() :
+                log.l.log(log.n(count),prefix_msg+'rows',clearline=True)
+        if verbose :
+            log.l.log(log.n(count),prefix_msg+'rows',clearline=True)
+            log.l.save_clearedline()
+    finally :
+        named.close()
+
+def g_stream_dicts(conn:psycopg2.extensions.connection,query:str,params=None,
+        itersize=50_000)->typing.Iterator[dict] :
+    ''' Like g_stream(), yielding the same dicts as g_from_cursor() would.
+    '''
+    named=conn.cursor(name=next(cursor_names))
+    try :
+        named.execute(query,params)
+        columns=None
+        while len(rows:=named.fetchmany(itersize))>0 :
+            if columns is None :
+                # named cursors only have a description after the first fetch
+                columns=[i.name for i in named.description]
+            for row in rows :
+                yield {k:v for k,v in zip(columns,row) if v!=None}
+    finally :
+        named.close()
+
+re_param=re.compile(r'\$(\d+)')
+
+class PreparedStatements :
+    ''' Query templates PREPAREd once per connection and then EXECUTEd with their
+    parameters: the server parses (and, once it settles on a generic plan, plans)
+    each template once per session, instead of every distinct SQL string of inline
+    ids. Templates take $1,$2,... of the given types, eg ids as one bigint[] with
+    id=ANY($1) or nodes && $1.
+    A PREPARE is not undone by a rollback, the QueryCanceled retries can EXECUTE again.
+    '''
+    def __init__(self) :
+        self.lock=threading.Lock()
+        # (template,types) -> statement name, the same on every connection
+        self.names={}
+        # statement name -> template
+        self.templates={}
+        # connection -> names prepared on it
+        self.prepared=weakref.WeakKeyDictionary()
+
+    def execute(self,c:psycopg2.extensions.cursor,template:str,types:typing.Sequence[str],
+            params:typing.Sequence,prepare=True) :
+        ''' c.execute() template with params. prepare=False inlines the parameters
+        instead, with a cast to their type, for servers without prepared statements
+        (eg behind a transaction pooler)
+        '''
+        template=template.strip().rstrip(';')
+        if not prepare :
+            # same order as the $n, which may repeat
+            order=[int(m.group(1))-1 for m in re_param.finditer(template)]
+            query=re_param.sub(lambda m:'%s::'+types[int(m.group(1))-1],template.replace('%','%%'))
+            c.execute(query+';',tuple(params[i] for i in order))
+            return
+        with self.lock :
+            key=(template,tuple(types))
+            if key not in self.names :
+                self.names[key]=f'pgsql2osm_prepared_{len(self.names)}'
+                self.templates[self.names[key]]=template
+            name=self.names[key]
+            prepared=self.prepared.setdefault(c.connection,set())
+        if name not in prepared :
+            c.execute(f'PREPARE {name} ({",".join(types)}) AS {template};')
+            prepared.add(name)
+        c.execute(f'EXECUTE {name} ({",".join("%s" for p in params)});',tuple(params))
+
+    def template(self,name:str)->typing.Optional[str] :
+        ''' The template PREPAREd as name, eg to report EXECUTEs by query
+        '''
+        with self.lock :
+            return self.templates.get(name)
+
+# one registry for all connections, see PreparedStatements.execute()
+prepared=PreparedStatements()
+
 def g_query_ids(c:psycopg2.extensions.cursor,query:str,ids:typing.Iterator[int],
-        id_col:str,step=1000,verbose=False)->typing.Iterator[dict] :
+        id_col:str,step=1000,verbose=False,binary=False,prepare=False)->typing.Iterator[dict] :
     ''' Given an SQL query without the ending semicolon and where the last
     clause is a WHERE, append AND {id_col} IN (*ids) and yield those results.
     The parenthesizing should be made explicit, NO GUARANTEER in this case:
     [...] WHERE condA OR condB -> [...] WHERE condA OR condB AND id IN ([...])
     -> SHOULD write [...] WHERE (condA OR condB)
     A psql syntax error will be thrown if ORDER BY, LIMIT are the last clause.
+    binary==True transfers the results with a binary COPY, see binarycopy.g_copy_binary().
+    prepare==True instead appends AND {id_col}=ANY($1), PREPAREd once and EXECUTEd with
+    each batch of ids as a bigint[], see PreparedStatements. Not with binary: COPY can
+    not EXECUTE.
     '''
     init_query=query
     # case of 'SELECT ... FROM table' -> 'SELECT .. FROM table WHERE {append_query}'
@@ -85,22 +210,141 @@ def g_query_ids(c:psycopg2.extensions.cursor,query:str,ids:typing.Iterator[int],
         buf=[]
         for i in range(step) :
             try :
-                buf.append(str(next(ids)))
+                buf.append(next(ids))
             except StopIteration :
                 finished=True # out of the while
                 break #out of the for 
         if len(buf)==0 :
             continue
+        if prepare and not binary :
+            if verbose :
+                log.l.log(init_query,with_and,id_col,'=ANY($1)',len(buf),'ids')
+            prepared.execute(c,f'{init_query} {with_and} {id_col}=ANY($1)',('bigint[]',),(buf,))
+            yield from g_from_cursor(c)
+            continue
         query=f'{init_query} {with_and} {id_col} IN ('
-        query+=','.join(buf)
+        query+=','.join(map(str,buf))
         query+=');'
         if verbose :
             log.l.log(query)
+        if binary :
+            yield from binarycopy.g_copy_binary(c,query,template=f'{init_query} {with_and} {id_col}')
+            continue
         c.execute(query)
         if verbose :
             log.l.log('query returned',c.rowcount,'rows')
         yield from g_from_cursor(c)
 
+class IdsReader :
+    ''' Minimal file-like object for COPY FROM STDIN, generating one id per line
+    lazily from ids.
+    '''
+    def __init__(self,ids:typing.Iterator[int]) :
+        self.ids=iter(ids)
+    def read(self,size=8192)->str :
+        lines=[]
+        length=0
+        for i in self.ids :
+            line=f'{i}\n'
+            lines.append(line)
+            length+=len(line)
+            if length>=size :
+                break
+        return ''.join(lines)
+    def readline(self,size=-1)->str :
+        for i in self.ids :
+            return f'{i}\n'
+        return ''
+
+def stage_ids(c:psycopg2.extensions.cursor,ids:typing.Iterator[int],table_name:str)->str :
+    ''' Bulk load ids into the session temp table table_name with COPY FROM STDIN,
+    replacing it if it exists. ANALYZE it so that the planner can choose a hash
+    or merge join. Return table_name.
+    '''
+    c.execute(f'DROP TABLE IF EXISTS {table_name};')
+    c.execute(f'CREATE TEMP TABLE {table_name} (id bigint);')
+    c.copy_expert(f'COPY {table_name} (id) FROM STDIN',IdsReader(ids))
+    c.execute(f'ANALYZE {table_name};')
+    return table_name
+
+def g_query_staged(c:psycopg2.extensions.cursor,query:str,staging_table:str,
+        id_col:str,itersize=10_000,binary=False)->typing.Iterator[dict] :
+    ''' Like g_query_ids(), but with the ids from a stage_ids() table: append
+    AND {id_col} IN (SELECT id FROM {staging_table}), and run it as a single
+    query. The results are streamed through a named (server-side) cursor, or
+    a binary COPY when binary==True.
+    '''
+    with_and='AND' if query.find('WHERE')>=0 else 'WHERE'
+    query=f'{query} {with_and} {id_col} IN (SELECT id FROM {staging_table});'
+    if binary :
+        yield from binarycopy.g_copy_binary(c,query)
+        return
+    yield from g_stream_dicts(c.connection,query,itersize=itersize)
+
+def adapt_batch_size(batch_size:int,elapsed:float,target_s:float,
+        min_size=100,max_size=100_000)->int :
+    ''' Scale batch_size so that the next batch takes about target_s seconds,
+    changing by at most a factor 2 per step to smooth out latency spikes.
+    '''
+    factor=target_s/max(elapsed,1e-3)
+    factor=min(2.0,max(0.5,factor))
+    return int(min(max_size,max(min_size,batch_size*factor)))
+
+class ChunkController :
+    ''' Chunk size of the parent queries, steered towards queries taking target_s each.
+    Query time is not proportional to the chunk size: it jumps once the array outgrows
+    what the index handles well, so adapt_batch_size() would oscillate around that
+    cliff. Instead, AIMD: grow by 25% while far below target, additively (5%) close
+    to it, and shrink multiplicatively as soon as a query is over target.
+    '''
+    def __init__(self,size=50,target_s=0.25,min_size=1,max_size=100_000) :
+        self.size=size
+        self.target_s=target_s
+        self.min_size=min_size
+        self.max_size=max_size
+
+    def update(self,elapsed:float)->int :
+        ''' elapsed: seconds taken by the slowest query of the last chunk
+        '''
+        if elapsed>self.target_s :
+            self.size=int(self.size*max(0.5,0.9*self.target_s/elapsed))
+        elif elapsed<self.target_s/2 :
+            self.size=int(self.size*1.25)+1
+        else :
+            self.size+=max(1,self.size//20)
+        self.size=min(self.max_size,max(self.min_size,self.size))
+        return self.size
+
+    def canceled(self)->int :
+        ''' The last chunk hit the statement_timeout
+        '''
+        self.size=max(self.min_size,self.size//2)
+        return self.size
+
+def load_chunk_sizes(filename:typing.Optional[str])->dict :
+    ''' Chunk sizes learned by previous runs, {key:size}
+    '''
+    if filename is None or not os.path.exists(filename) :
+        return {}
+    try :
+        with open(filename) as f :
+            return json.load(f)
+    except ValueError :
+        return {}
+
+def save_chunk_sizes(filename:typing.Optional[str],sizes:dict) :
+    ''' Merge sizes into the file, replaced atomically: several processes may save at once
+    '''
+    if filename is None :
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(filename)),exist_ok=True)
+    merged=load_chunk_sizes(filename)
+    merged.update(sizes)
+    tmp=f'{filename}.{os.getpid()}.tmp'
+    with open(tmp,'w') as f :
+        json.dump(merged,f,indent=1,sort_keys=True)
+    os.replace(tmp,filename)
+
 def get_columns_of_types(c:psycopg2.extensions.cursor,
         col_types:typing.Collection[str],table_full_name:str)->typing.Iterator[str] :
     values_col_types=",".join(["'"+i+"'" for i in col_types])
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import heapq
+import pickle
+import tempfile
+import typing
+
+"""
+External merge sort with bounded memory: items are collected in memory until
+their estimated size reaches max_bytes, then sorted and spilled to a temporary
+file (a run). At the end, all runs and the remaining in-memory items are merged
+with heapq.merge, reading each run sequentially.
+"""
+
+class ExternalSorter :
+    """ Usage:
+        sorter=ExternalSorter(key=lambda el:el.id,max_bytes=512<<20,size=estimate_size)
+        for item in items :
+            sorter.add(item)
+        for item in sorter.g_sorted() :
+            ...
+    size(item) is an estimate of the memory used by item, in bytes. Runs are
+    written into tmp_dir (default: the system's temporary directory).
+    """
+    def __init__(self,key:typing.Callable,max_bytes:int,size:typing.Callable[[typing.Any],int],
+            tmp_dir:typing.Optional[str]=None) :
+        self.key=key
+        self.max_bytes=max_bytes
+        self.size=size
+        self.tmp_dir=tmp_dir
+        self.items=[]
+        self.items_bytes=0
+        self.runs=[]
+
+    def add(self,item) :
+        self.items.append(item)
+        self.items_bytes+=self.size(item)
+        if self.items_bytes>=self.max_bytes :
+            self.spill()
+
+    def spill(self) :
+        self.items.sort(key=self.key)
+        run=tempfile.TemporaryFile(dir=self.tmp_dir)
+        pickler=pickle.Pickler(run,pickle.HIGHEST_PROTOCOL)
+        for item in self.items :
+            pickler.dump(item)
+            # the pickler would otherwise keep a reference to every item
+            pickler.clear_memo()
+        run.seek(0)
+        self.runs.append(run)
+        self.items=[]
+        self.items_bytes=0
+
+    def g_run(self,run:typing.BinaryIO)->typing.Iterator :
+        unpickler=pickle.Unpickler(run)
+        while True :
+            try :
+                yield unpickler.load()
+            except EOFError :
+                return
+
+    def g_sorted(self)->typing.Iterator :
+        """ All added items in ascending key order. Can only be called once.
+        """
+        self.items.sort(key=self.key)
+        try :
+            if len(self.runs)==0 :
+                yield from self.items
+            else :
+                yield from heapq.merge(*map(self.g_run,self.runs),self.items,key=self.key)
+        finally :
+            self.close()
+
+    def close(self) :
+        for run in self.runs :
+            run.close()
+        self.runs=[]
+        self.items=[]
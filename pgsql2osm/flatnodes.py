@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import mmap
+import os
+import typing
+
+"""
+The osm2pgsql --flat-nodes file is an osmium DenseFileArray: a plain array of
+osmium::Location, indexed by node id. Each Location is two native-endian int32,
+x (lon) then y (lat), in units of 1e-7 degrees. Ids that were never set contain
+the undefined location (int32 max for both coordinates).
+"""
+
+LOCATION_SIZE=8 # two int32
+COORDINATE_PRECISION=10_000_000
+
+def coordinate_str(value:int)->str :
+    """ Same output as osmium's Location::as_string: fixed point with trailing
+    zeros removed, and no decimal point at all when the fraction is zero.
+    """
+    sign='-' if value<0 else ''
+    int_part,frac_part=divmod(abs(value),COORDINATE_PRECISION)
+    frac=f'{frac_part:07d}'.rstrip('0')
+    if frac :
+        return f'{sign}{int_part}.{frac}'
+    return f'{sign}{int_part}'
+
+class FlatNodes :
+    """ Read-only, in-process replacement for the get_lonlat binary: memory-map the
+    flatnodes file and look up locations directly.
+    """
+    def __init__(self,nodes_file:str) :
+        self.nodes_file=nodes_file
+        self.fd=os.open(nodes_file,os.O_RDONLY)
+        size=os.fstat(self.fd).st_size
+        if size<LOCATION_SIZE :
+            os.close(self.fd)
+            raise BaseException(f'nodes_file is empty or too small: {nodes_file}')
+        self.mm=mmap.mmap(self.fd,size,access=mmap.ACCESS_READ)
+        if hasattr(self.mm,'madvise') :
+            # lookups are sparse over a potentially huge file, readahead is wasted IO
+            self.mm.madvise(mmap.MADV_RANDOM)
+        self.coords=memoryview(self.mm)[:size-size%LOCATION_SIZE].cast('i')
+        self.max_id=len(self.coords)//2-1
+
+    def get_latlon_str(self,osm_ids:typing.Collection[int])->typing.Iterator[typing.Tuple[str,str,str]] :
+        """ Yield (osm_id,lat,lon) strings, like get_lonlat would have produced them.
+        Ids without a valid location are skipped. Ids are sorted first so that the
+        file pages are accessed sequentially.
+        """
+        coords=self.coords
+        max_id=self.max_id
+        for osm_id in sorted(map(int,osm_ids)) :
+            if osm_id<=0 or osm_id>max_id :
+                continue
+            x=coords[2*osm_id]
+            y=coords[2*osm_id+1]
+            # also excludes the undefined location
+            if not (-180*COORDINATE_PRECISION<=x<=180*COORDINATE_PRECISION
+                    and -90*COORDINATE_PRECISION<=y<=90*COORDINATE_PRECISION) :
+                continue
+            yield (str(osm_id),coordinate_str(y),coordinate_str(x))
+
+    def close(self) :
+        self.coords.release()
+        self.mm.close()
+        os.close(self.fd)
@@ -4,6 +4,8 @@ import typing
 import os
 import sys
 import time
+import threading
+import contextlib
 
 def n(i:int)->str :
     """ Format big numbers for easier readability
@@ -24,6 +26,9 @@ class Logger() :
         self._ready=False
         self.previous_prependline=False
         self.previous_clearline=None
+        self.muted_threads=set()
+        # called with the name of each phase as it starts
+        self.phase_listeners=[]
         #os.get_terminal_size() will error out when .isatty() is false.
         # instead of calling isatty() on each line, save it one at program start
         # (because it does not change)
@@ -33,6 +38,22 @@ class Logger() :
         except OSError :
             self.isatty=False
 
+    def mute(self)->typing.ContextManager :
+        ''' Silence all logging from the current thread for the duration of the with block.
+        For worker threads whose progress is instead reported by the main thread.
+        '''
+        @contextlib.contextmanager
+        def muted() :
+            self.muted_threads.add(threading.get_ident())
+            try :
+                yield
+            finally :
+                self.muted_threads.discard(threading.get_ident())
+        return muted()
+
+    def is_muted(self)->bool :
+        return len(self.muted_threads)>0 and threading.get_ident() in self.muted_threads
+
     def check_ready(self) :
         assert self._ready, 'Need to run .set_phases first'
     def set_phases(self,phases:typing.Collection[str]) :
@@ -40,6 +61,11 @@ class Logger() :
         self.str_maxlen_phase=max(list(map(len,phases)))
         self.current_phase=0 #index into phases list
         self._ready=True
+        self.phase_started()
+
+    def phase_started(self) :
+        for listener in self.phase_listeners :
+            listener(self.phases[self.current_phase])
 
     def next_phase(self) :
         self.check_ready()
@@ -47,6 +73,7 @@ class Logger() :
         if self.current_phase>=len(self.phases) :
             self.current_phase=0
             l.log(f'WARNING: Called .next_phase() too many times with {self.phases}. resetting')
+        self.phase_started()
 
     def save_clearedline(self) :
         ''' Simply write a newline at the end of the previous clearline: save it.
@@ -65,6 +92,8 @@ class Logger() :
             Use just before a .log(clearline=True) to add information before
         '''
         #self.check_ready() dont't for performance reasons
+        if self.is_muted() :
+            return
         assert int(clearline)+int(prependline)<2, 'not both clearline and prependline can be True'
         str_msg=' '.join(map(str,msg))
         l=self.str_maxlen_phase+5
@@ -166,6 +195,8 @@ class RateLogger(Logger) :
         """ Show a rate progress bar on count from tot items in format:
             '{count} ({count_rate}/s) / {tot} {msg}    {percent:count/tot}%'
         """
+        if self.is_muted() :
+            return
         self.is_simplerate=True
         if count>1e6 :
             #set higher for a smoother rate display
@@ -211,6 +242,8 @@ class RateLogger(Logger) :
         reshuffle the arguments so that calling them has the args arranged in an order similar to
         how they will be printed out. Not .simplerate() though, it is separate.
         """
+        if self.is_muted() :
+            return
         self.is_simplerate=False
         if ns[0]>1e6 :
             self.sample_length=100_000
@@ -234,6 +267,8 @@ class RateLogger(Logger) :
         has finished (for loop has ended) : reset counters and data storage.
         When lastline=False, do NOT calculate+print the final "summary 100%" line
         """
+        if self.is_muted() :
+            return
         if lastline and self.prev_args is not None:
             #last line print
             if self.is_simplerate :
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+import array
+import bisect
+import hashlib
+import json
+import typing
+import zlib
+
+from . import checkpoint
+from . import writers
+
+"""
+Manifest of an extract: for each element type, the sorted ids of all exported
+elements and a 64-bit hash of each element's content (its xml serialization).
+A later run with --since <manifest> compares against it and only writes an
+osmChange of what was created, modified or deleted since.
+The database has no element versions: a plain extract has none (version 0 for
+osmium), and each --since osmChange gives all its elements, deletes included,
+the version of its manifest plus one. Applying it with osmium then replaces the
+elements of the previous extract, the newer version wins.
+File format:
+    b'pgsql2osm-manifest 1\n'
+    one line of json: generator, at_time, version (absent in older manifests:
+    0), and for each type the byte sizes of its ids and hashes blobs
+    for each of node, way, relation: the ids (see checkpoint.encode_ids) then
+    the hashes (int64 array, zlib-compressed), in the same order
+"""
+
+MAGIC=b'pgsql2osm-manifest 1\n'
+TYPES=('node','way','relation')
+
+def element_hash(el_str:str)->int :
+    return int.from_bytes(hashlib.blake2b(el_str.encode(),digest_size=8).digest(),'little',signed=True)
+
+class ManifestWriter :
+    """ Collect the (id,hash) of every element written, then .save() them.
+    version: of the elements written, see Manifest.change_version
+    """
+    def __init__(self,version=0) :
+        self.version=version
+        self.ids={t:array.array('q') for t in TYPES}
+        self.hashes={t:array.array('q') for t in TYPES}
+
+    def add(self,el:writers.OsmElement,el_hash:int) :
+        if el.name in self.ids :
+            self.ids[el.name].append(int(el.attrs['id']))
+            self.hashes[el.name].append(el_hash)
+
+    def save(self,filename:str,root_attrs:dict) :
+        blobs=[]
+        header={'generator':root_attrs.get('generator'),'at_time':root_attrs.get('at_time'),
+            'version':self.version,'sizes':{}}
+        for t in TYPES :
+            ids=self.ids[t]
+            hashes=self.hashes[t]
+            if any(ids[i]>ids[i+1] for i in range(len(ids)-1)) :
+                # without --sorted: sort both by id
+                order=sorted(range(len(ids)),key=ids.__getitem__)
+                ids=array.array('q',(ids[i] for i in order))
+                hashes=array.array('q',(hashes[i] for i in order))
+            ids_blob=checkpoint.encode_ids(ids)
+            hashes_blob=zlib.compress(hashes.tobytes(),1)
+            header['sizes'][t]=[len(ids_blob),len(hashes_blob)]
+            blobs.extend((ids_blob,hashes_blob))
+        with open(filename,'wb') as f :
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode()+b'\n')
+            for blob in blobs :
+                f.write(blob)
+
+class Manifest :
+    """ A manifest read from a file, to compare a new extract against: see .action().
+    The elements of the osmChange get version .change_version
+    """
+    def __init__(self,filename:str) :
+        with open(filename,'rb') as f :
+            if f.readline()!=MAGIC :
+                raise BaseException(f'Not a pgsql2osm manifest: {filename}')
+            self.header=json.loads(f.readline())
+            self.ids={}
+            self.hashes={}
+            for t in TYPES :
+                ids_size,hashes_size=self.header['sizes'][t]
+                self.ids[t]=checkpoint.decode_ids(f.read(ids_size))
+                self.hashes[t]=array.array('q')
+                self.hashes[t].frombytes(zlib.decompress(f.read(hashes_size)))
+        self.change_version=self.header.get('version',0)+1
+        # which of the old elements are still there
+        self.seen={t:bytearray(len(self.ids[t])) for t in TYPES}
+
+    def action(self,el:writers.OsmElement,el_hash:int)->typing.Optional[str] :
+        """ 'create', 'modify', or None when el is unchanged since the manifest
+        """
+        ids=self.ids[el.name]
+        osm_id=int(el.attrs['id'])
+        ix=bisect.bisect_left(ids,osm_id)
+        if ix<len(ids) and ids[ix]==osm_id :
+            self.seen[el.name][ix]=1
+            return None if self.hashes[el.name][ix]==el_hash else 'modify'
+        return 'create'
+
+    def g_deleted(self)->typing.Iterator[writers.OsmElement] :
+        """ Elements of the manifest that were not seen by .action(), relations first
+        """
+        for t in reversed(TYPES) :
+            ids=self.ids[t]
+            seen=self.seen[t]
+            ix=seen.find(0)
+            while ix>=0 :
+                yield writers.OsmElement(t,{'id':ids[ix],'version':self.change_version})
+                ix=seen.find(0,ix+1)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+import itertools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+
+from . import metrics
+
+"""
+Memory profile of a run, for --profile-memory: metrics.sampler samples the RSS of
+the process (one thread, shared with --metrics), and at the end of each phase (see
+log.Logger.phase_listeners) records the peak RSS during the phase, the ids and bytes
+held by each key of the accumulator and, with --tracemalloc N, the top N allocation
+sites of python objects still alive. The summary goes to stderr, or to a json file.
+"""
+
+def mb(size:typing.Optional[int])->str :
+    return '-' if size is None else f'{size/(1<<20):.0f}MB'
+
+class MemoryProfiler :
+    """ Register .phase() as a phase listener of log.l, .watch() the accumulator
+    and call .finish() at the end.
+    """
+    def __init__(self,tracemalloc_top=0,sampler:metrics.RssSampler=metrics.sampler) :
+        self.tracemalloc_top=tracemalloc_top
+        self.sampler=sampler
+        self.accumulator=None
+        self.phases=[]
+        self.lock=threading.Lock()
+        self.phase_name='start' #before log.l.set_phases()
+        self.phase_start=time.time()
+        self.peak=0
+        self.last=None
+        if self.tracemalloc_top>0 :
+            # one frame: every more frame makes adding ids to the accumulator slower still
+            tracemalloc.start()
+        self.sampler.add_listener(self.rss)
+
+    def watch(self,a) :
+        ''' Report the sizes of the keys of accumulator a from now on
+        '''
+        self.accumulator=a
+
+    def rss(self,rss:int) :
+        ''' metrics.RssSampler listener
+        '''
+        with self.lock :
+            self.last=rss
+            self.peak=max(self.peak,rss)
+
+    def phase(self,name:str) :
+        self.end_phase()
+        self.phase_name=name
+        self.phase_start=time.time()
+
+    def end_phase(self) :
+        self.sampler.sample()
+        with self.lock :
+            record={
+                'name':self.phase_name,
+                'wall_s':time.time()-self.phase_start,
+                'peak_rss_bytes':self.peak,
+                'end_rss_bytes':self.last,
+                'accumulator':{},
+            }
+            self.peak=self.last
+        a=self.accumulator
+        if a is not None :
+            record['accumulator']={k:{'ids':a.len(k),'bytes':a.nbytes(k)} for k in a.named_data}
+        if tracemalloc.is_tracing() :
+            record['traced_peak_bytes']=tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            # Snapshot.filter_traces() is slow with millions of traces: filter the statistics
+            stats=(stat for stat in tracemalloc.take_snapshot().statistics('lineno')
+                if stat.traceback[0].filename!=tracemalloc.__file__)
+            record['top_allocations']=[{
+                    'site':f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                    'bytes':stat.size,
+                    'count':stat.count,
+                } for stat in itertools.islice(stats,self.tracemalloc_top)]
+        self.phases.append(record)
+
+    def finish(self) :
+        self.end_phase()
+        self.sampler.remove_listener(self.rss)
+        if tracemalloc.is_tracing() :
+            tracemalloc.stop()
+
+    def report(self)->str :
+        lines=['memory profile:']
+        for record in self.phases :
+            lines.append(f"  {record['name']}: peak RSS {mb(record['peak_rss_bytes'])}, at the end {mb(record['end_rss_bytes'])}, {record['wall_s']:.1f}s")
+            for k,size in record['accumulator'].items() :
+                if size['ids']>0 :
+                    lines.append(f"    {k}: {size['ids']} ids, {mb(size['bytes'])}")
+            if 'traced_peak_bytes' in record :
+                lines.append(f"    python objects: peak {mb(record['traced_peak_bytes'])}, top allocations:")
+                for allocation in record['top_allocations'] :
+                    lines.append(f"      {mb(allocation['bytes'])} in {allocation['count']} blocks at {allocation['site']}")
+        return '\n'.join(lines)
+
+    def save(self,target:str) :
+        ''' Print the report to stderr if target is '-', else write json to the file target
+        '''
+        if target=='-' :
+            print(self.report(),file=sys.stderr)
+            return
+        with open(target,'w') as f :
+            json.dump({'phases':self.phases},f,indent=1)
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+
+import bisect
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import typing
+
+import psycopg2.extensions
+
+from . import dbutils
+
+"""
+Machine-readable metrics of a run, for --metrics FILE. For each phase (as
+announced by log.Logger.set_phases() and .next_phase()): wall and cpu time,
+queries issued, rows fetched, bytes written, chunk sizes reached, peak RSS (sampled), and
+a latency histogram per query template. Saved as json, or as a Prometheus
+textfile (for the node_exporter textfile collector) when FILE ends in .prom
+"""
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS=(0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,float('inf'))
+
+re_string=re.compile(r"'(?:[^']|'')*'")
+re_number=re.compile(r'\b\d+(?:\.\d+)?\b')
+re_list=re.compile(r'\?(?:\s*,\s*\?)+')
+re_space=re.compile(r'\s+')
+re_execute=re.compile(r'\s*EXECUTE\s+(pgsql2osm_prepared_\d+)\b')
+
+def query_template(query:str)->str :
+    ''' query with its literal values replaced by ?, and lists of them by ?,...
+    so that all the chunks of one query count as one template
+    '''
+    query=re_string.sub('?',query)
+    query=re_number.sub('?',query)
+    query=re_list.sub('?,...',query)
+    return re_space.sub(' ',query).strip()
+
+PAGE_SIZE=os.sysconf('SC_PAGE_SIZE') if hasattr(os,'sysconf') else 4096
+
+def peak_rss()->int :
+    ''' Peak resident memory of this process so far, in bytes
+    '''
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform=='darwin' else maxrss*1024
+
+def current_rss()->typing.Optional[int] :
+    ''' Resident memory of this process in bytes, None where there is no /proc
+    '''
+    try :
+        with open('/proc/self/statm') as f :
+            return int(f.read().split()[1])*PAGE_SIZE
+    except OSError :
+        return None
+
+class RssSampler :
+    """ One background thread sampling the RSS every interval_s for all its listeners
+    (Metrics and memprofile.MemoryProfiler), each called with every sample. The thread
+    only runs while there are listeners.
+    """
+    def __init__(self,interval_s=0.1) :
+        self.interval_s=interval_s
+        self.lock=threading.Lock()
+        self.listeners=[]
+        self.stop=None
+        self.thread=None
+
+    def add_listener(self,f:typing.Callable[[int],None]) :
+        with self.lock :
+            self.listeners.append(f)
+            if self.thread is None :
+                self.stop=threading.Event()
+                self.thread=threading.Thread(target=self.run,args=(self.stop,),daemon=True)
+                self.thread.start()
+
+    def remove_listener(self,f:typing.Callable[[int],None]) :
+        with self.lock :
+            self.listeners.remove(f)
+            if len(self.listeners)>0 or self.thread is None :
+                return
+            stop,thread=self.stop,self.thread
+            self.stop=self.thread=None
+        stop.set()
+        thread.join()
+
+    def run(self,stop:threading.Event) :
+        while not stop.wait(self.interval_s) :
+            self.sample()
+
+    def sample(self)->int :
+        ''' Sample now, eg at the end of a phase, and pass it to all listeners
+        '''
+        rss=current_rss()
+        if rss is None :
+            # only the peak of the whole process is available there
+            rss=peak_rss()
+        with self.lock :
+            listeners=list(self.listeners)
+        for f in listeners :
+            f(rss)
+        return rss
+
+# shared by --metrics and --profile-memory
+sampler=RssSampler()
+
+class PhaseMetrics :
+    def __init__(self,name:str) :
+        self.name=name
+        self.start_wall=time.time()
+        self.start_cpu=time.process_time()
+        self.wall_s=None #set when the phase ends
+        self.cpu_s=None
+        self.peak_rss=None #from the RssSampler
+        self.queries=0
+        self.rows=0
+        self.bytes_written=0
+        self.chunk_sizes={}
+        # query template -> [count in each of LATENCY_BUCKETS..., sum of seconds]
+        self.latency={}
+
+    def end(self) :
+        if self.wall_s is None :
+            self.wall_s=time.time()-self.start_wall
+            self.cpu_s=time.process_time()-self.start_cpu
+
+    def to_dict(self)->dict :
+        return {
+            'name':self.name,
+            'wall_s':self.wall_s,
+            'cpu_s':self.cpu_s,
+            'peak_rss_bytes':self.peak_rss,
+            'queries':self.queries,
+            'rows':self.rows,
+            'bytes_written':self.bytes_written,
+            'chunk_sizes':self.chunk_sizes,
+            'query_latency':{template:{
+                    'count':sum(counts[:-1]),
+                    'sum_s':counts[-1],
+                    'buckets':{str(le):count for le,count in zip(LATENCY_BUCKETS,counts)},
+                } for template,counts in self.latency.items()},
+        }
+
+class CountingFile :
+    """ Binary file-like object passing everything on to f, counting the bytes written
+    """
+    def __init__(self,f:typing.BinaryIO,metrics) :
+        self.f=f
+        self.metrics=metrics
+
+    def write(self,data:bytes)->int :
+        self.metrics.written(len(data))
+        return self.f.write(data)
+
+    def __getattr__(self,name:str) :
+        return getattr(self.f,name)
+
+class Metrics :
+    """ Collects the metrics of every phase. Register .phase() as a phase listener
+    of log.l, and use .cursor_class as the cursor_factory of all connections.
+    Thread-safe: worker threads of --jobs count into the current phase.
+    The RSS samples of sampler (an RssSampler) give the peak of each phase, until .save()
+    """
+    def __init__(self,sampler:RssSampler=sampler) :
+        self.lock=threading.Lock()
+        self.started=time.time()
+        self.phases=[PhaseMetrics('start')] #before log.l.set_phases()
+        self.cursor_class=self.cursor_factory()
+        self.last_rss=None
+        self.sampler=sampler
+        self.sampler.add_listener(self.rss)
+        self.sampler.sample()
+        # prepared statement name -> query_template() of what it executes
+        self.prepared_templates={}
+
+    @property
+    def current(self)->PhaseMetrics :
+        return self.phases[-1]
+
+    def rss(self,rss:int) :
+        ''' RssSampler listener
+        '''
+        with self.lock :
+            current=self.current
+            current.peak_rss=max(current.peak_rss or 0,rss)
+            self.last_rss=rss
+
+    def phase(self,name:str) :
+        self.sampler.sample()
+        with self.lock :
+            self.current.end()
+            self.phases.append(PhaseMetrics(name))
+            self.current.peak_rss=self.last_rss
+
+    def query(self,query:typing.Any,elapsed:float,rows:int) :
+        if not isinstance(query,str) :
+            # bytes, or a psycopg2.sql.Composable
+            query=query.decode() if isinstance(query,bytes) else str(query)
+        template=self.template(query)
+        with self.lock :
+            current=self.current
+            current.queries+=1
+            current.rows+=max(0,rows)
+            counts=current.latency.get(template)
+            if counts is None :
+                counts=current.latency[template]=[0]*len(LATENCY_BUCKETS)+[0.0]
+            counts[bisect.bisect_left(LATENCY_BUCKETS,elapsed)]+=1
+            counts[-1]+=elapsed
+
+    def template(self,query:str)->str :
+        ''' query_template() of query. EXECUTEs of dbutils.prepared statements count
+        under the template they were PREPAREd with, not under the statement name
+        '''
+        m=re_execute.match(query)
+        if m is None :
+            return query_template(query)
+        name=m.group(1)
+        template=self.prepared_templates.get(name)
+        if template is None :
+            prepared=dbutils.prepared.template(name)
+            if prepared is None :
+                return query_template(query)
+            template=self.prepared_templates[name]=query_template(prepared)
+        return template
+
+    def fetched(self,rows:int) :
+        with self.lock :
+            self.current.rows+=rows
+
+    def written(self,size:int) :
+        with self.lock :
+            self.current.bytes_written+=size
+
+    def chunk_size(self,key:str,size:int) :
+        with self.lock :
+            self.current.chunk_sizes[key]=size
+
+    def count_output(self,f:typing.BinaryIO)->CountingFile :
+        return CountingFile(f,self)
+
+    def cursor_factory(self)->type :
+        metrics=self
+        class MetricsCursor(psycopg2.extensions.cursor) :
+            ''' Time each query, and count the rows it returned: all at once on
+            client-side cursors, as they are fetched on named cursors
+            '''
+            def execute(self,query,params=None) :
+                start=time.perf_counter()
+                try :
+                    return super().execute(query,params)
+                finally :
+                    metrics.query(query,time.perf_counter()-start,self.rowcount if self.name is None else 0)
+
+            def copy_expert(self,sql,file,size=8192) :
+                start=time.perf_counter()
+                try :
+                    return super().copy_expert(sql,file,size)
+                finally :
+                    metrics.query(sql,time.perf_counter()-start,self.rowcount)
+
+            def fetchmany(self,size=None) :
+                rows=super().fetchmany(size) if size is not None else super().fetchmany()
+                if self.name is not None :
+                    metrics.fetched(len(rows))
+                return rows
+        return MetricsCursor
+
+    def to_dict(self,completed:bool)->dict :
+        return {
+            'started':time.strftime('%FT%T',time.localtime(self.started)),
+            'completed':completed,
+            'wall_s':time.time()-self.started,
+            'phases':[p.to_dict() for p in self.phases],
+        }
+
+    def to_prometheus(self,completed:bool)->str :
+        lines=[]
+        # unique phase labels, in case a phase name came back
+        labels=[]
+        for p in self.phases :
+            label=p.name
+            n=1
+            while label in labels :
+                n+=1
+                label=f'{p.name} #{n}'
+            labels.append(label)
+        def metric(name:str,kind:str,help_text:str,samples:typing.Iterable[tuple]) :
+            lines.append(f'# HELP pgsql2osm_{name} {help_text}')
+            lines.append(f'# TYPE pgsql2osm_{name} {kind}')
+            for suffix,sample_labels,value in samples :
+                labels_str=','.join(f'{k}="{escape_label(v)}"' for k,v in sample_labels)
+                labels_str='{'+labels_str+'}' if labels_str!='' else ''
+                lines.append(f'pgsql2osm_{name}{suffix}{labels_str} {value}')
+        phases=list(zip(labels,self.phases))
+        metric('run_completed','gauge','1 if the run completed',[('',(),int(completed))])
+        metric('run_start_time_seconds','gauge','Start of the run, unix time',[('',(),self.started)])
+        metric('phase_wall_seconds','gauge','Wall time of the phase',
+            [('',(('phase',l),),p.wall_s) for l,p in phases])
+        metric('phase_cpu_seconds','gauge','Cpu time of the process during the phase',
+            [('',(('phase',l),),p.cpu_s) for l,p in phases])
+        metric('phase_peak_rss_bytes','gauge','Peak resident memory of the process during the phase',
+            [('',(('phase',l),),p.peak_rss) for l,p in phases])
+        metric('phase_queries','gauge','Queries issued during the phase',
+            [('',(('phase',l),),p.queries) for l,p in phases])
+        metric('phase_rows','gauge','Rows fetched during the phase',
+            [('',(('phase',l),),p.rows) for l,p in phases])
+        metric('phase_bytes_written','gauge','Bytes of osm data written during the phase, before compression',
+            [('',(('phase',l),),p.bytes_written) for l,p in phases])
+        metric('chunk_size','gauge','Chunk size reached by the parent queries',
+            [('',(('phase',l),('query',k)),v) for l,p in phases for k,v in p.chunk_sizes.items()])
+        samples=[]
+        for l,p in phases :
+            for template,counts in p.latency.items() :
+                cumulative=0
+                for le,count in zip(LATENCY_BUCKETS,counts) :
+                    cumulative+=count
+                    samples.append(('_bucket',(('phase',l),('query',template),('le','+Inf' if le==float('inf') else str(le))),cumulative))
+                samples.append(('_sum',(('phase',l),('query',template)),counts[-1]))
+                samples.append(('_count',(('phase',l),('query',template)),cumulative))
+        metric('query_duration_seconds','histogram','Latency of each query template',samples)
+        return '\n'.join(lines)+'\n'
+
+    def save(self,filename:str,completed:bool) :
+        ''' End the current phase and write filename, as a Prometheus textfile if
+        it ends in .prom, as json otherwise. Replaced atomically: a collector never
+        reads it half-written.
+        '''
+        self.sampler.sample()
+        self.sampler.remove_listener(self.rss)
+        with self.lock :
+            self.current.end()
+        if filename.endswith('.prom') :
+            data=self.to_prometheus(completed)
+        else :
+            data=json.dumps(self.to_dict(completed),indent=1)
+        tmp=filename+'.tmp'
+        with open(tmp,'w') as f :
+            f.write(data)
+        os.replace(tmp,filename)
+
+def escape_label(value:str)->str :
+    return value.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
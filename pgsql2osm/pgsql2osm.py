@@ -1,14 +1,32 @@
 #!/usr/bin/python3
 
-import lxml.etree as ET
 import time
+import array
+import bisect
+import itertools
 import psycopg2
 import typing
 import asyncio
+import concurrent.futures
+import multiprocessing
+import contextlib
+import copy
+import heapq
+import os
+import tempfile
+import queue
+import sys
+import threading
 
 from . import settings
 from . import dbutils
 from . import log
+from . import writers
+from . import compress
+from . import extsort
+from . import checkpoint
+from . import manifest
+from . import probe
 from . import __version__
 
 """
@@ -24,8 +42,12 @@ FUTURE IMPROVEMENTS
 class Accumulator() :
 
     def g_adaptive_parent_multiquery(self,name:str,c:psycopg2.extensions.cursor,
-            queries:typing.Collection[str],
-            nodelist_lambda_tuples:typing.Collection[typing.Collection[typing.Callable]]
+            queries:typing.Collection[typing.Tuple[str,typing.Tuple[str,...]]],
+            nodelist_lambda_tuples:typing.Collection[typing.Collection[typing.Callable]],
+            ids:typing.Optional[typing.Sequence[int]]=None,
+            on_rollback:typing.Optional[typing.Callable]=None,
+            controller:typing.Optional[dbutils.ChunkController]=None,
+            prepare=True,
         )->typing.Iterator :
         ''' For all the ids referred to by name :
         The database has some indexes on the bigint[] columns that contain
@@ -39,87 +61,60 @@ class Accumulator() :
         parent belongs to which child, we can run the queries "in parallel" :
             ... WHERE ARRAY[child_id1,child_id2,..]::bigint[] && nodes
             ... WHERE ARRAY['n'||child_id1,'n'||child_id2,...] && members
+        queries are (template,types) with $1,$2,... parameters of those types, the
+        lambdas of nodelist_lambda_tuples make their values from each chunk of ids, eg
+            ('SELECT id FROM ways WHERE $1 && nodes',('bigint[]',)) with (list,)
+        each template is PREPAREd once per connection, see dbutils.PreparedStatements
+        (unless prepare==False).
         This is a marked throughput improvement, but the performance also drops
         dramaticaaly once we surpass the indexed array size. on my machine it seems
-        to be 11. But this function will readjust this chunk_size dynamically,
-        to allow for the highest available database performance.
+        to be 11. controller (a dbutils.ChunkController) readjusts this chunk_size
+        dynamically from the measured query times, and keeps the last one in
+        controller.size.
         Return format: generate tuples of a first int and then (lists of tuples) as
         (scanned_nodes_count,queries[0].results,queries[1].results,...)
         where queries[0].results=[row1_tup,row2_tup,row3_tup],
         len(q[0].res) is not necessarily equal to len(q[1].res), and
         scanned_nodes_count it the amount of nodes processed by this tuple.
+        ids: only process those instead of all the ids referred to by name.
+        on_rollback(c) is called after each QueryCanceled rollback, before anything
+        else is executed in the new transaction (eg to SET TRANSACTION SNAPSHOT again).
         '''
-        nix=self.named_data.index(name)
-        len_ids=self.len(name)
+        ids_as_list=self.sequence(name) if ids is None else ids
+        len_ids=len(ids_as_list)
+        if controller is None :
+            controller=dbutils.ChunkController()
 
         total_processed_nodes=0
-        start_chunk_size=50 #const
-        chunk_size=start_chunk_size
-        avg_accepted_chunk_size=0
-        chunks_unchanged_chunk_size=0
-        stable=False
-        chunks=0
-        # to trigger a QueryCanceled when the index could not be used and the query
-        # took too long
-        c.execute("SET statement_timeout='1s';")
+        # only a safety net for when the index could not be used and a query takes
+        # far too long: the controller keeps queries well below it
+        timeout_ms=max(1000,int(10_000*controller.target_s))
+        c.execute(f"SET statement_timeout={timeout_ms};")
         printed_slow_warning=False
-        ids_as_list=list(self.data[name])
         while total_processed_nodes<len_ids :
-            start_time=time.time()
-            #nodes_chunk=self.get_iter_slice(nix,total_processed_nodes,total_processed_nodes+chunk_size)
-            nodes_chunk=ids_as_list[total_processed_nodes:total_processed_nodes+chunk_size]
-            # maybe rewrite logic to NOT NEED len(nodes_chunk), then we could
-            # have it be a generator
-            # but we need to store the str=','.join(ids) anyways...
-            nodes_chunk=list(nodes_chunk) #less efficient that way
+            chunk_size=controller.size
+            nodes_chunk=list(ids_as_list[total_processed_nodes:total_processed_nodes+chunk_size])
             try :
                 results=[None for q in queries]
-                for ix,q in enumerate(queries) :
+                slowest=0
+                for ix,(template,types) in enumerate(queries) :
                     #apply callbacks
-                    data_s=list(map(lambda f:f(nodes_chunk),nodelist_lambda_tuples[ix]))
-                    q_uery=q.format(*data_s)
-                    #l.log(q_uery)
-                    c.execute(q_uery)
+                    params=[f(nodes_chunk) for f in nodelist_lambda_tuples[ix]]
+                    start_time=time.time()
+                    dbutils.prepared.execute(c,template,types,params,prepare)
                     results[ix]=list(dbutils.g_from_cursor(c))
+                    slowest=max(slowest,time.time()-start_time)
                 total_processed_nodes+=len(nodes_chunk)
-                #tentatively highten the chunk size, just to spice things up
-                # (and maybe the db engine has warmed up in the meantime)
-                if chunks_unchanged_chunk_size>(2500 if stable else 50):
-                    #in the case we may hit the ceiling of index-performs-poorly
-                    if chunk_size-0.49<=avg_accepted_chunk_size<=chunk_size+0.49 :
-                        chunk_size+=0 #pass, but still set chunks_unchanged_chunk_size 0
-                    else :
-                        chunk_size+=1
-                    #in the case we hit the avg_accepted_chunk_size ceiling, limitied by the initial
-                    # start_chunk_size :
-                    # check if avg was "dragged down" by a too-low initial chunk_size
-                    #if start_chunk_size-2<=avg_accepted_chunk_size :
-                    #    chunk_size=int((chunk_size*1.1)+1)
-                    chunks_unchanged_chunk_size=0
-                else :
-                    chunks_unchanged_chunk_size+=1
-                #total chunk averag is sum(all_accepted_chunks)/count(all_accepted_chunks)
-                if chunks!=0 :
-                    avg_accepted_chunk_size=total_processed_nodes/chunks
+                controller.update(slowest)
                 yield (len(nodes_chunk),*results)
-                chunks+=1
             except psycopg2.errors.QueryCanceled :
                 # DO NOT increment total_processed_nodes, because we need to redo the work
-                #TODO: chunk_size, can it also grow ?
-                prev_chunk_size=chunk_size
-                chunks_unchanged_chunk_size=0
-                if chunk_size-2<=avg_accepted_chunk_size<=chunk_size-1 :
-                    chunk_size-=1
-                    stable=True
-                else :
-                    chunk_size=int(chunk_size/1.2)
-                    if prev_chunk_size==chunk_size :
-                        chunk_size-=1
-                    if chunk_size==0 :
-                        chunk_size=1 #nothing to be done...
-                c.execute('ABORT;') #start new
-                if chunk_size==0 :
-                    chunk_size=1 #well we just need to work with the slow database...
+                # start new, rollback() also keeps psycopg2's transaction status in sync
+                c.connection.rollback()
+                if on_rollback is not None :
+                    on_rollback(c)
+                if chunk_size<=controller.min_size :
+                    #well we just need to work with the slow database...
                     if not printed_slow_warning :
                         log.l.log('WARNING: queries are running very slowly, the index may not exist.')
                         log.l.log(f'\tplease kill this process: "kill {log.l.pid}" and create indexes:')
@@ -130,8 +125,9 @@ class Accumulator() :
                     #see below, db forgets it. but don't rely on its forgetfulness
                     c.execute("SET statement_timeout=0;")
                 else :
+                    controller.canceled()
                     #it forgets that at each new transaction
-                    c.execute("SET statement_timeout='1s';")
+                    c.execute(f"SET statement_timeout={timeout_ms};")
         #set it back, maybe run an ABORT; instead ?
         c.execute("SET statement_timeout='2h';")
 
@@ -161,7 +157,258 @@ class DictAccumulator(Accumulator) :
             if i not in self.data[k_remove] :
                 missing.add(i)
         return iter(missing)
+    def add_many(self,k,ids) :
+        for i in ids :
+            self.add(k,i)
+    def copy(self,k_from,k_to) :
+        self.data[k_to]=set(self.data[k_from])
+    def sequence(self,k) :
+        return list(self.data[k])
+    def load_sorted(self,k,ids) :
+        self.data[k]=set(ids)
+    def add_sorted(self,k,ids) :
+        self.data[k].update(ids)
+    def nbytes(self,k) :
+        # the set, and a python int of 32 bytes per id
+        return sys.getsizeof(self.data[k])+32*len(self.data[k])
+    def subset(self,keys) :
+        sub=DictAccumulator(keys)
+        for k in keys :
+            if k in self.data :
+                sub.data[k]=set(self.data[k])
+        return sub
+
+
+class SortedIds :
+    ''' Sorted unique ids as int64, 8 bytes per id: a list of array.array blocks of
+    block_size to 2*block_size ids, and the largest id of each block in maxes to bisect.
+    An add copies one block (a few KB) instead of the whole array, and there are
+    no large merges.
+    Blocks are never modified in place, only replaced: .copy(), iterators and
+    slices share them, and keep seeing the ids as they were.
+    '''
+    def __init__(self,block_size=256) :
+        self.block_size=block_size
+        self.blocks=[]
+        self.maxes=[]
+        self.length=0
+        self.offsets=None # index of the first id of each block, for slicing
+
+    @classmethod
+    def from_sorted(cls,ids:typing.Iterable[int],block_size=256)->'SortedIds' :
+        ''' ids must be sorted and unique
+        '''
+        result=cls(block_size)
+        if isinstance(ids,array.array) :
+            blocks=(ids[i:i+block_size] for i in range(0,len(ids),block_size))
+        else :
+            ids=iter(ids)
+            blocks=iter(lambda:array.array('q',itertools.islice(ids,block_size)),array.array('q'))
+        for block in blocks :
+            result.blocks.append(block)
+            result.maxes.append(block[-1])
+            result.length+=len(block)
+        return result
+
+    def add(self,i:int)->bool :
+        ''' Return whether i was added, False if it was already there
+        '''
+        maxes=self.maxes
+        b=bisect.bisect_left(maxes,i)
+        if b==len(maxes) :
+            if b==0 :
+                self.blocks.append(array.array('q',(i,)))
+                maxes.append(i)
+                self.length+=1
+                self.offsets=None
+                return True
+            b-=1 #larger than all: append to the last block
+        block=self.blocks[b]
+        ix=bisect.bisect_left(block,i)
+        if ix<len(block) and block[ix]==i :
+            return False
+        block=block[:]
+        block.insert(ix,i)
+        if len(block)>2*self.block_size :
+            half=len(block)//2
+            self.blocks[b:b+1]=[block[:half],block[half:]]
+            maxes[b:b+1]=[block[half-1],block[-1]]
+        else :
+            self.blocks[b]=block
+            maxes[b]=block[-1]
+        self.length+=1
+        self.offsets=None
+        return True
+
+    def update(self,ids:typing.Iterable[int])->int :
+        ''' Add many ids at once, return how many were added. They are sorted and
+        deduplicated first, then merged block by block: each block that receives
+        ids is copied once, instead of once per id.
+        '''
+        new=sorted(set(ids))
+        if len(self.blocks)==0 :
+            filled=SortedIds.from_sorted(array.array('q',new),self.block_size)
+            self.blocks,self.maxes,self.length=filled.blocks,filled.maxes,filled.length
+            self.offsets=None
+            return len(new)
+        blocks,maxes=self.blocks,self.maxes
+        bisect_left=bisect.bisect_left
+        added=0
+        j=0
+        while j<len(new) :
+            i=new[j]
+            b=bisect_left(maxes,i)
+            if b>=len(maxes)-1 :
+                # all the rest, including the ids past the last block
+                b=len(maxes)-1
+                end=len(new)
+            elif j+1<len(new) and new[j+1]<=maxes[b] :
+                end=bisect.bisect_right(new,maxes[b],j+2)
+            else :
+                end=j+1
+            block=blocks[b]
+            if end==j+1 :
+                # a single id for this block: the same as add()
+                j=end
+                ix=bisect_left(block,i)
+                if ix<len(block) and block[ix]==i :
+                    continue
+                merged=block[:]
+                merged.insert(ix,i)
+                added+=1
+            elif end-j>64 :
+                # many ids, eg all those past the last block: merge in C
+                merged=array.array('q',sorted(set(block).union(new[j:end])))
+                added+=len(merged)-len(block)
+                j=end
+            else :
+                merged=block[:]
+                ix=0
+                for i in new[j:end] :
+                    ix=bisect_left(merged,i,ix)
+                    if ix==len(merged) or merged[ix]!=i :
+                        merged.insert(ix,i)
+                        added+=1
+                j=end
+            if len(merged)>2*self.block_size :
+                pieces=[merged[i:i+self.block_size] for i in range(0,len(merged),self.block_size)]
+                if len(pieces[-1])<self.block_size :
+                    pieces[-2:]=[pieces[-2]+pieces[-1]]
+                blocks[b:b+1]=pieces
+                maxes[b:b+1]=[piece[-1] for piece in pieces]
+            else :
+                blocks[b]=merged
+                maxes[b]=merged[-1]
+        self.length+=added
+        self.offsets=None
+        return added
+
+    def __contains__(self,i:int)->bool :
+        b=bisect.bisect_left(self.maxes,i)
+        if b==len(self.maxes) :
+            return False
+        block=self.blocks[b]
+        return block[bisect.bisect_left(block,i)]==i
+
+    def __len__(self)->int :
+        return self.length
+
+    def __iter__(self)->typing.Iterator[int] :
+        return itertools.chain.from_iterable(list(self.blocks))
+
+    def __getitem__(self,index:slice)->array.array :
+        ''' Only slices (with step 1), as a new array
+        '''
+        start,stop,step=index.indices(self.length)
+        assert step==1, 'Unsupported slice step'
+        if self.offsets is None :
+            self.offsets=list(itertools.accumulate((len(block) for block in self.blocks[:-1]),initial=0))
+        result=array.array('q')
+        b=bisect.bisect_right(self.offsets,start)-1
+        while start<stop :
+            piece=self.blocks[b][start-self.offsets[b]:start-self.offsets[b]+stop-start]
+            result.extend(piece)
+            start+=len(piece)
+            b+=1
+        return result
+
+    def copy(self)->'SortedIds' :
+        ''' Sharing the blocks: cheap, and both can then be changed independently
+        '''
+        result=SortedIds(self.block_size)
+        result.blocks=list(self.blocks)
+        result.maxes=list(self.maxes)
+        result.length=self.length
+        return result
 
+    def nbytes(self)->int :
+        return sum(sys.getsizeof(block) for block in self.blocks)+sys.getsizeof(self.blocks)+sys.getsizeof(self.maxes)+32*len(self.maxes)
+
+class ArrayAccumulator(Accumulator) :
+    ''' Same interface as DictAccumulator, but stores the ids of each key in a
+    SortedIds: 8 bytes per id instead of the ~70 bytes of a python int in a set.
+    Sequences and iterators are snapshots: iterating over .all(k) while adding to
+    k is allowed and iterates over the ids as they were before.
+    '''
+    def __init__(self,named_data,block_size=256) :
+        self.named_data=named_data
+        self.block_size=block_size
+        self.data={k:SortedIds(block_size) for k in self.named_data}
+
+    def add(self,k,i) :
+        assert i>0 and isinstance(i,int), f'Unsupported type or zero or negative value {i}'
+        self.data[k].add(i)
+    def add_many(self,k,ids) :
+        ''' Faster than add() one by one, the more ids at once the better: see SortedIds.update
+        '''
+        ids=set(ids)
+        # non-int ids raise a TypeError in the array
+        assert len(ids)==0 or min(ids)>0, f'Unsupported zero or negative value in {k}'
+        self.data[k].update(ids)
+    def all(self,k) :
+        return iter(self.data[k])
+    def is_in(self,k,i) :
+        return i in self.data[k]
+    def len(self,k) :
+        return len(self.data[k])
+    def clear(self,k) :
+        self.data[k]=SortedIds(self.block_size)
+    def get_iter_slice(self,k,start,end) :
+        return self.data[k][start:end]
+    def sequence(self,k) :
+        return self.data[k].copy()
+    def copy(self,k_from,k_to) :
+        self.data[k_to]=self.data[k_from].copy()
+    def load_sorted(self,k,ids) :
+        ''' Replace the contents of k with ids, which must be sorted and unique
+        '''
+        self.data[k]=SortedIds.from_sorted(ids,self.block_size)
+    def add_sorted(self,k,ids) :
+        ''' Add many ids at once, which must be sorted and unique: merge them
+        into the blocks instead of adding them one by one
+        '''
+        merged=(i for i,_ in itertools.groupby(heapq.merge(self.data[k],ids)))
+        self.data[k]=SortedIds.from_sorted(merged,self.block_size)
+    def nbytes(self,k) :
+        ''' Approximate memory used by k. Blocks shared by .copy() count for each key
+        '''
+        return self.data[k].nbytes()
+    def subset(self,keys) :
+        ''' New accumulator with only keys, sharing the blocks of the keys that also
+        exist here: both can then be used independently, eg from different threads.
+        '''
+        sub=ArrayAccumulator(keys,self.block_size)
+        for k in keys :
+            if k in self.data :
+                sub.data[k]=self.data[k].copy()
+        return sub
+    def all_subtract(self,k_from,k_remove) :
+        remove=self.data[k_remove]
+        if len(remove)==0 :
+            return iter(self.data[k_from])
+        missing=array.array('q')
+        missing.extend(i for i in self.data[k_from] if i not in remove)
+        return iter(missing)
 
 async def chain(*generators:typing.Iterator)->typing.Iterator:
     for g in generators :
@@ -177,20 +424,20 @@ async def chain(*generators:typing.Iterator)->typing.Iterator:
 
 def all_nwr_within(s:settings.Settings,a:Accumulator) :
     #SELECT workflow to get all element [ids ONLY] in bounding box or boundary:
+    # the results are streamed, these are the biggest queries
     # 1a) select all nodes WHERE way ST_Within(bbox);
     constr,tbl_name=s.make_bounds_constr('_point')
     log.l.log('executing big query on',tbl_name,'...',clearline=True)
-    s.c.execute(f'SELECT osm_id FROM {tbl_name} WHERE {constr};')
-    for row in dbutils.g_from_cursor(s.c,verbose=True,prefix_msg=tbl_name+' ') :
-        a.add('nodes',row['osm_id'])
+    for osm_id, in dbutils.g_stream(s.access,f'SELECT osm_id FROM {tbl_name} WHERE {constr};',
+            itersize=s.itersize,verbose=True,prefix_msg=tbl_name+' ') :
+        a.add('nodes',osm_id)
     log.l.log(log.n(a.len('nodes')),'nodes within bounds')
 
     # 1b) select all ways,rels FROM planet_osm_polygon WHERE way ST_Within(bbox);
     constr,tbl_name=s.make_bounds_constr('_polygon')
     log.l.log('executing big query on',tbl_name,'...',clearline=True)
-    s.c.execute(f'SELECT osm_id FROM {tbl_name} WHERE {constr};')
-    for row in dbutils.g_from_cursor(s.c,verbose=True,prefix_msg=tbl_name+' ') :
-        id=row['osm_id']
+    for id, in dbutils.g_stream(s.access,f'SELECT osm_id FROM {tbl_name} WHERE {constr};',
+            itersize=s.itersize,verbose=True,prefix_msg=tbl_name+' ') :
         if id>0 :
             a.add('ways',id)
         else :
@@ -202,15 +449,122 @@ def all_nwr_within(s:settings.Settings,a:Accumulator) :
     # of planet_osm_line
     constr,tbl_name=s.make_bounds_constr('_line')
     log.l.log('executing big query on',tbl_name,'...',clearline=True)
-    s.c.execute(f'SELECT osm_id FROM {tbl_name} WHERE {constr};')
-    for row in dbutils.g_from_cursor(s.c,verbose=True,prefix_msg=tbl_name+' ') :
-        id=row['osm_id']
+    for id, in dbutils.g_stream(s.access,f'SELECT osm_id FROM {tbl_name} WHERE {constr};',
+            itersize=s.itersize,verbose=True,prefix_msg=tbl_name+' ') :
         if id>0 :
             a.add('ways',id)
         else :
             a.add('rels',-id)
     log.l.log(log.n(a.len('ways')),'ways,',log.n(a.len('rels')),'rels within bounds')
 
+def g_parent_multiquery(s:settings.Settings,a:Accumulator,name:str,
+        queries:typing.Collection[typing.Tuple[str,typing.Tuple[str,...]]],
+        nodelist_lambda_tuples:typing.Collection[typing.Collection[typing.Callable]],
+        cache_key:str
+    )->typing.Iterator :
+    ''' Same results as a.g_adaptive_parent_multiquery(name,s.c,...), but with s.jobs>1
+    split the ids into s.jobs disjoint contiguous slices, each run on its own connection
+    and thread with its own adaptive chunk size. Tuples are yielded as they arrive, so
+    that only this thread adds to the accumulator.
+    All connections import a snapshot exported by one more connection, kept in its
+    transaction until the end: every worker sees the same database state.
+    The chunk sizes start from the one learned for cache_key by previous runs (in
+    s.chunk_cache), and the one reached is saved back.
+    With s.recording (--record or --replay), the chunk size stays fixed: a replay needs
+    the same chunks, the same statements as recorded.
+    '''
+    start_size=dbutils.load_chunk_sizes(s.chunk_cache).get(cache_key,50)
+    fixed=s.recording is not None
+    if fixed :
+        start_size=s.recording.chunk_size(cache_key,start_size)
+    controllers=[]
+    def new_controller()->dbutils.ChunkController :
+        if fixed :
+            controllers.append(dbutils.ChunkController(start_size,s.chunk_target_ms/1000,
+                min_size=start_size,max_size=start_size))
+        else :
+            controllers.append(dbutils.ChunkController(start_size,s.chunk_target_ms/1000))
+        return controllers[-1]
+    try :
+        yield from g_parent_multiquery_jobs(s,a,name,queries,nodelist_lambda_tuples,new_controller)
+    finally :
+        sizes=sorted(controller.size for controller in controllers)
+        if len(sizes)>0 :
+            # workers that had little to do did not get far: take the median
+            chunk_size=sizes[len(sizes)//2]
+            log.l.log(f'chunk size for {cache_key}: {start_size} -> {chunk_size}')
+            if s.metrics is not None :
+                s.metrics.chunk_size(cache_key,chunk_size)
+            if not fixed :
+                dbutils.save_chunk_sizes(s.chunk_cache,{cache_key:chunk_size})
+
+def g_parent_multiquery_jobs(s:settings.Settings,a:Accumulator,name:str,
+        queries:typing.Collection[typing.Tuple[str,typing.Tuple[str,...]]],
+        nodelist_lambda_tuples:typing.Collection[typing.Collection[typing.Callable]],
+        new_controller:typing.Callable[[],dbutils.ChunkController]
+    )->typing.Iterator :
+    if s.jobs<=1 :
+        yield from a.g_adaptive_parent_multiquery(name,s.c,queries,nodelist_lambda_tuples,
+            controller=new_controller(),prepare=s.prepare)
+        return
+    ids=a.sequence(name)
+    slice_size=-(-len(ids)//s.jobs) #ceil
+    slices=[ids[i:i+slice_size] for i in range(0,len(ids),slice_size)]
+
+    exporter=s.new_connection()
+    exporter.set_session(isolation_level='REPEATABLE READ',readonly=True)
+    snapshot=exporter.cursor()
+    snapshot.execute('SELECT pg_export_snapshot();')
+    snapshot_id=snapshot.fetchone()[0]
+
+    def import_snapshot(c:psycopg2.extensions.cursor) :
+        # needs to be the first statement of each transaction
+        c.execute('SET TRANSACTION SNAPSHOT %s;',(snapshot_id,))
+
+    results=queue.Queue(maxsize=4*s.jobs)
+    stop=threading.Event()
+    def worker(ids_slice:typing.Sequence[int]) :
+        controller=new_controller()
+        try :
+            conn=s.new_connection()
+            try :
+                conn.set_session(isolation_level='REPEATABLE READ',readonly=True)
+                c=conn.cursor()
+                import_snapshot(c)
+                for result in a.g_adaptive_parent_multiquery(name,c,queries,nodelist_lambda_tuples,
+                        ids=ids_slice,on_rollback=import_snapshot,controller=controller,prepare=s.prepare) :
+                    if stop.is_set() :
+                        break
+                    results.put(result)
+            finally :
+                conn.close()
+            results.put(None)
+        except BaseException as e :
+            results.put(e)
+
+    threads=[threading.Thread(target=worker,args=(ids_slice,),daemon=True) for ids_slice in slices]
+    for t in threads :
+        t.start()
+    try :
+        running=len(threads)
+        while running>0 :
+            result=results.get()
+            if result is None :
+                running-=1
+            elif isinstance(result,BaseException) :
+                raise result
+            else :
+                yield result
+    finally :
+        stop.set()
+        # unblock workers waiting on a full queue
+        while any(t.is_alive() for t in threads) :
+            try :
+                results.get(timeout=0.1)
+            except queue.Empty :
+                pass
+        exporter.close()
+
 def nodes_parent_wr(s:settings.Settings,a:Accumulator,only_nodes_within=False) :
     # 2a) foreach node_id :
     # 2b) select all ways WHERE ARRAY[node_id]::bigint[] <@ nodes;
@@ -221,13 +575,10 @@ def nodes_parent_wr(s:settings.Settings,a:Accumulator,only_nodes_within=False) :
     rel_count=0
     node_count=0
 
-    try :
-        s.c.execute('SELECT planet_osm_index_bucket(ARRAY[]::bigint[])')
-        use_bucket_func=True
-    except psycopg2.errors.UndefinedFunction :
-        use_bucket_func=False #does not exist
+    # see probe.probe()
+    use_bucket_func=s.strategy.ways_nodes=='bucket'
     if use_bucket_func :
-        add_buck='planet_osm_index_bucket(ARRAY[{0}]::bigint[]) && planet_osm_index_bucket(nodes) AND '
+        add_buck='planet_osm_index_bucket($1) && planet_osm_index_bucket(nodes) AND '
     else :
         add_buck=''
 
@@ -236,19 +587,22 @@ def nodes_parent_wr(s:settings.Settings,a:Accumulator,only_nodes_within=False) :
     if s.new_jsonb_schema :
         # the ::char(1) cast IS IMPORTANT for index performance, 10x or more slower without it
         rels_query="SELECT id FROM "+tbl_rels
-        rels_query+=" WHERE planet_osm_member_ids(members,'N'::char(1)) && ARRAY[{0}]::bigint[];"
-        rels_lambdas=(lambda i:','.join(map(str,i)),)
+        rels_query+=" WHERE planet_osm_member_ids(members,'N'::char(1)) && $1"
+        rels_query=(rels_query,('bigint[]',))
+        rels_lambdas=(list,)
     else :
         parts_indexed="SELECT id,members FROM "+tbl_rels
-        parts_indexed+=" WHERE ARRAY[{0}]::bigint[] && parts"
-        members_where="ARRAY[{1}] && members"
-        rels_query=f'SELECT id FROM ({parts_indexed}) AS parts_indexed WHERE {members_where};'
-        rels_lambdas=(lambda i:','.join(map(str,i)),lambda i:','.join(map(lambda j:f"'n{j}'",i)),)
+        parts_indexed+=" WHERE $1 && parts"
+        members_where="$2 && members"
+        rels_query=(f'SELECT id FROM ({parts_indexed}) AS parts_indexed WHERE {members_where}',
+            ('bigint[]','text[]'))
+        rels_lambdas=(list,lambda i:[f'n{j}' for j in i],)
     
-    for node_c,way_ids,rel_ids in a.g_adaptive_parent_multiquery(nodes_name,s.c,
-            ('SELECT id FROM '+tbl_ways+' WHERE '+add_buck+'ARRAY[{0}]::bigint[] && nodes;',
+    for node_c,way_ids,rel_ids in g_parent_multiquery(s,a,nodes_name,
+            (('SELECT id FROM '+tbl_ways+' WHERE '+add_buck+'$1 && nodes',('bigint[]',)),
                 rels_query),
-            [(lambda i:','.join(map(str,i)),),rels_lambdas]) :
+            [(list,),rels_lambdas],
+            f'{tbl_ways}+{tbl_rels}:nodes_parent'+('_bucket' if use_bucket_func else '')) :
         node_count+=node_c
         log.l.doublerate(way_count,'ways',rel_count,'rels parents of node',node_count,a_len(nodes_name))
         for way in way_ids:
@@ -270,17 +624,19 @@ def ways_parent_r(s:settings.Settings,a:Accumulator) :
     if s.new_jsonb_schema :
         # the ::char(1) cast IS IMPORTANT for index performance, 10x or more slower without it
         rels_query="SELECT id FROM "+tbl_rels
-        rels_query+=" WHERE planet_osm_member_ids(members,'W'::char(1)) && ARRAY[{0}]::bigint[];"
-        rels_lambdas=(lambda i:','.join(map(str,i)),)
+        rels_query+=" WHERE planet_osm_member_ids(members,'W'::char(1)) && $1"
+        rels_query=(rels_query,('bigint[]',))
+        rels_lambdas=(list,)
     else :
         parts_indexed="SELECT id,members FROM "+tbl_rels
-        parts_indexed+=" WHERE ARRAY[{0}]::bigint[] && parts"
-        members_where="ARRAY[{1}] && members"
-        rels_query=f'SELECT id FROM ({parts_indexed}) AS parts_indexed WHERE {members_where};'
-        rels_lambdas=(lambda i:','.join(map(str,i)),lambda i:','.join(map(lambda j:f"'w{j}'",i)),)
+        parts_indexed+=" WHERE $1 && parts"
+        members_where="$2 && members"
+        rels_query=(f'SELECT id FROM ({parts_indexed}) AS parts_indexed WHERE {members_where}',
+            ('bigint[]','text[]'))
+        rels_lambdas=(list,lambda i:[f'w{j}' for j in i],)
 
-    for way_c,rel_ids in a.g_adaptive_parent_multiquery('ways',s.c,
-            (rels_query,),[rels_lambdas]) :
+    for way_c,rel_ids in g_parent_multiquery(s,a,'ways',
+            (rels_query,),[rels_lambdas],f'{tbl_rels}:ways_parent') :
         way_count+=way_c
         for rel in rel_ids:
             rel_count+=1
@@ -289,11 +645,49 @@ def ways_parent_r(s:settings.Settings,a:Accumulator) :
     log.l.finishrate(lastline=False)
     log.l.log(a_len('rels'),'rels forward')
 
-def rels_children_nwr(s:settings.Settings,a:Accumulator,only_multipolygon_rels=False,without_rels=False) :
+def rels_members_query(s:settings.Settings,only_multipolygon_rels=False,without_rels=False)->str :
+    ''' Build the query returning (osm_type,ref) of all members of the rels with id=ANY(%s),
+    osm_type being one of 'N','W','R'. Unless without_rels==True, rels that are members
+    of rels are resolved server-side by a recursive query, to any depth: their own
+    members are returned as well, and every rel of that closure appears as an 'R' row.
+    '''
+    tbl_rels=s.tables['_rels']['name']
+    if s.new_jsonb_schema :
+        members="SELECT m->>'type' AS osm_type,(m->>'ref')::bigint AS ref FROM jsonb_array_elements(r.members) AS m"
+        multipolygon_constr=" AND (r.tags->>'type')='multipolygon'"
+    else :
+        #members is [mixed_id1,role1,mixed_id2,role2,...], mixed_id like 'w123'
+        members="SELECT upper(substr(r.members[i],1,1)) AS osm_type,substr(r.members[i],2)::bigint AS ref"
+        members+=" FROM generate_series(1,coalesce(array_length(r.members,1),0),2) AS i"
+        multipolygon_constr=" AND ((r.tags::hstore)->'type')='multipolygon'"
+    multipolygon_constr=multipolygon_constr if only_multipolygon_rels else ''
+
+    if without_rels :
+        query=f'SELECT DISTINCT m.osm_type,m.ref FROM {tbl_rels} AS r,LATERAL ({members}) AS m'
+        query+=f" WHERE r.id=ANY(%s::bigint[]){multipolygon_constr} AND m.osm_type!='R';"
+        return query
+    # UNION (not UNION ALL) also terminates on cyclic rel memberships
+    query=f'''WITH RECURSIVE closure(id) AS (
+            SELECT unnest(%s::bigint[])
+        UNION
+            SELECT m.ref FROM closure JOIN {tbl_rels} AS r ON r.id=closure.id{multipolygon_constr},
+                LATERAL ({members}) AS m
+            WHERE m.osm_type='R'
+    )
+    SELECT DISTINCT m.osm_type,m.ref FROM closure JOIN {tbl_rels} AS r ON r.id=closure.id{multipolygon_constr},
+        LATERAL ({members}) AS m
+    WHERE m.osm_type!='R'
+    UNION ALL
+    SELECT 'R',id FROM closure;'''
+    return query
+
+def rels_children_nwr(s:settings.Settings,a:Accumulator,only_multipolygon_rels=False,without_rels=False,
+        batch_size=10_000) :
     ''' Going over all rel ids in accumulator, read every rel's members[] array and add all its
     children, according to their type: node/way/relation, to the accumulator.
     without_rels==True means to disregard the rel's children that are rels.
     only_multipolygon_rels==True means to only scan rels that are type="multipolygon".
+    Rels are queried batch_size at a time, see rels_members_query().
     '''
     # 4) BACKpropagation: resolve to take in all rels->ways->nodes
     # 4a) foreach rel_id: add all its members'ids as n{id} -> node, w{id} -> way, or r{id} -> rel
@@ -302,97 +696,80 @@ def rels_children_nwr(s:settings.Settings,a:Accumulator,only_multipolygon_rels=F
     rel_count=0
     tot_count=0
     a_len=a.len
+    len_rels=a_len('rels')
     #relation can be of very different types. a multipolygon could be a forest for example,
     # with an associated geometry. constrast that to a type="route" or type="superroute",
     # thore are only groups of already representable ways on the map
     # see osm wiki /Types_of_relation for more
-    if s.new_jsonb_schema :
-        multipolygon_constr=" AND (tags->>'type')='multipolygon'"
-    else :
-        multipolygon_constr=" AND ((tags::hstore)->'type')='multipolygon'"
-    multipolygon_constr=multipolygon_constr if only_multipolygon_rels else ''
+    query=rels_members_query(s,only_multipolygon_rels,without_rels)
 
-    tbl_rels=s.tables['_rels']['name']
-    for j in (1,2): #repeat twice to resolve rels that have rels as children
-        buffer_add_rels=set()
-        for rel_id in a.all('rels') :
-            #for row in g_query_ids()
-            tot_count+=1
-            s.c.execute(f'SELECT members FROM {tbl_rels} WHERE id={rel_id}{multipolygon_constr};')
-            for row in dbutils.g_from_cursor(s.c) :
-                ms=row['members']
-                if s.new_jsonb_schema :
-                    for m in ms :
-                        if m['type']=='N' :
-                            a.add('nodes',m['ref'])
-                            node_count+=1
-                        elif m['type']=='W' :
-                            a.add('ways',m['ref'])
-                            way_count+=1
-                        elif m['type']=='R' :
-                            buffer_add_rels.add(m['ref'])
-                            if not without_rels :
-                                rel_count+=1
-                        else :
-                            raise ValueError(f'''Encountered invalid members[]
-                                element of rel id {rel_id} in members={repr(ms)},
-                                value {repr(m)}''')
-                else :
-                    for i in range(0,len(ms),2) :
-                        osm_type=ms[i][0]
-                        osm_id=int(ms[i][1:])
-                        if osm_type=='n' :
-                            a.add('nodes',osm_id)
-                            node_count+=1
-                        elif osm_type=='w' :
-                            a.add('ways',osm_id)
-                            way_count+=1
-                        elif osm_type=='r' :
-                            buffer_add_rels.add(osm_id)
-                            if not without_rels :
-                                rel_count+=1
-                        else :
-                            raise ValueError(f'''Encountered invalid members[]
-                                element of rel id {rel_id} in members={repr(ms)}
-                                at index [{i}]={repr(ms[i])}''')
-            log.l.triplerate(node_count,'nodes',way_count,'ways',rel_count,'rels children of rel',
-                    tot_count,a_len('rels'))
-        if without_rels :
-            #l.save_clearedline()
-            log.l.finishrate()
-            return #after first run
-        for rel_id in buffer_add_rels :
-            a.add('rels',rel_id)
-        tot_count=0 #reset counter to make only count up to 100% not 200%
+    rel_ids=a.all('rels')
+    while len(batch:=list(itertools.islice(rel_ids,batch_size)))>0 :
+        tot_count+=len(batch)
+        for osm_type,osm_id in dbutils.g_stream(s.access,query,(batch,),itersize=s.itersize) :
+            if osm_type=='N' :
+                a.add('nodes',osm_id)
+                node_count+=1
+            elif osm_type=='W' :
+                a.add('ways',osm_id)
+                way_count+=1
+            elif osm_type=='R' :
+                if not a.is_in('rels',osm_id) :
+                    rel_count+=1
+                a.add('rels',osm_id)
+            else :
+                raise ValueError(f'''Encountered invalid members[]
+                    element type {repr(osm_type)} with ref {osm_id} in one of the rels {batch}''')
+        log.l.triplerate(node_count,'nodes',way_count,'ways',rel_count,'rels children of rel',
+                tot_count,len_rels)
     log.l.finishrate()
 
-def ways_children_n(s:settings.Settings,a:Accumulator) :
+def ways_children_n(s:settings.Settings,a:Accumulator,target_s=0.5) :
+    ''' Add all nodes[] ids of all ways in accumulator. Ways are queried in batches
+    with one array parameter, the batch size adapts so that each query takes about target_s.
+    '''
     a_len=a.len
-    # 4b) foreach way_id: add all its nodes[] ids
+    # 4b) foreach batch of way_ids: add all their nodes[] ids
     way_count=0
     node_count=0
-    for way_id in a.all('ways') :
-        way_count+=1
-        s.c.execute(f'SELECT id,nodes FROM {s.tables["_ways"]["name"]} WHERE id={way_id};')
+    tbl_ways=s.tables["_ways"]["name"]
+    batch_size=1_000
+    way_ids=a.all('ways')
+    while len(batch:=list(itertools.islice(way_ids,batch_size)))>0 :
+        start_time=time.time()
+        dbutils.prepared.execute(s.c,f'SELECT nodes FROM {tbl_ways} WHERE id=ANY($1)',('bigint[]',),
+            (batch,),s.prepare)
+        # one add_many per batch: ArrayAccumulator merges them block by block
+        nodes=[]
         for row in dbutils.g_from_cursor(s.c) :
-            for i in row['nodes'] :
-                a.add('nodes',i)
-                if i==122317 :
-                    log.l.log('n122317 is in',a.is_in('nodes',122317))
-                    log.l.log('FROM way',row['id'],'which has',len(row['nodes']),'nodes')
-                node_count+=1
+            nodes.extend(row['nodes'])
+        a.add_many('nodes',nodes)
+        node_count+=len(nodes)
+        way_count+=len(batch)
+        batch_size=dbutils.adapt_batch_size(batch_size,time.time()-start_time,target_s)
         log.l.rate(node_count,'nodes children of way',way_count,a_len('ways'))
     log.l.finishrate()
 
 
+def osm_root_attrs(s:settings.Settings)->dict :
+    return {
+        'version':'0.6',
+        'generator':f'{__package__} v{__version__}',
+        'at_time':time.strftime(f'%F_%T'),
+        'url':s.project_url,
+    }
+
 async def stream_osm_xml(s:settings.Settings) :
     ''' Query osm2pgsql-imported postgres database for nodes, ways and rels and stream
-    an xml representation of them into s.out_file. Attempts to select objects that are in
+    an xml (or pbf, see writers.output_format) representation of them into s.out_file. Attempts to select objects that are in
     the given bounds. But the dependencies are sometimes required, so more data that just
     within the bounds will be included. Currently, no geometric features are clipped in
     any way.
     See --help for s.bounds.
     '''
+    if s.regions is not None :
+        await stream_regions(s)
+        return
     log.l.log_start(time.strftime('%F_%T'))
     ## TODO: move this config to Settings
     with_parents=True
@@ -402,29 +779,58 @@ async def stream_osm_xml(s:settings.Settings) :
     log.l.set_phases(phases)
 
     #nodes within are a subset of nodes: copy of nodes just after all_nwr_within was run
-    a=DictAccumulator(('nodes','nodes_within','ways','rels','done_ids'))
+    a=ArrayAccumulator(('nodes','nodes_within','ways','rels','done_ids'))
+    if s.memory_profiler is not None :
+        s.memory_profiler.watch(a)
+
+    cp=None
+    done_phase=None #last phase completed before resuming
+    if s.checkpoint_dir is not None :
+        cp=checkpoint.Checkpoint(s,s.checkpoint_dir)
+        if s.resume :
+            done_phase=cp.load(a)
+    if done_phase=='write' :
+        log.l.log('nothing to do: the checkpoint is of a complete extraction')
+        return
+    def resumed(phase:str)->bool :
+        return done_phase is not None and phases.index(done_phase)>=phases.index(phase)
 
-    #NOTE: only nodes existing in _point are selected: they are
-    #   about 5% of all nodes usually
-    all_nwr_within(s,a)
-    #copy [~100K tagged_nodes, ~300K ways, ~7K rels]
-    for i in a.all('nodes') :
-        a.add('nodes_within',i)
+    if s.partitions>1 and not resumed('parents') :
+        # all of within, children and parents, in parallel
+        partitioned_nwr(s,a)
+        if cp is not None :
+            cp.save_phase('parents',a)
+        done_phase='parents'
+
+    if not resumed('within') :
+        #NOTE: only nodes existing in _point are selected: they are
+        #   about 5% of all nodes usually
+        all_nwr_within(s,a)
+        #copy [~100K tagged_nodes, ~300K ways, ~7K rels]
+        a.copy('nodes','nodes_within')
+        if cp is not None :
+            cp.save_phase('within',a)
 
     log.l.next_phase() #children
 
-    ## TODO: move config to Settings
-    # [+0K nodes, +60K ways, +0K rels] only_multipolygon_rels=True,without_rels=True
-    rels_children_nwr(s,a,only_multipolygon_rels=True,without_rels=True)
-    # [+3.2M nodes]
-    ways_children_n(s,a)
-    # we now have: [~3.3M nodes, ~350K ways, ~7K rels]
+    if not resumed('children') :
+        ## TODO: move config to Settings
+        # [+0K nodes, +60K ways, +0K rels] only_multipolygon_rels=True,without_rels=True
+        rels_children_nwr(s,a,only_multipolygon_rels=True,without_rels=True)
+        # [+3.2M nodes]
+        ways_children_n(s,a)
+        # we now have: [~3.3M nodes, ~350K ways, ~7K rels]
+        if cp is not None :
+            cp.save_phase('children',a)
 
     if with_parents :
         log.l.next_phase() #parents
-        # [+40K ways, +1K rels]
-        nodes_parent_wr(s,a,only_nodes_within=True)
-        #ways_parent_r(s,a)
+        if not resumed('parents') :
+            # [+40K ways, +1K rels]
+            nodes_parent_wr(s,a,only_nodes_within=True)
+            #ways_parent_r(s,a)
+            if cp is not None :
+                cp.save_phase('parents',a)
 
     log.l.next_phase() #write
     counts=[a.len(i)for i in ('nodes','ways','rels')]
@@ -434,30 +840,301 @@ async def stream_osm_xml(s:settings.Settings) :
     # ONLY after all ids have been resolved, do we actually query the data,
     # RAM-inefficient otherwise; more RAM-inefficient for bigger extracts.
     # do more of a streaming from database to file approach
-    with ET.xmlfile(s.out_file,encoding='utf-8') as xml_out :
-        xml_out.write_declaration()
-        with xml_out.element('osm',{
-            'version':'0.6',
-            'generator':f'{__package__} v{__version__}',
-            'at_time':time.strftime(f'%F_%T'),
-            'url':s.project_url,
-        }) :
+    out_format=writers.output_format(s.out_file,s.out_format)
+    # incremental: only what changed since the manifest of a previous extract, as osmChange
+    since=None
+    if s.since is not None :
+        since=manifest.Manifest(s.since)
+        out_format='osc'
+    manifest_w=None
+    if s.manifest :
+        manifest_w=manifest.ManifestWriter(0 if since is None else since.change_version)
+    writer_kwargs={}
+    if s.sorted and out_format=='pbf' :
+        writer_kwargs['optional_features']=('Sort.Type_then_ID',)
+    # resuming the write phase: the output is complete up to offset
+    offset=cp.output_offset() if cp is not None else None
+    if offset is not None :
+        writer_kwargs['append']=True
+    # write phase checkpoints need to be able to come back to an offset of the output
+    write_cp=cp if isinstance(s.out_file,str) else None
+    # .bz2, .gz or .zst out_file: compressed in-process
+    root_attrs=osm_root_attrs(s)
+    with compress.open_output(s.out_file,s.compress_threads,offset) as out_f, \
+            writers.open_writer(count_output(s,out_f),root_attrs,out_format,**writer_kwargs) as out :
+        if s.concurrent_write :
+            write_concurrently(s,a,out,out_format)
+        else :
             async for el in chain(
-                    create_nodes(s,a),
-                    create_ways(s,a),
-                    create_relations(s,a),
+                    g_output_order(s,create_nodes(s,a)),
+                    g_output_order(s,create_ways(s,a)),
+                    g_output_order(s,create_relations(s,a)),
             ) :
-                xml_out.write(el)
+                if write_cp is not None :
+                    write_cp.before_write(el,out,out_f)
+                if manifest_w is None and since is None :
+                    out.write(el)
+                else :
+                    write_tracked(el,out,manifest_w,since)
+            if since is not None :
+                for el in since.g_deleted() :
+                    out.write_action('delete',el)
+    if manifest_w is not None :
+        manifest_w.save(s.out_file+'.manifest',root_attrs)
+        log.l.log('manifest written to',s.out_file+'.manifest')
+    if cp is not None :
+        cp.save_done()
+
+def count_output(s:settings.Settings,out_f:typing.BinaryIO)->typing.BinaryIO :
+    ''' out_f, counting the bytes written into s.metrics if there are metrics
+    '''
+    return out_f if s.metrics is None else s.metrics.count_output(out_f)
+
+def write_tracked(el:writers.OsmElement,out:writers.XmlWriter,manifest_w:typing.Optional[manifest.ManifestWriter],
+        since:typing.Optional[manifest.Manifest]) :
+    ''' out.write(el), also adding el to the manifest_w. With since (the manifest of a
+    previous extract), out is an OscWriter: only write el if it changed since, with
+    the version of the change.
+    '''
+    if el.name not in manifest.TYPES :
+        if since is None :
+            out.write(el) #debug
+        return
+    el_str=writers.element_to_str(el)
+    el_hash=manifest.element_hash(el_str)
+    if manifest_w is not None :
+        manifest_w.add(el,el_hash)
+    if since is not None :
+        action=since.action(el,el_hash)
+        if action is not None :
+            # hashed without it: the version alone is no change
+            el.attrs['version']=since.change_version
+            out.write_action(action,el)
+    elif isinstance(out,writers.XmlWriter) :
+        out.write_str(el_str)
+    else :
+        out.write(el)
+
+# settings passed on to the partition worker processes
+PARTITION_SETTINGS_KEYS=('debug','bounds_geojson','bounds_rel_id','bounds_iso','get_lonlat_binary',
+    'nodes_file','postgres_dsn','stage_ids','binary_copy','itersize','chunk_target_ms','chunk_cache',
+    'prepare')
+
+def partition_worker(settings_kwargs:dict,bounds_box:str)->typing.Tuple[array.array,array.array,array.array] :
+    ''' Run in a separate process: the within, children and parents phases for one
+    partition of the boundary, returns its sorted (nodes,ways,rels) id arrays.
+    '''
+    access=psycopg2.connect(settings_kwargs['postgres_dsn'])
+    try :
+        log.l.set_phases(['partition'])
+        with log.l.mute() :
+            ps=settings.ModuleSettings(access=access,bounds_box=bounds_box,
+                has_suggested_out_filename=True,**settings_kwargs)
+            a=ArrayAccumulator(('nodes','nodes_within','ways','rels','done_ids'))
+            all_nwr_within(ps,a)
+            a.copy('nodes','nodes_within')
+            rels_children_nwr(ps,a,only_multipolygon_rels=True,without_rels=True)
+            ways_children_n(ps,a)
+            nodes_parent_wr(ps,a,only_nodes_within=True)
+        return tuple(a.sequence(k) for k in ('nodes','ways','rels'))
+    finally :
+        access.close()
 
-def rel_to_xml(row_dict:dict,tags:dict,new_jsonb_schema:bool)->ET.Element :
+def partitioned_nwr(s:settings.Settings,a:Accumulator) :
+    ''' Replacement for the within, children and parents phases: split the boundary
+    into s.partitions strips of longitude (each strip being the boundary AND a bbox),
+    resolve each strip's ids in its own process, and merge them into a. Elements
+    crossing strips are found by several partitions and merged only once.
+    '''
+    lon_from,lat_from,lon_to,lat_to=s.bounds_extent()
+    width=(lon_to-lon_from)/s.partitions
+    boxes=[f'{lon_from+i*width},{lat_from},{lon_from+(i+1)*width if i<s.partitions-1 else lon_to},{lat_to}'
+        for i in range(s.partitions)]
+    settings_kwargs={k:getattr(s,k) for k in PARTITION_SETTINGS_KEYS}
+    if settings_kwargs['postgres_dsn'] is None :
+        settings_kwargs['postgres_dsn']=s.access.dsn
+    log.l.log(f'resolving ids of {s.partitions} partitions in parallel ...')
+    # spawn: a forked process would inherit the connections of this one
+    with concurrent.futures.ProcessPoolExecutor(s.partitions,
+            mp_context=multiprocessing.get_context('spawn')) as pool :
+        futures={pool.submit(partition_worker,settings_kwargs,box):box for box in boxes}
+        for done,future in enumerate(concurrent.futures.as_completed(futures),start=1) :
+            for k,ids in zip(('nodes','ways','rels'),future.result()) :
+                a.add_sorted(k,ids)
+            log.l.log(f'partition {done}/{s.partitions} (bbox {futures[future]}) done:',
+                log.n(a.len('nodes')),'nodes,',log.n(a.len('ways')),'ways,',log.n(a.len('rels')),'rels so far')
+
+def region_out_file(out_file:str,iso:str,name:str)->str :
+    ''' Output filename for one region of the batch: fill in the {iso} and {name}
+    placeholders of out_file
+    '''
+    return out_file.format(iso=iso.lower(),name=name.replace('/','_'))
+
+async def stream_regions(s:settings.Settings) :
+    ''' Batch mode of stream_osm_xml() for all the iso codes in s.regions, writing
+    one output per region. The ids of each region are collected in turn, on the same
+    connection. Then every element needed by any region is queried only once, and
+    written to the outputs of all the regions containing it.
+    '''
+    log.l.log_start(time.strftime('%F_%T')+f' batch of {len(s.regions)} regions')
+    phases=[f'{iso} {phase}' for iso in s.regions for phase in ('within','children','parents')]
+    log.l.set_phases(phases+['write'])
+
+    regions=[] # (settings of the region, accumulator of the region)
+    union=ArrayAccumulator(('nodes','ways','rels','done_ids'))
+    if s.memory_profiler is not None :
+        s.memory_profiler.watch(union)
+    for ix,iso in enumerate(s.regions) :
+        rs=copy.copy(s)
+        rs.regions=None
+        rs.bounds_iso=iso
+        rs.has_suggested_out_filename=True
+        name,osm_id=dbutils.regions_lookup(iso)
+        rs.out_file=region_out_file(s.out_file,iso,name)
+        a=ArrayAccumulator(('nodes','nodes_within','ways','rels','done_ids'))
+        if ix>0 :
+            log.l.next_phase() #within
+        log.l.log(f'region {name}, output {rs.out_file}')
+        all_nwr_within(rs,a)
+        a.copy('nodes','nodes_within')
+        log.l.next_phase() #children
+        rels_children_nwr(rs,a,only_multipolygon_rels=True,without_rels=True)
+        ways_children_n(rs,a)
+        log.l.next_phase() #parents
+        nodes_parent_wr(rs,a,only_nodes_within=True)
+        a.clear('nodes_within')
+        for k in ('nodes','ways','rels') :
+            union.add_sorted(k,a.sequence(k))
+        regions.append((rs,a))
+
+    log.l.next_phase() #write
+    total=sum(a.len(k) for rs,a in regions for k in ('nodes','ways','rels'))
+    unique=sum(union.len(k) for k in ('nodes','ways','rels'))
+    log.l.log('dumping',log.n(unique),'elements for',log.n(total),'in all regions')
+
+    with contextlib.ExitStack() as stack :
+        outs=[]
+        for rs,a in regions :
+            out_format=writers.output_format(rs.out_file,s.out_format)
+            writer_kwargs={}
+            if s.sorted and out_format=='pbf' :
+                writer_kwargs['optional_features']=('Sort.Type_then_ID',)
+            out_f=stack.enter_context(compress.open_output(rs.out_file,s.compress_threads))
+            outs.append((stack.enter_context(writers.open_writer(count_output(s,out_f),osm_root_attrs(s),
+                out_format,**writer_kwargs)),a))
+        async for el in chain(
+                g_output_order(s,create_nodes(s,union)),
+                g_output_order(s,create_ways(s,union)),
+                g_output_order(s,create_relations(s,union)),
+        ) :
+            key=checkpoint.ELEMENT_KEYS.get(el.name)
+            osm_id=int(el.attrs['id']) if key is not None else None
+            el_str=None #serialize once for all xml outputs
+            for out,a in outs :
+                if key is not None and not a.is_in(key,osm_id) :
+                    continue
+                if isinstance(out,writers.XmlWriter) :
+                    if el_str is None :
+                        el_str=writers.element_to_str(el)
+                    out.write_str(el_str)
+                else :
+                    out.write(el)
+
+def output_tmp_dir(s:settings.Settings)->typing.Optional[str] :
+    ''' Where to put temporary files: next to the output, that filesystem has room for it
+    '''
+    return os.path.dirname(os.path.abspath(s.out_file)) if isinstance(s.out_file,str) else None
+
+def element_size(el:writers.OsmElement)->int :
+    ''' Rough estimate of the memory used by el, in bytes
+    '''
+    return 400+40*len(el.nds)+200*len(el.members)+150*len(el.tags)
+
+async def g_output_order(s:settings.Settings,g:typing.Iterator[writers.OsmElement])->typing.Iterator[writers.OsmElement] :
+    ''' Elements of g as they come, or with s.sorted in ascending id order: sorted
+    externally, using at most about s.sort_memory MB. debug elements have no id and are
+    passed through immediately.
+    '''
+    if not s.sorted :
+        async for el in chain(g) :
+            yield el
+        return
+    sorter=extsort.ExternalSorter(lambda el:int(el.attrs['id']),s.sort_memory<<20,
+        element_size,output_tmp_dir(s))
+    try :
+        async for el in chain(g) :
+            if el.name=='debug' :
+                yield el
+            else :
+                sorter.add(el)
+        if len(sorter.runs)>0 :
+            log.l.log('merging',len(sorter.runs)+1,'sorted runs')
+        for el in sorter.g_sorted() :
+            yield el
+    finally :
+        sorter.close()
+
+def write_concurrently(s:settings.Settings,a:Accumulator,out:writers.XmlWriter,out_format:str) :
+    ''' Run create_nodes, create_ways and create_relations at the same time, each in
+    a thread with its own connection and its own subset of the accumulator (they all
+    use the 'done_ids' key). Each one writes a fragment into a temporary segment file,
+    the segments are then spliced into out in osm order: nodes, ways, relations.
+    Progress of all three is reported from here, the producers' own logging is muted.
+    '''
+    producers=((create_nodes,'nodes'),(create_ways,'ways'),(create_relations,'rels'))
+    segments=[tempfile.TemporaryFile(dir=output_tmp_dir(s)) for p in producers]
+    subsets=[a.subset((key,'done_ids')) for create,key in producers]
+    totals=[a.len(key) for create,key in producers]
+    errors=[]
+
+    def run(create:typing.Callable,sub:Accumulator,segment:typing.BinaryIO) :
+        async def consume() :
+            with writers.open_writer(segment,{},out_format,fragment=True) as w :
+                async for el in g_output_order(ps,create(ps,sub)) :
+                    w.write(el)
+        ps=copy.copy(s)
+        try :
+            ps.access=s.new_connection()
+            ps.c=ps.access.cursor()
+            with log.l.mute() :
+                asyncio.run(consume())
+        except BaseException as e :
+            errors.append(e)
+        finally :
+            if hasattr(ps,'access') and ps.access is not s.access :
+                ps.access.close()
+
+    threads=[threading.Thread(target=run,args=(create,sub,segment),daemon=True)
+        for (create,key),sub,segment in zip(producers,subsets,segments)]
+    for t in threads :
+        t.start()
+    while any(t.is_alive() for t in threads) :
+        done=[sub.len('done_ids') for sub in subsets]
+        log.l.triplerate(done[0],'nodes',done[1],'ways',done[2],'rels',sum(done),max(1,sum(totals)))
+        time.sleep(0.1)
+    log.l.finishrate()
+    for t in threads :
+        t.join()
+    if len(errors)>0 :
+        raise errors[0]
+
+    log.l.log('merging segments')
+    for segment in segments :
+        segment.seek(0)
+        out.write_segment(segment)
+        segment.close()
+    for create,key in producers :
+        a.clear(key)
+
+def rel_to_xml(row_dict:dict,tags:dict,new_jsonb_schema:bool)->writers.OsmElement :
     # separate tags and row_dict, see way_to_xml()
     attrs,col_tags=split_tags_out(row_dict,('id','members'))
-    rel=ET.Element('relation',{'id':str(attrs['id'])})
+    members=[]
     if 'members' in attrs :
         if new_jsonb_schema :
+            trsl={'N':'node','W':'way','R':'relation'}
             for m in attrs.pop('members') :
-                trsl={'N':'node','W':'way','R':'relation'}
-                ET.SubElement(rel,'member',{'type':trsl[m['type']],'ref':str(m['ref']),'role':m['role']})
+                members.append((trsl[m['type']],m['ref'],m['role']))
         else :
             m=iter(attrs.pop('members'))
             while True :
@@ -466,19 +1143,20 @@ def rel_to_xml(row_dict:dict,tags:dict,new_jsonb_schema:bool)->ET.Element :
                     role=next(m)
                     osm_type={'n':'node','w':'way','r':'relation'}[mixed_id[0]]
                     id=mixed_id[1:]
-                    ET.SubElement(rel,'member',{'type':osm_type,'ref':str(id),'role':role})
+                    members.append((osm_type,id,role))
                 except StopIteration :
                     break
+    el_tags=[]
     have_keys=set()
     for t in (tags,col_tags) :
         for k,v in tags.items() :
             if k not in have_keys :
                 # make sure a float like v=18.572e6 does not have the 'e' in str() -> YES: "18572000.0"
-                ET.SubElement(rel,'tag',{'k':str(k),'v':str(v)})
+                el_tags.append((k,v))
                 have_keys.add(k)
-    return rel
+    return writers.OsmElement('relation',{'id':attrs['id']},members=members,tags=el_tags)
 
-def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element] :
+def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[writers.OsmElement] :
     ''' Read all ids from accumulator, under a.all('rels') and fetch corresponding
     data from database.
     Use the accumulator 'done_ids' for checking what was done and what needs to be done.
@@ -494,11 +1172,11 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
     table_name=s.tables['_polygon']['name']
     log.l.log('reading table',table_name,'...')
     read_columns=[f'-{table_name}.osm_id AS id',
-        f'hstore_to_json({table_name}.tags) AS json_tags',
+        f'{hstore_tags(s,table_name+".tags")} AS json_tags',
         # we need to merge the _polygon tags with the _rels tags.
         # _planet tags are overwritten by _rels tags because
         # json_tags is first loaded, the json_tags2 overloads all existing and non-existing keys
-        f'{tbl_rels}.tags AS json_tags2' if s.new_jsonb_schema else f'hstore_to_json({tbl_rels}.tags::hstore) AS json_tags2',
+        f'{tbl_rels}.tags AS json_tags2' if s.new_jsonb_schema else f'{hstore_tags(s,tbl_rels+".tags::hstore")} AS json_tags2',
         # do we need this ? no ; especially the tags->'area'='yes' will overwrite 'area' if it exists
         #f'{table_name}.way_area AS area',
         #I think real does not exist and real->float4
@@ -516,8 +1194,8 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
     # osm_id IN (-id1,-id2,-id3) is fast. But it needs some more memory in python to
     # store the negatives copy as well
     if s.debug_xml :
-        yield ET.Element('debug',{'status':'starting polygon query'})
-    for row_dict in dbutils.g_query_ids(s.c,query,g_negate(a.all('rels')),'osm_id',step=250) :
+        yield writers.OsmElement('debug',{'status':'starting polygon query'})
+    for row_dict in g_query_accumulated(s,query,g_negate(a.all('rels')),'osm_id',step=250) :
         if a.is_in('done_ids',row_dict['id']) :
             continue
         #collapse hstore tags 
@@ -525,7 +1203,7 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
         tags={**tags,**row_dict.pop('json_tags2')} if 'json_tags2' in row_dict else tags
         yield rel_to_xml(row_dict,tags,s.new_jsonb_schema)
         if s.debug_xml :
-            yield ET.Element('debug',{'previous':str(row_dict['id']),
+            yield writers.OsmElement('debug',{'previous':str(row_dict['id']),
                 'done_ids_len':str(a_len('done_ids')),'ids_len':str(len_ids),
                 'table':table_name})
         add_done_ids(row_dict['id'])
@@ -539,19 +1217,19 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
     log.l.log('reading table',table_name,'...')
 
     read_columns=[f'-{table_name}.osm_id AS id',
-        f'hstore_to_json({table_name}.tags) AS json_tags',
+        f'{hstore_tags(s,table_name+".tags")} AS json_tags',
         #f'{tbl_rels}.tags AS json_tags2' if s.new_jsonb_schema else f'hstore_to_json({tbl_rels}.tags::hstore) AS json_tags2',
         *list(dbutils.get_columns_of_types(s.c,('int4','int','int8','int16','text','real','float4','float8'),table_name))
     ]
     
-    #TEMP: there seems to be no index on _line! so we do additional queries one by one when double_query_mode==True
-    double_query_mode=True
+    # without indexes the JOIN is very slow: then do additional queries one by one, see probe.probe()
+    double_query_mode=s.strategy.line_rels=='double'
     if not double_query_mode :
         read_columns.append(f'{tbl_rels}.members')
         if s.new_jsonb_schema :
             read_columns.append(f'{tbl_rels}.tags AS json_tags2')
         else :
-            read_columns.append(f'hstore_to_json({tbl_rels}.tags::hstore) AS json_tags2')
+            read_columns.append(f'{hstore_tags(s,tbl_rels+".tags::hstore")} AS json_tags2')
     query='SELECT '+(','.join(read_columns))+f' FROM {table_name}'
 
     if not double_query_mode :
@@ -561,48 +1239,51 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
         #query+=f' JOIN {tbl_rels} ON {table_name}.osm_id=-{tbl_rels}.id'
         #query+=f' JOIN {tbl_rels} ON -{table_name}.osm_id={tbl_rels}.id'
         # sloow
-        query+=f', {tbl_rels} WHERE {table_name}.osm_id=-{tbl_rels}.id'
-        #slooow
-        #query+=f', {tbl_rels} WHERE -{table_name}.osm_id={tbl_rels}.id'
+        #query+=f', {tbl_rels} WHERE {table_name}.osm_id=-{tbl_rels}.id'
+        # only with the indexes that probe.probe() checks for
+        query+=probe.line_rels_join(table_name,tbl_rels)
     else :
-        # try a FROM _line,_rels WHERE -_line.osm_id=rels.id, maybe that recognizes the index ?
+        # the _rels rows of each batch of _line rows in one query, joined client-side
         if s.new_jsonb_schema :
-            query2=f'SELECT tags AS json_tags2,members FROM {tbl_rels} WHERE id=' #need to append id
+            query2=f'SELECT id,tags AS json_tags2,members FROM {tbl_rels} WHERE id=ANY($1)'
         else :
-            query2=f'SELECT hstore_to_json(tags::hstore) AS json_tags2,members FROM {tbl_rels} WHERE id=' #need to append id
-        cursor2=s.access.cursor() # need a second cursor here
+            query2=f'SELECT id,hstore_to_json(tags::hstore) AS json_tags2,members FROM {tbl_rels} WHERE id=ANY($1)'
+        # need a second cursor here, on another connection while a binary COPY streams on s.access
+        conn2=s.new_connection() if s.binary_copy else None
+        cursor2=(s.access if conn2 is None else conn2).cursor()
 
     # psql does not have an index on -osm_id and does not understand *=-1 is bijective.
     #therevore  checking -osm_id IN (id1,id2,id3) is super slow, but
     # osm_id IN (-id1,-id2,-id3) is fast. But it needs some more memory in python to
     # store the negatives copy as well
-    if s.debug_xml :
-        yield ET.Element('debug',{'status':'starting line query'})
-    first=True
-    for row_dict in dbutils.g_query_ids(s.c,query,g_negate(a.all_subtract('rels','done_ids')),'osm_id',step=250) :
-        if first :
-            start_t=time.time()
-            #l.log('rels _line output start',start_t)
-            first=False
-
-        if a.is_in('done_ids',row_dict['id']) :
-            continue
-        #collapse hstore tags 
-        tags=row_dict.pop('json_tags') if 'json_tags' in row_dict else {}
+    try :
+        if s.debug_xml :
+            yield writers.OsmElement('debug',{'status':'starting line query'})
+        first=True
+        line_rows=g_query_accumulated(s,query,g_negate(a.all_subtract('rels','done_ids')),'osm_id',step=250)
         if double_query_mode :
-            cursor2.execute(query2+str(row_dict['id']))
-            #add this missing data, ORDER important
-            json_tags2,row_dict['members']=cursor2.fetchone()
-            tags={**tags,**json_tags2}
-        else :
+            line_rows=g_join_rels(s,cursor2,query2,line_rows)
+        for row_dict in line_rows :
+            if first :
+                start_t=time.time()
+                #l.log('rels _line output start',start_t)
+                first=False
+
+            if a.is_in('done_ids',row_dict['id']) :
+                continue
+            #collapse hstore tags 
+            tags=row_dict.pop('json_tags') if 'json_tags' in row_dict else {}
             tags={**tags,**row_dict.pop('json_tags2')} if 'json_tags2' in row_dict else tags
-        yield rel_to_xml(row_dict,tags,s.new_jsonb_schema)
-        if s.debug_xml :
-            yield ET.Element('debug',{'previous':str(row_dict['id']),
-                'done_ids_len':str(a_len('done_ids')),'ids_len':str(len_ids),
-                'table':table_name})
-        add_done_ids(row_dict['id'])
-        log.l.simplerate(a_len('done_ids'),'rels',len_ids)
+            yield rel_to_xml(row_dict,tags,s.new_jsonb_schema)
+            if s.debug_xml :
+                yield writers.OsmElement('debug',{'previous':str(row_dict['id']),
+                    'done_ids_len':str(a_len('done_ids')),'ids_len':str(len_ids),
+                    'table':table_name})
+            add_done_ids(row_dict['id'])
+            log.l.simplerate(a_len('done_ids'),'rels',len_ids)
+    finally :
+        if double_query_mode and conn2 is not None :
+            conn2.close()
     if first :
         #edgecase when query returned 0 items
         start_t=time.time()
@@ -614,19 +1295,19 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
         query=f'SELECT id,members,tags AS json_tags FROM {table_name}'
     else :
         #in this table, tags is ::text[], not a hstore
-        query=f'SELECT id,members,hstore_to_json(tags::hstore) AS json_tags FROM {table_name}'
+        query=f'SELECT id,members,{hstore_tags(s,"tags::hstore")} AS json_tags FROM {table_name}'
     #bigger step than previous, because there is (heurisitcally) less data for these "light" relations,
     # which have no interesting tags regarding rendering making them worthy of a place in _polygon or _line
     if s.debug_xml :
-        yield ET.Element('debug',{'status':'starting rels query'})
-    for row_dict in dbutils.g_query_ids(s.c,query,a.all_subtract('rels','done_ids'),'id',step=300) :
+        yield writers.OsmElement('debug',{'status':'starting rels query'})
+    for row_dict in g_query_accumulated(s,query,a.all_subtract('rels','done_ids'),'id',step=300) :
         if a.is_in('done_ids',row_dict['id']) :
             continue
         #collapse hstore tags 
         tags=row_dict.pop('json_tags') if 'json_tags' in row_dict else {}
         yield rel_to_xml(row_dict,tags,s.new_jsonb_schema)
         if s.debug_xml :
-            yield ET.Element('debug',{'previous':str(row_dict['id']),
+            yield writers.OsmElement('debug',{'previous':str(row_dict['id']),
                 'done_ids_len':str(a_len('done_ids')),'ids_len':str(len_ids),
                 'table':table_name})
         add_done_ids(row_dict['id'])
@@ -634,24 +1315,21 @@ def create_relations(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Elem
     log.l.finishrate()
     a.clear('rels')
 
-def way_to_xml(row_dict:dict,tags:dict)->ET.Element :
+def way_to_xml(row_dict:dict,tags:dict)->writers.OsmElement :
     attrs,col_tags=split_tags_out(row_dict,('id','nodes'))
     # KEEP tags and row_dict separate:
     # https://www.openstreetmap.org/way/513097887 defines an id='1nh5Cbt9_EsnMhdH5T3hnPXQguY=' !!!
 
-    way=ET.Element('way',{'id':str(attrs['id'])})
-    if 'nodes' in attrs:
-        for nd in attrs['nodes'] :
-            ET.SubElement(way,'nd',{'ref':str(nd)})
+    el_tags=[]
     have_keys=set()
     for t in (tags,col_tags) :
         for k,v in t.items() :
             if k not in have_keys :
-                ET.SubElement(way,'tag',{'k':str(k),'v':str(v)})
+                el_tags.append((k,v))
                 have_keys.add(k)
-    return way
+    return writers.OsmElement('way',{'id':attrs['id']},nds=attrs.get('nodes',()),tags=el_tags)
 
-def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element] :
+def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[writers.OsmElement] :
     tbl_ways=s.tables['_ways']['name']
     table_name=s.tables['_polygon']['name']
     a_add=a.add
@@ -662,8 +1340,8 @@ def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element]
 
     log.l.log('reading table',table_name,'...')
     read_columns=[f'{table_name}.osm_id AS id',
-        f'hstore_to_json({table_name}.tags) AS json_tags', #polygons stores a hstore even in the new_jsonb_schema
-        f'{tbl_ways}.tags AS json_tags2' if s.new_jsonb_schema else f'hstore_to_json({tbl_ways}.tags::hstore) AS json_tags2',
+        f'{hstore_tags(s,table_name+".tags")} AS json_tags', #polygons stores a hstore even in the new_jsonb_schema
+        f'{tbl_ways}.tags AS json_tags2' if s.new_jsonb_schema else f'{hstore_tags(s,tbl_ways+".tags::hstore")} AS json_tags2',
         # do we need this ? no
         #f'{table_name}.way_area AS area',
         #I think real does not exist and real->float4
@@ -673,7 +1351,7 @@ def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element]
     query+=f',{tbl_ways}.nodes FROM {table_name} JOIN {tbl_ways}'
     query+=f' ON {table_name}.osm_id={tbl_ways}.id'
 
-    for row_dict in dbutils.g_query_ids(s.c,query,a.all('ways'),'osm_id') :
+    for row_dict in g_query_accumulated(s,query,a.all('ways'),'osm_id') :
         if a.is_in('done_ids',row_dict['id']) :
             continue
         #collapse hstore tags 
@@ -687,15 +1365,15 @@ def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element]
     table_name=s.tables['_line']['name']
     log.l.log('reading table',table_name,'...')
     read_columns=[f'{table_name}.osm_id AS id',
-        f'hstore_to_json({table_name}.tags) AS json_tags',
-        f'{tbl_ways}.tags AS json_tags2' if s.new_jsonb_schema else f'hstore_to_json({tbl_ways}.tags::hstore) AS json_tags2',
+        f'{hstore_tags(s,table_name+".tags")} AS json_tags',
+        f'{tbl_ways}.tags AS json_tags2' if s.new_jsonb_schema else f'{hstore_tags(s,tbl_ways+".tags::hstore")} AS json_tags2',
         *list(dbutils.get_columns_of_types(s.c,('int4','int','int8','int16','text','real','float4','float8'),table_name))
     ]
     query='SELECT '+(','.join(read_columns))
     query+=f',{tbl_ways}.nodes FROM {table_name} JOIN {tbl_ways}'
     query+=f' ON {table_name}.osm_id={tbl_ways}.id'
 
-    for row_dict in dbutils.g_query_ids(s.c,query,a.all_subtract('ways','done_ids'),'osm_id') :
+    for row_dict in g_query_accumulated(s,query,a.all_subtract('ways','done_ids'),'osm_id') :
         if a.is_in('done_ids',row_dict['id']) :
             continue
         #collapse hstore tags 
@@ -712,8 +1390,8 @@ def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element]
     if s.new_jsonb_schema :
         query=f'SELECT id,nodes,tags AS json_tags FROM {table_name}'
     else :
-        query=f'SELECT id,nodes,hstore_to_json(tags::hstore) AS json_tags FROM {table_name}'
-    for row_dict in dbutils.g_query_ids(s.c,query,a.all_subtract('ways','done_ids'),'id') :
+        query=f'SELECT id,nodes,{hstore_tags(s,"tags::hstore")} AS json_tags FROM {table_name}'
+    for row_dict in g_query_accumulated(s,query,a.all_subtract('ways','done_ids'),'id') :
         if a.is_in('done_ids',row_dict['id']) :
             continue
         #collapse hstore tags 
@@ -724,21 +1402,58 @@ def create_ways(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element]
     log.l.finishrate()
     a.clear('ways')
 
+def g_join_rels(s:settings.Settings,c:psycopg2.extensions.cursor,query:str,
+        rows:typing.Iterator[dict],batch_size=250)->typing.Iterator[dict] :
+    ''' Add json_tags2 and members from _rels to each of rows, like the JOIN of
+    probe.line_rels_join() would (rows without a _rels row are dropped): one query
+    per batch_size rows instead of one per row. query selects id,json_tags2,members
+    WHERE id=ANY($1), see create_relations().
+    '''
+    rows=iter(rows)
+    while len(batch:=list(itertools.islice(rows,batch_size)))>0 :
+        dbutils.prepared.execute(c,query,('bigint[]',),(list({row['id'] for row in batch}),),s.prepare)
+        rels={rel.pop('id'):rel for rel in dbutils.g_from_cursor(c)}
+        for row_dict in batch :
+            rel=rels.get(row_dict['id'])
+            if rel is None :
+                continue
+            row_dict.update(rel)
+            yield row_dict
+
+def g_query_accumulated(s:settings.Settings,query:str,ids:typing.Iterator[int],
+        id_col:str,step=1000)->typing.Iterator[dict] :
+    ''' Run query for all ids, see dbutils.g_query_ids(). With s.stage_ids, load the ids
+    into a temp table first and run one single query joined on it instead of
+    one query per step ids.
+    '''
+    if s.stage_ids :
+        staging_table=dbutils.stage_ids(s.c,ids,'pgsql2osm_staged_ids')
+        yield from dbutils.g_query_staged(s.c,query,staging_table,id_col,
+            itersize=s.itersize,binary=s.binary_copy)
+    else :
+        yield from dbutils.g_query_ids(s.c,query,ids,id_col,step=step,binary=s.binary_copy,
+            prepare=s.prepare)
+
+def hstore_tags(s:settings.Settings,expr:str)->str :
+    ''' SELECT expression reading the hstore expr as a json_tags dict. The binary COPY
+    decodes hstore itself: skip the server-side hstore_to_json() then.
+    '''
+    return expr if s.binary_copy else f'hstore_to_json({expr})'
+
 def g_negate(g:typing.Iterator[int]) :
     for i in g :
         yield -i
 
-def node_to_xml(row_dict:dict,tags:dict)->ET.Element :
+def node_to_xml(row_dict:dict,tags:dict)->writers.OsmElement :
     attrs,col_tags=split_tags_out(row_dict,('id','lat','lon'))
-    attrs['id']=str(attrs['id'])
-    node=ET.Element('node',attrs)
+    el_tags=[]
     have_keys=set()
     for t in (tags,col_tags) :
         for k,v in t.items() :
             if k not in have_keys :
-                ET.SubElement(node,'tag',{'k':str(k),'v':str(v)})
+                el_tags.append((k,v))
                 have_keys.add(k)
-    return node
+    return writers.OsmElement('node',attrs,tags=el_tags)
 
 def split_tags_out(row_dict:dict,keep_keys:typing.Collection[str])->typing.Collection[dict] :
     ''' Given a row_dict, it also contains tags from the database columns.
@@ -754,7 +1469,7 @@ def split_tags_out(row_dict:dict,keep_keys:typing.Collection[str])->typing.Colle
             tags[k]=v
     return (dest_dict,tags,)
 
-async def create_nodes(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.Element] :
+async def create_nodes(s:settings.Settings,a:Accumulator)->typing.Iterator[writers.OsmElement] :
     table_name=s.tables['_point']['name']
     a.clear('done_ids')
     a_add=a.add
@@ -764,14 +1479,14 @@ async def create_nodes(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.El
 
     log.l.log('reading table',table_name,'...',clearline=True)
     read_columns=[f'{table_name}.osm_id AS id',
-        f'hstore_to_json({table_name}.tags) AS json_tags',
+        f'{hstore_tags(s,table_name+".tags")} AS json_tags',
         f'ST_X(ST_Transform({table_name}.way,4326)) AS lon',
         f'ST_Y(ST_Transform({table_name}.way,4326)) AS lat',
         *list(dbutils.get_columns_of_types(s.c,('int4','int','int8','int16','text'),table_name))
     ]
     query='SELECT '+(','.join(read_columns))+f' FROM {table_name}'
 
-    for row_dict in dbutils.g_query_ids(s.c,query,a.all('nodes'),'osm_id') :
+    for row_dict in g_query_accumulated(s,query,a.all('nodes'),'osm_id') :
         if a.is_in('done_ids',row_dict['id']) :
             continue
         # extract the json_tags into tags
@@ -787,7 +1502,9 @@ async def create_nodes(s:settings.Settings,a:Accumulator)->typing.Iterator[ET.El
     log.l.log('now querying flatnodes file for missing nodes')
     to_get_lat_lons=set()
 
-    for batch in g_batches(a.all_subtract('nodes','done_ids'),5_000) :
+    # in-process lookups have no per-batch process spawn to amortize
+    batch_size=5_000 if s.get_lonlat_binary is not None else 200_000
+    for batch in g_batches(a.all_subtract('nodes','done_ids'),batch_size) :
         async for osm_id,lat,lon in dbutils.get_latlon_str_from_flatnodes(batch,s) :
             #osm_id,lat and lon are already strings (don't bother to convert+reconvert them)
             osm_id_int=int(osm_id)
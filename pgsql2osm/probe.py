@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+import json
+import typing
+
+import psycopg2
+
+"""
+Startup probe of the database: which indexes exist on the osm2pgsql tables, and
+which query strategy the planner can run fast for each phase, judged from the
+EXPLAIN of each query template (nothing is executed). See probe()
+"""
+
+# only the plan is looked at, the values do not need to exist
+SAMPLE_IDS=','.join(str(i) for i in range(1,51))
+# a Bitmap Heap Scan always reads the bitmap of an index scan
+INDEX_SCANS=('Index Scan','Index Only Scan','Bitmap Heap Scan')
+
+class Strategy :
+    """ Result of probe(): the query strategies to use, the indexes found, and
+    the indexes that are missing along with the CREATE INDEX that would help
+    """
+    def __init__(self) :
+        # planet_osm_index_bucket() exists
+        self.bucket_func=False
+        # parents of nodes in _ways: 'bucket' also filters on planet_osm_index_bucket(nodes),
+        # 'plain' only on nodes && ARRAY[...]
+        self.ways_nodes='plain'
+        # rels from _line: 'join' _rels in the same query, 'double' query _rels separately
+        self.line_rels='double'
+        # table key -> [(index name,access method,definition)]
+        self.indexes={}
+        # probed query name -> (uses an index,total cost), None when it failed
+        self.plans={}
+        # (what is slow without it,CREATE INDEX statement)
+        self.missing=[]
+
+    def summary(self)->typing.List[str] :
+        lines=[f'INFO: parents of nodes: {self.ways_nodes} nodes query, rels from _line: {self.line_rels} query']
+        for reason,create in self.missing :
+            lines.append(f'WARNING: no usable index for {reason}, consider:')
+            lines.append(f'\t{create}')
+        return lines
+
+    def report(self)->str :
+        """ Everything that was found, for --probe
+        """
+        lines=['indexes:']
+        for key,indexes in self.indexes.items() :
+            lines.append(f'  {key}:')
+            for name,method,definition in indexes :
+                lines.append(f'    {name} ({method}): {definition}')
+            if len(indexes)==0 :
+                lines.append('    none')
+        lines.append('query plans:')
+        for name,plan in self.plans.items() :
+            if plan is None :
+                lines.append(f'  {name}: not supported by this database')
+            else :
+                uses_index,cost=plan
+                lines.append(f'  {name}: {"index" if uses_index else "SEQUENTIAL SCAN"}, cost {cost:.0f}')
+        lines.append('strategies:')
+        lines.append(f'  parents of nodes in _ways: {self.ways_nodes}')
+        lines.append(f'  rels from _line: {self.line_rels}')
+        if len(self.missing)>0 :
+            lines.append('missing indexes:')
+            for reason,create in self.missing :
+                lines.append(f'  {reason}:')
+                lines.append(f'    {create}')
+        return '\n'.join(lines)
+
+def table_indexes(c:psycopg2.extensions.cursor,table_full_name:str)->typing.List[tuple] :
+    c.execute('''SELECT i.relname,am.amname,pg_get_indexdef(x.indexrelid)
+        FROM pg_index AS x
+            JOIN pg_class AS i ON i.oid=x.indexrelid
+            JOIN pg_am AS am ON am.oid=i.relam
+        WHERE x.indrelid=%s::regclass ORDER BY i.relname;''',(table_full_name,))
+    return c.fetchall()
+
+def has_function(c:psycopg2.extensions.cursor,name:str)->bool :
+    c.execute('SELECT count(*) FROM pg_proc WHERE proname=%s;',(name,))
+    return c.fetchone()[0]>0
+
+def g_plan_nodes(plan:dict)->typing.Iterator[dict] :
+    yield plan
+    for child in plan.get('Plans',()) :
+        yield from g_plan_nodes(child)
+
+def explain(c:psycopg2.extensions.cursor,query:str,table_full_names:typing.Collection[str],
+        seqscan=False)->typing.Optional[tuple] :
+    ''' (uses an index on all of table_full_names,total cost) of the query plan,
+    or None when the query fails (eg a function does not exist).
+    Sequential scans are disabled for the EXPLAIN unless seqscan: on small tables the
+    planner would rightly prefer them, the question is whether an index can be used at
+    all. The costs are then distorted, only compare the costs of seqscan plans.
+    Everything is rolled back to a savepoint, the transaction can go on.
+    '''
+    c.execute('SAVEPOINT pgsql2osm_probe;')
+    try :
+        if not seqscan :
+            c.execute('SET LOCAL enable_seqscan=off;')
+        c.execute('EXPLAIN (FORMAT JSON) '+query)
+        plan=c.fetchone()[0]
+    except psycopg2.Error :
+        plan=None
+    finally :
+        c.execute('ROLLBACK TO SAVEPOINT pgsql2osm_probe;')
+        c.execute('RELEASE SAVEPOINT pgsql2osm_probe;')
+    if plan is None :
+        return None
+    if isinstance(plan,str) :
+        plan=json.loads(plan)
+    plan=plan[0]['Plan']
+    indexed=set(node.get('Relation Name') for node in g_plan_nodes(plan) if node['Node Type'] in INDEX_SCANS)
+    uses_index=all(table_full_name.split('.')[-1].strip('"') in indexed for table_full_name in table_full_names)
+    return (uses_index,plan['Total Cost'])
+
+def line_rels_join(tbl_line:str,tbl_rels:str)->str :
+    ''' Appended to SELECT ... FROM {tbl_line} to get the _rels row of each line too
+    '''
+    return f', {tbl_rels} WHERE -{tbl_line}.osm_id={tbl_rels}.id'
+
+def probe(s)->Strategy :
+    """ s is a settings.Settings object, its tables already detected
+    """
+    c=s.c
+    st=Strategy()
+    tbl_ways=s.tables['_ways']['name']
+    tbl_rels=s.tables['_rels']['name']
+    for key in ('_point','_line','_polygon','_ways','_rels') :
+        st.indexes[key]=table_indexes(c,s.tables[key]['name'])
+    st.bucket_func=has_function(c,'planet_osm_index_bucket')
+
+    def probed(name:str,query:str,tables:typing.Collection[str],seqscan=False)->typing.Optional[tuple] :
+        st.plans[name]=explain(c,query,tables,seqscan)
+        return st.plans[name]
+    def usable(plan:typing.Optional[tuple])->bool :
+        return plan is not None and plan[0]
+
+    # within: the geometries intersecting the boundary
+    for key in ('_point','_line','_polygon') :
+        tbl=s.tables[key]['name']
+        geom=s.tables[key]['geom']
+        plan=probed(f'{key} within bounds',
+            f"SELECT osm_id FROM {tbl} WHERE ST_Intersects({geom},ST_MakeEnvelope(0,0,1,1,{s.tables[key]['srid']}))",(tbl,))
+        if not usable(plan) :
+            st.missing.append((f'{key} within bounds',f'CREATE INDEX ON {tbl} USING GIST ({geom});'))
+
+    # parents of nodes: ways
+    plain=probed('_ways parents of nodes',
+        f'SELECT id FROM {tbl_ways} WHERE ARRAY[{SAMPLE_IDS}]::bigint[] && nodes',(tbl_ways,))
+    bucket=None
+    if st.bucket_func :
+        bucket=probed('_ways parents of nodes, bucket filter',
+            f'SELECT id FROM {tbl_ways} WHERE planet_osm_index_bucket(ARRAY[{SAMPLE_IDS}]::bigint[])'
+            f' && planet_osm_index_bucket(nodes) AND ARRAY[{SAMPLE_IDS}]::bigint[] && nodes',(tbl_ways,))
+    if usable(bucket) and (not usable(plain) or bucket[1]<=plain[1]) :
+        st.ways_nodes='bucket'
+    elif not usable(plain) :
+        create_on='planet_osm_index_bucket(nodes)' if st.bucket_func else 'nodes'
+        st.missing.append(('_ways parents of nodes',
+            f'CREATE INDEX ON {tbl_ways} USING GIN ({create_on}) WITH (fastupdate=off);'))
+
+    # parents of nodes and ways: rels
+    for osm_type,name in (('N','nodes'),('W','ways')) :
+        if s.new_jsonb_schema :
+            plan=probed(f'_rels parents of {name}',
+                f"SELECT id FROM {tbl_rels} WHERE planet_osm_member_ids(members,'{osm_type}'::char(1)) && ARRAY[{SAMPLE_IDS}]::bigint[]",
+                (tbl_rels,))
+            create=f"CREATE INDEX ON {tbl_rels} USING GIN (planet_osm_member_ids(members,'{osm_type}'::char(1))) WITH (fastupdate=off);"
+        else :
+            plan=probed(f'_rels parents of {name}',
+                f'SELECT id FROM {tbl_rels} WHERE ARRAY[{SAMPLE_IDS}]::bigint[] && parts',(tbl_rels,))
+            create=f'CREATE INDEX ON {tbl_rels} USING GIN (parts) WITH (fastupdate=off);'
+        if not usable(plan) and (s.new_jsonb_schema or osm_type=='N') :
+            st.missing.append((f'_rels parents of {name}',create))
+
+    # write: elements by id
+    for key,id_col in (('_point','osm_id'),('_line','osm_id'),('_polygon','osm_id'),('_ways','id'),('_rels','id')) :
+        tbl=s.tables[key]['name']
+        plan=probed(f'{key} by id',f'SELECT {id_col} FROM {tbl} WHERE {id_col} IN ({SAMPLE_IDS})',(tbl,))
+        if not usable(plan) :
+            st.missing.append((f'{key} by id',f'CREATE INDEX ON {tbl} USING BTREE ({id_col});'))
+
+    # write: rels from _line, with their _rels members and tags. With sequential scans
+    # enabled: the JOIN is only worth it when the planner uses the indexes on its own,
+    # and when it costs less than the two queries by id of the double query
+    tbl_line=s.tables['_line']['name']
+    join=probed('_line JOIN _rels by id',
+        f'SELECT {tbl_line}.osm_id FROM {tbl_line}{line_rels_join(tbl_line,tbl_rels)}'
+        f' AND osm_id IN ({SAMPLE_IDS})',(tbl_line,tbl_rels),seqscan=True)
+    double=[probed(f'{key} by id, for the double query',query,(tbl,),seqscan=True) for key,tbl,query in (
+        ('_line',tbl_line,f'SELECT osm_id FROM {tbl_line} WHERE osm_id IN ({SAMPLE_IDS})'),
+        ('_rels',tbl_rels,f'SELECT id FROM {tbl_rels} WHERE id=ANY(ARRAY[{SAMPLE_IDS}]::bigint[])'))]
+    if usable(join) and None not in double and join[1]<=sum(plan[1] for plan in double) :
+        st.line_rels='join'
+    return st
@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+
+import collections
+import gzip
+import json
+import os
+import pickle
+import threading
+import time
+import typing
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+from . import __version__
+from . import log
+
+"""
+--record DIR saves the results of every statement a run executes (rows, errors,
+named cursor fetches, COPY output) and every location read from the flatnodes
+file. --replay DIR then runs the same export from them, without a database or a
+nodes file: to profile and benchmark the python side (node_to_xml, tags, writers)
+with reproducible inputs. Each statement is looked up by its text and parameters,
+so the replay has to issue the same ones: the same boundary and options (checked),
+a fixed chunk size for the parent queries, and no --jobs or --partitions.
+"""
+
+RECORDING_FILE='recording.pickle.gz'
+META_FILE='meta.json'
+# settings that change which statements run
+RECORDED_SETTINGS=('bounds_geojson','bounds_rel_id','bounds_iso','bounds_box','regions',
+    'stage_ids','binary_copy','since')
+
+Column=collections.namedtuple('Column',('name','type_code'))
+
+def query_key(query:typing.Any,params:typing.Any)->tuple :
+    if isinstance(query,bytes) :
+        query=query.decode()
+    elif not isinstance(query,str) :
+        # a psycopg2.sql.Composable
+        query=str(query)
+    return (query,repr(params))
+
+def columns(description:typing.Optional[typing.Sequence])->typing.Optional[list] :
+    if description is None :
+        return None
+    return [Column(col.name,col.type_code) for col in description]
+
+def force_single_job(s) :
+    ''' Same statements in the same order: one connection finds the parents
+    '''
+    if s.jobs!=1 or s.partitions!=1 :
+        log.l.log_start('INFO: --record and --replay run with --jobs 1 --partitions 1')
+    s.jobs=1
+    s.partitions=1
+
+class Recorder :
+    """ Use .cursor_class as the cursor_factory of all connections, wrap the
+    flatnodes.FlatNodes with .flatnodes(), and .finish() at the end.
+    Client-side cursors are read once to record their rows, then scrolled back.
+    Named cursors are recorded as they are fetchmany()ed.
+    """
+    def __init__(self,directory:str,s,base:typing.Optional[type]=None) :
+        self.directory=directory
+        os.makedirs(directory,exist_ok=True)
+        self.lock=threading.Lock()
+        self.seq=0
+        self.f=gzip.open(os.path.join(directory,RECORDING_FILE),'wb',compresslevel=1)
+        self.meta={
+            'pgsql2osm':__version__,
+            'started':time.strftime('%FT%T'),
+            'completed':False,
+            'settings':{k:getattr(s,k,None) for k in RECORDED_SETTINGS},
+            'chunk_sizes':{},
+        }
+        self.cursor_class=self.cursor_factory(base or psycopg2.extensions.cursor)
+
+    def write(self,record:tuple) :
+        with self.lock :
+            pickle.dump(record,self.f,protocol=pickle.HIGHEST_PROTOCOL)
+
+    def result(self,key:tuple,kind:str,payload:typing.Any)->int :
+        ''' Record the next result of statement key, return its sequence number
+        for chunk(). kind is 'rows', 'none', 'error', 'stream' or 'copy'
+        '''
+        with self.lock :
+            self.seq+=1
+            pickle.dump(('result',self.seq,key,kind,payload),self.f,protocol=pickle.HIGHEST_PROTOCOL)
+            return self.seq
+
+    def chunk(self,seq:int,description:typing.Optional[list],data:typing.Union[list,bytes]) :
+        self.write(('chunk',seq,description,data))
+
+    def chunk_size(self,key:str,size:int)->int :
+        self.meta['chunk_sizes'][key]=size
+        return size
+
+    def flatnodes(self,locations) :
+        return RecordingFlatNodes(locations,self)
+
+    def finish(self,completed:bool) :
+        with self.lock :
+            self.f.close()
+        self.meta['completed']=completed
+        with open(os.path.join(self.directory,META_FILE),'w') as f :
+            json.dump(self.meta,f,indent=1)
+
+    def cursor_factory(self,base:type)->type :
+        recorder=self
+        class RecordingCursor(base) :
+            def execute(self,query,params=None) :
+                key=query_key(query,params)
+                try :
+                    result=super().execute(query,params)
+                except psycopg2.Error as e :
+                    recorder.result(key,'error',(e.pgcode,str(e)))
+                    raise
+                if self.name is not None :
+                    self.recording_seq=recorder.result(key,'stream',None)
+                elif self.description is None :
+                    recorder.result(key,'none',self.rowcount)
+                else :
+                    rows=super().fetchall()
+                    if len(rows)>0 :
+                        self.scroll(0,mode='absolute')
+                    recorder.result(key,'rows',(columns(self.description),rows))
+                return result
+
+            def fetchmany(self,size=None) :
+                rows=super().fetchmany(size) if size is not None else super().fetchmany()
+                if self.name is not None and len(rows)>0 :
+                    recorder.chunk(self.recording_seq,columns(self.description),rows)
+                return rows
+
+            def copy_expert(self,sql,file,size=8192) :
+                key=query_key(sql,None)
+                if hasattr(file,'read') :
+                    # COPY FROM STDIN
+                    try :
+                        result=super().copy_expert(sql,file,size)
+                    except psycopg2.Error as e :
+                        recorder.result(key,'error',(e.pgcode,str(e)))
+                        raise
+                    recorder.result(key,'none',self.rowcount)
+                    return result
+                tee=RecordingFile(file,recorder,key)
+                try :
+                    result=super().copy_expert(sql,tee,size)
+                except psycopg2.Error as e :
+                    if tee.seq is None :
+                        recorder.result(key,'error',(e.pgcode,str(e)))
+                    else :
+                        tee.flush_recording()
+                    raise
+                tee.close()
+                return result
+        return RecordingCursor
+
+class RecordingFile :
+    """ Passes the output of a COPY TO STDOUT on to f, recording it in chunks
+    """
+    def __init__(self,f:typing.BinaryIO,recorder:Recorder,key:tuple,chunk_size=1<<20) :
+        self.f=f
+        self.recorder=recorder
+        self.key=key
+        self.chunk_size=chunk_size
+        self.seq=None #registered with the first write
+        self.buf=[]
+        self.buf_len=0
+
+    def write(self,data:typing.Union[bytes,memoryview]) :
+        if self.seq is None :
+            self.seq=self.recorder.result(self.key,'copy',None)
+        data=bytes(data)
+        self.buf.append(data)
+        self.buf_len+=len(data)
+        if self.buf_len>=self.chunk_size :
+            self.flush_recording()
+        return self.f.write(data)
+
+    def flush_recording(self) :
+        if self.buf_len>0 :
+            self.recorder.chunk(self.seq,None,b''.join(self.buf))
+        self.buf=[]
+        self.buf_len=0
+
+    def close(self) :
+        if self.seq is None :
+            # no output at all
+            self.seq=self.recorder.result(self.key,'copy',None)
+        self.flush_recording()
+
+    def __getattr__(self,name:str) :
+        return getattr(self.f,name)
+
+class RecordingFlatNodes :
+    def __init__(self,locations,recorder:Recorder) :
+        self.locations=locations
+        self.recorder=recorder
+
+    def get_latlon_str(self,osm_ids:typing.Collection[int])->typing.Iterator[typing.Tuple[str,str,str]] :
+        batch=[]
+        for location in self.locations.get_latlon_str(osm_ids) :
+            batch.append(location)
+            yield location
+        self.recorder.write(('locations',batch))
+
+class Result :
+    def __init__(self,kind:str,payload:typing.Any) :
+        self.kind=kind
+        self.description=None
+        self.rows=[]
+        self.chunks=[]
+        self.rowcount=-1
+        self.error=None
+        if kind=='rows' :
+            self.description,self.rows=payload
+            self.rowcount=len(self.rows)
+        elif kind=='none' :
+            self.rowcount=payload
+        elif kind=='error' :
+            self.error=payload
+
+    def add_chunk(self,description:typing.Optional[list],data:typing.Union[list,bytes]) :
+        if self.kind=='copy' :
+            self.chunks.append(data)
+            return
+        if description is not None :
+            self.description=description
+        self.rows.extend(data)
+
+    def exception(self)->psycopg2.Error :
+        pgcode,message=self.error
+        if pgcode is not None :
+            try :
+                return psycopg2.errors.lookup(pgcode)(message)
+            except KeyError :
+                pass
+        return psycopg2.Error(message)
+
+class Replayer :
+    """ Loads a recording entirely. .connection() stands in for psycopg2.connect(),
+    .flatnodes() for flatnodes.FlatNodes
+    """
+    def __init__(self,directory:str) :
+        meta_file=os.path.join(directory,META_FILE)
+        if not os.path.exists(meta_file) :
+            raise BaseException(f'Not a --record directory, or the recording did not finish: {directory}')
+        with open(meta_file) as f :
+            self.meta=json.load(f)
+        self.lock=threading.Lock()
+        # statement key -> its results in the order they were recorded
+        self.results={}
+        self.locations={}
+        by_seq={}
+        with gzip.open(os.path.join(directory,RECORDING_FILE),'rb') as f :
+            while True :
+                try :
+                    record=pickle.load(f)
+                except EOFError :
+                    break
+                if record[0]=='result' :
+                    _,seq,key,kind,payload=record
+                    by_seq[seq]=Result(kind,payload)
+                    self.results.setdefault(key,collections.deque()).append(by_seq[seq])
+                elif record[0]=='chunk' :
+                    _,seq,description,data=record
+                    by_seq[seq].add_chunk(description,data)
+                else :
+                    for osm_id,lat,lon in record[1] :
+                        self.locations[int(osm_id)]=(lat,lon)
+        self.last={}
+
+    def check_settings(self,s) :
+        different=[k for k,v in self.meta['settings'].items() if getattr(s,k,None)!=v]
+        if len(different)>0 :
+            raise BaseException('--replay needs the same options as the recording, different: '
+                +', '.join(f'{k} (recorded {self.meta["settings"][k]!r})' for k in different))
+        if not self.meta['completed'] :
+            log.l.log_start('WARNING: the recorded run did not complete, the replay may stop early')
+
+    def next_result(self,key:tuple)->Result :
+        ''' The results of a statement come in the order they were recorded, the last
+        one again if it runs more often than recorded
+        '''
+        with self.lock :
+            results=self.results.get(key)
+            if results is not None and len(results)>0 :
+                self.last[key]=results.popleft()
+            elif key not in self.last :
+                raise ReplayError(f'statement not in the recording: {key[0]} {key[1]}')
+            return self.last[key]
+
+    def chunk_size(self,key:str,size:int)->int :
+        return self.meta['chunk_sizes'].get(key,size)
+
+    def connection(self)->'ReplayConnection' :
+        return ReplayConnection(self)
+
+    def flatnodes(self)->'ReplayFlatNodes' :
+        return ReplayFlatNodes(self.locations)
+
+    def finish(self,completed:bool) :
+        pass
+
+class ReplayError(Exception) :
+    pass
+
+class ReplayConnection :
+    """ The parts of a psycopg2 connection that are used
+    """
+    def __init__(self,replayer:Replayer) :
+        self.replayer=replayer
+        self.dsn='replay'
+        self.cursor_factory=None
+        self.autocommit=False
+        self.closed=0
+
+    def cursor(self,name:typing.Optional[str]=None,**kwargs)->'ReplayCursor' :
+        return ReplayCursor(self,name)
+
+    def set_session(self,**kwargs) :
+        pass
+
+    def commit(self) :
+        pass
+
+    def rollback(self) :
+        pass
+
+    def close(self) :
+        self.closed=1
+
+class ReplayCursor :
+    """ The parts of a psycopg2 cursor that are used, serving recorded results
+    """
+    def __init__(self,connection:ReplayConnection,name:typing.Optional[str]) :
+        self.connection=connection
+        self.name=name
+        self.description=None
+        self.rowcount=-1
+        self.itersize=2000
+        self.arraysize=1
+        self.rows=[]
+        self.pos=0
+
+    def result(self,key:tuple)->Result :
+        result=self.connection.replayer.next_result(key)
+        if result.kind=='error' :
+            raise result.exception()
+        return result
+
+    def execute(self,query,params=None) :
+        result=self.result(query_key(query,params))
+        self.description=result.description
+        self.rowcount=result.rowcount
+        self.rows=result.rows
+        self.pos=0
+
+    def copy_expert(self,sql,file,size=8192) :
+        result=self.result(query_key(sql,None))
+        self.rowcount=result.rowcount
+        for data in result.chunks :
+            for i in range(0,len(data),size) :
+                file.write(data[i:i+size])
+
+    def fetchone(self)->typing.Optional[tuple] :
+        if self.pos>=len(self.rows) :
+            return None
+        self.pos+=1
+        return self.rows[self.pos-1]
+
+    def fetchmany(self,size=None)->list :
+        size=self.arraysize if size is None else size
+        rows=self.rows[self.pos:self.pos+size]
+        self.pos+=len(rows)
+        return rows
+
+    def fetchall(self)->list :
+        rows=self.rows[self.pos:]
+        self.pos=len(self.rows)
+        return rows
+
+    def __iter__(self) :
+        while self.pos<len(self.rows) :
+            self.pos+=1
+            yield self.rows[self.pos-1]
+
+    def close(self) :
+        self.rows=[]
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self,*args) :
+        self.close()
+
+class ReplayFlatNodes :
+    def __init__(self,locations:dict) :
+        self.locations=locations
+
+    def get_latlon_str(self,osm_ids:typing.Collection[int])->typing.Iterator[typing.Tuple[str,str,str]] :
+        ''' Like flatnodes.FlatNodes.get_latlon_str(): sorted, unknown ids skipped
+        '''
+        for osm_id in sorted(int(i) for i in osm_ids) :
+            location=self.locations.get(osm_id)
+            if location is not None :
+                yield (str(osm_id),*location)
@@ -9,7 +9,12 @@ import sys #maybe move all to log.py
 
 from . import pgsql2osm
 from . import dbutils
+from . import flatnodes
+from . import probe
 from . import log
+from . import metrics
+from . import memprofile
+from . import replay
 from . import __metadata__
 
 
@@ -24,18 +29,132 @@ class Settings :
         self.bounds_rel_id=args.bounds_rel_id
         self.bounds_iso=args.bounds_iso
         self.bounds_box=args.bounds_box
+        #batch mode: several iso codes, one output each
+        self.regions=None
+        if self.bounds_iso is not None and ',' in self.bounds_iso :
+            self.regions=[iso.strip() for iso in self.bounds_iso.split(',') if iso.strip()!='']
+        elif args.regions_file is not None :
+            self.regions=dbutils.read_regions_file(args.regions_file)
+        if self.regions is not None :
+            self.bounds_iso=None
+
+        self.partitions=args.partitions
+
+        self.manifest=args.manifest
+        self.since=args.since
+        if (self.manifest or self.since is not None) and (args.concurrent_write or args.checkpoint_dir is not None) :
+            raise BaseException('--manifest and --since are not supported with --concurrent-write or --checkpoint')
+        if self.manifest and args.out_file=='-' :
+            raise BaseException('--manifest is written next to the output, which can not be stdout')
 
         self.get_lonlat_binary=args.get_lonlat_binary
         self.nodes_file=args.nodes_file
+        self.record_dir=args.record_dir
+        self.replay_dir=args.replay_dir
+        if self.record_dir is not None and self.replay_dir is not None :
+            raise BaseException('--record and --replay can not be used together')
+        if self.nodes_file is None and self.replay_dir is None :
+            raise BaseException('The nodes_file is needed, unless with --replay')
+
+        self.stage_ids=args.stage_ids
+        self.binary_copy=args.binary_copy
+        self.itersize=args.itersize
+        self.prepare=args.prepare
+        self.jobs=args.jobs
+        self.probe_only=args.probe_only
+        self.chunk_target_ms=args.chunk_target_ms
+        #None: don't remember chunk sizes between runs
+        self.chunk_cache=args.chunk_cache if args.chunk_cache!='' else None
+        self.concurrent_write=args.concurrent_write
+        self.sorted=args.sorted
+        self.sort_memory=args.sort_memory
+        self.checkpoint_dir=args.checkpoint_dir
+        self.resume=args.resume
+        if self.resume and self.checkpoint_dir is None :
+            raise BaseException('--resume needs the --checkpoint directory to resume from')
 
         #can either be a file-obj or a filename:str
         self.out_file=sys.stdout.buffer if args.out_file=='-' else args.out_file
+        self.check_regions()
+        #None: guess from out_file
+        self.out_format=args.out_format
+        #None: one thread per cpu
+        self.compress_threads=args.compress_threads
         
-        self.access=psycopg2.connect(args.postgres_dsn)
+        self.postgres_dsn=args.postgres_dsn
+        self.access=None
+        self.open_replay()
+        if self.access is None :
+            self.access=psycopg2.connect(self.postgres_dsn)
+        self.metrics_file=args.metrics_file
+        self.setup_metrics()
+        #None, '-' for stderr, or a json filename
+        self.profile_memory=args.profile_memory
+        self.tracemalloc_top=args.tracemalloc_top
+        self.setup_memory_profiler()
+        self.setup_recording()
 
         self.has_suggested_out_filename=False #only print suggestion once
         self.connect_and_check()
 
+    def check_regions(self) :
+        """ Batch mode (self.regions) writes one output per region, named from the
+        out_file template, and supports fewer options
+        """
+        if self.regions is None :
+            return
+        if not isinstance(self.out_file,str) or ('{iso}' not in self.out_file and '{name}' not in self.out_file) :
+            raise BaseException('With several regions, --output needs to be a filename with an {iso} or {name} placeholder')
+        if self.checkpoint_dir is not None or self.concurrent_write or self.manifest or self.since is not None :
+            raise BaseException('--checkpoint, --concurrent-write, --manifest and --since are not supported with several regions')
+        if self.partitions>1 :
+            raise BaseException('--partitions is not supported with several regions')
+
+    def open_replay(self) :
+        """ With a replay_dir, load the recording: it stands in for the database
+        as self.access. Before setup_metrics()
+        """
+        self.replayer=None
+        if self.replay_dir is None :
+            return
+        self.replayer=replay.Replayer(self.replay_dir)
+        self.access=self.replayer.connection()
+
+    def setup_metrics(self) :
+        """ With a metrics_file, collect metrics of all queries and phases into
+        self.metrics. Before any cursor is opened on self.access
+        """
+        self.metrics=None
+        if self.metrics_file is None :
+            return
+        self.metrics=metrics.Metrics()
+        log.l.phase_listeners.append(self.metrics.phase)
+        self.access.cursor_factory=self.metrics.cursor_class
+
+    def setup_memory_profiler(self) :
+        self.memory_profiler=None
+        if self.profile_memory is None :
+            return
+        self.memory_profiler=memprofile.MemoryProfiler(self.tracemalloc_top)
+        log.l.phase_listeners.append(self.memory_profiler.phase)
+
+    def setup_recording(self) :
+        """ self.recording: the replay.Replayer of open_replay(), or with a record_dir a
+        replay.Recorder of everything executed on self.access and new_connection()s.
+        After setup_metrics(), before any cursor is opened on self.access
+        """
+        self.recording=self.replayer
+        if self.replayer is not None :
+            self.replayer.check_settings(self)
+        elif self.record_dir is not None :
+            self.recording=replay.Recorder(self.record_dir,self,self.access.cursor_factory)
+            self.access.cursor_factory=self.recording.cursor_class
+        else :
+            return
+        replay.force_single_job(self)
+        # the locations are recorded from the nodes file read in-process
+        self.get_lonlat_binary=None
+
     def connect_and_check(self) :
         #use one cursor for everything
         self.c=self.access.cursor()
@@ -84,9 +203,56 @@ class Settings :
             assert len(t_schema)==2, 'Could not decide which middle db schema is used'
 
         log.l.log_start('INFO: detected middle database layout = '+('new jsonb' if self.new_jsonb_schema else 'legacy text[]'))
+        # which indexes exist, and which queries can use them
+        self.strategy=probe.probe(self)
+        for line in self.strategy.summary() :
+            log.l.log_start(line)
         asyncio.run(self.test())
 
 
+    def new_connection(self)->psycopg2.extensions.connection :
+        """ Open another connection to the same database, for queries that need to
+        run while self.access is busy. Without a postgres_dsn (ModuleSettings with only
+        an access), reuse the dsn of access: its password is not available.
+        """
+        if self.replayer is not None :
+            return self.replayer.connection()
+        conn=psycopg2.connect(self.postgres_dsn if self.postgres_dsn is not None else self.access.dsn)
+        if self.metrics is not None :
+            conn.cursor_factory=self.metrics.cursor_class
+        if self.recording is not None :
+            # also wraps the metrics one
+            conn.cursor_factory=self.recording.cursor_class
+        return conn
+
+    def bounds_extent(self)->typing.Tuple[float,float,float,float] :
+        """ Bounding box of the boundary as (lon_from,lat_from,lon_to,lat_to), intersected
+        with the bbox if both are given. See make_bounds_constr()
+        """
+        geom=None
+        if self.bounds_geojson!=None :
+            with open(self.bounds_geojson,'r') as f :
+                geojson=f.read().strip()
+            geom=f"ST_GeomFromGeoJSON('{geojson}'::jsonb)"
+        elif self.bounds_rel_id!=None or self.bounds_iso!=None :
+            osm_rel_id=self.bounds_rel_id if self.bounds_rel_id!=None else int(dbutils.regions_lookup(self.bounds_iso)[1])
+            relbound_way_col=self.tables['_polygon']['geom']
+            relbound_name=self.tables['_polygon']['name']
+            geom=f'(SELECT {relbound_way_col} FROM {relbound_name} WHERE osm_id={-osm_rel_id})'
+        box=None
+        if self.bounds_box!=None :
+            box=tuple(map(float,self.bounds_box.split(',')))
+        if geom==None :
+            assert box!=None, 'no boundary provided'
+            return box
+        self.c.execute(f'''SELECT ST_XMin(e),ST_YMin(e),ST_XMax(e),ST_YMax(e)
+            FROM (SELECT ST_Extent(ST_Transform({geom},4326)) AS e) AS extent;''')
+        extent=self.c.fetchone()
+        assert extent[0]!=None, 'boundary is empty'
+        if box!=None :
+            extent=(max(extent[0],box[0]),max(extent[1],box[1]),min(extent[2],box[2]),min(extent[3],box[3]))
+        return extent
+
     def make_bounds_constr(self,table_key:str)->typing.Collection[str] :
         """ Lookup the table_key in self.tables and return the
         "ST_Intersects(way, ST_MakeEnvelope(x1,y2,x2,y2))" part of a query for the specific
@@ -149,23 +315,46 @@ class Settings :
         """ Handle all the asyncio stuff for stream_osm_xml(), only returns when
         everything is finished. Can be run multiple times
         """
+        if self.probe_only :
+            print(self.strategy.report(),file=sys.stderr)
+            return
+        completed=False
         try :
             t=asyncio.run(pgsql2osm.stream_osm_xml(self))
+            completed=True
         except ZeroDivisionError :
             print('\nError: boundary is empty or database has no data within',file=sys.stderr)
+        finally :
+            if self.metrics is not None :
+                self.metrics.save(self.metrics_file,completed)
+            if self.memory_profiler is not None :
+                self.memory_profiler.finish()
+                self.memory_profiler.save(self.profile_memory)
+            if self.recording is not None :
+                self.recording.finish(completed)
         sys.stderr.flush()
 
     async def test(self) :
         """ Test: checks if get_lonlat exsits, is executable.
             And the get_lonlat execution will crash if planet.bin.nodes is
             not readwrite or does not exist.
+            Without get_lonlat, open the nodes_file in-process (readonly is enough).
         """
-        if not os.path.exists(self.get_lonlat_binary) :
+        if self.replayer is not None :
+            # the locations were recorded, the nodes_file is not needed
+            self.flatnodes=self.replayer.flatnodes()
+        elif self.get_lonlat_binary is None :
+            if not os.path.exists(self.nodes_file) :
+                raise BaseException(f'Did not find nodes_file at {self.nodes_file}')
+            self.flatnodes=flatnodes.FlatNodes(self.nodes_file)
+            if self.recording is not None :
+                self.flatnodes=self.recording.flatnodes(self.flatnodes)
+        elif not os.path.exists(self.get_lonlat_binary) :
             raise BaseException(f'Did not find get_lonlat_binary at {self.get_lonlat_binary}')
         #check that user=execute bit is set
         elif not ((os.stat(self.get_lonlat_binary).st_mode>>6)%8)%2==1 :
             raise BaseException(f'Seems not executable: get_lonlat_binary, please run "chmod +x {self.get_lonlat_binary}"')
-        if not os.path.exists(self.nodes_file) :
+        elif not os.path.exists(self.nodes_file) :
             raise BaseException(f'Did not find nodes_file at {self.nodes_file}')
 
         result=[]
@@ -178,6 +367,10 @@ class ModuleSettings(Settings) :
     """ Pass the stream_osm_xml() a ModuleSettings if you directly want to
     give python objects instead of using the CLI and argparse
         * supported feature: 'out_file' can be any open file python object
+        * with a 'metrics_file', 'profile_memory' or 'record_dir', run .main() (or call
+          .metrics.save(), .memory_profiler.finish() and .save(), .recording.finish()
+          after stream_osm_xml())
+        * with a 'replay_dir', 'access' and 'nodes_file' are not needed
     WARNING: danger zone, requirement is not checked! if you forget to set some
     settings value, this script may crash just before the end!
     """
@@ -188,6 +381,14 @@ class ModuleSettings(Settings) :
                 'bounds_rel_id':None,'bounds_iso':None,'bounds_box':None,
                 'get_lonlat_binary':None,'nodes_file':None,'out_file':None,
                 'access':None,'postgres_dsn':None,'has_suggested_out_filename':False,
+                'stage_ids':False,'binary_copy':False,'itersize':50_000,'prepare':True,'jobs':1,
+                'concurrent_write':False,'sorted':False,'sort_memory':1024,
+                'checkpoint_dir':None,'resume':False,'regions':None,
+                'partitions':1,'manifest':False,'since':None,
+                'chunk_target_ms':250,'chunk_cache':None,'probe_only':False,
+                'metrics_file':None,'profile_memory':None,'tracemalloc_top':0,
+                'record_dir':None,'replay_dir':None,
+                'out_format':None,'compress_threads':None,
         }
         for k,v in kwargs.items() :
             if k in keys :
@@ -195,4 +396,9 @@ class ModuleSettings(Settings) :
         for k,v in keys.items() :
             if not hasattr(self,k) :
                 setattr(self,k,v)
+        self.check_regions()
+        self.open_replay()
+        self.setup_metrics()
+        self.setup_memory_profiler()
+        self.setup_recording()
         self.connect_and_check()
@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+
+import re
+import shutil
+import decimal
+import struct
+import typing
+import zlib
+
+from . import compress
+
+"""
+Output writers: the create_* generators yield OsmElement objects, and a writer
+serializes them to s.out_file. XmlWriter produces the same bytes lxml's
+ET.xmlfile did, without building an element tree for every osm element.
+PbfWriter writes the .osm.pbf format instead.
+"""
+
+class OsmElement :
+    """ One osm element to be written, lightweight replacement for an ET.Element.
+    name is 'node', 'way', 'relation' (or 'debug'), attrs its xml attributes.
+    nds are the way's node refs, members the relation's (type,ref,role) tuples
+    with type one of 'node','way','relation', and tags (key,value) tuples.
+    """
+    __slots__=('name','attrs','nds','members','tags')
+    def __init__(self,name:str,attrs:dict,nds:typing.Collection=(),
+            members:typing.Collection[tuple]=(),tags:typing.Collection[tuple]=()) :
+        self.name=name
+        self.attrs=attrs
+        self.nds=nds
+        self.members=members
+        self.tags=tags
+
+# all characters that need escaping in attribute values, and those not allowed in xml 1.0
+special_chars=re.compile('[&<>"\n\r\t\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+invalid_chars=re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+escapes={'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;','\n':'&#10;','\r':'&#13;','\t':'&#9;'}
+
+def escape_attr(value:str)->str :
+    """ Escape value like lxml does for attributes, and like lxml raise a ValueError
+    on characters that can not appear in xml.
+    """
+    if special_chars.search(value) is None :
+        return value #fast path: nothing to do for most values
+    if invalid_chars.search(value) is not None :
+        raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+    return special_chars.sub(lambda m:escapes[m.group()],value)
+
+def element_to_str(el:OsmElement)->str :
+    """ Serialize el the same as lxml serializes the equivalent ET.Element, with
+    children in order: nd, member, tag.
+    """
+    parts=['<',el.name]
+    for k,v in el.attrs.items() :
+        parts.append(f' {k}="{escape_attr(str(v))}"')
+    if not (el.nds or el.members or el.tags) :
+        parts.append('/>')
+        return ''.join(parts)
+    parts.append('>')
+    for ref in el.nds :
+        parts.append(f'<nd ref="{escape_attr(str(ref))}"/>')
+    for osm_type,ref,role in el.members :
+        parts.append(f'<member type="{osm_type}" ref="{escape_attr(str(ref))}" role="{escape_attr(str(role))}"/>')
+    for k,v in el.tags :
+        parts.append(f'<tag k="{escape_attr(str(k))}" v="{escape_attr(str(v))}"/>')
+    parts.append(f'</{el.name}>')
+    return ''.join(parts)
+
+class XmlWriter :
+    """ Context manager writing an .osm xml document to out_file, which can be either
+    a filename:str or an open binary file object. Elements are serialized into a
+    buffer, which is encoded and written out every flush_size characters.
+    With fragment=True, only the elements are written, without the declaration and
+    root element: a segment to be spliced into another writer with .write_segment().
+    With append=True, out_file already has the beginning of the document: only the
+    root element is closed at the end.
+    Usage:
+        with XmlWriter(out_file,{'version':'0.6'}) as w :
+            w.write(el)
+    """
+    def __init__(self,out_file:typing.Union[str,typing.BinaryIO],root_attrs:dict,
+            root_name='osm',flush_size=1<<20,fragment=False,append=False) :
+        self.out_file=out_file
+        self.root_attrs=root_attrs
+        self.root_name=root_name
+        self.flush_size=flush_size
+        self.fragment=fragment
+        self.append=append
+        self.buf=[]
+        self.buf_len=0
+
+    def __enter__(self) :
+        self.opened=isinstance(self.out_file,str)
+        self.f=open(self.out_file,'wb') if self.opened else self.out_file
+        if not (self.fragment or self.append) :
+            root=''.join(f' {k}="{escape_attr(str(v))}"' for k,v in self.root_attrs.items())
+            self.write_str(f"<?xml version='1.0' encoding='utf-8'?>\n<{self.root_name}{root}>")
+        return self
+
+    def write_str(self,data:str) :
+        self.buf.append(data)
+        self.buf_len+=len(data)
+        if self.buf_len>=self.flush_size :
+            self.flush()
+
+    def write(self,el:OsmElement) :
+        self.write_str(element_to_str(el))
+
+    def write_segment(self,segment:typing.BinaryIO) :
+        """ Copy the output of a fragment=True XmlWriter, from its current position
+        """
+        self.flush()
+        shutil.copyfileobj(segment,self.f,1<<20)
+
+    def flush(self) :
+        if self.buf_len>0 :
+            self.f.write(''.join(self.buf).encode('utf-8'))
+        self.buf=[]
+        self.buf_len=0
+
+    def __exit__(self,exc_type,exc_value,traceback) :
+        if exc_type is None and not self.fragment :
+            self.write_str(f'</{self.root_name}>')
+        self.flush()
+        if self.opened :
+            self.f.close()
+        else :
+            self.f.flush()
+
+class OscWriter(XmlWriter) :
+    """ XmlWriter for an osmChange document: elements are written with
+    .write_action(action,el), action being 'create', 'modify' or 'delete'. Consecutive
+    elements of the same action are grouped into one action element.
+    """
+    def __init__(self,out_file:typing.Union[str,typing.BinaryIO],root_attrs:dict,**kwargs) :
+        super().__init__(out_file,root_attrs,root_name='osmChange',**kwargs)
+        self.action=None
+
+    def write_action(self,action:str,el:OsmElement) :
+        self.write_action_str(action,element_to_str(el))
+
+    def write_action_str(self,action:str,el_str:str) :
+        """ Like write_action, with el already serialized by element_to_str()
+        """
+        if action!=self.action :
+            if self.action is not None :
+                self.write_str(f'</{self.action}>')
+            self.write_str(f'<{action}>')
+            self.action=action
+        self.write_str(el_str)
+
+    def __exit__(self,exc_type,exc_value,traceback) :
+        if exc_type is None and self.action is not None :
+            self.write_str(f'</{self.action}>')
+        super().__exit__(exc_type,exc_value,traceback)
+
+"""
+PBF: see the openstreetmap wiki page PBF_Format. The file is a sequence of
+    int32 (big endian) length of BlobHeader, BlobHeader, Blob
+where the first Blob contains a HeaderBlock and all others a PrimitiveBlock.
+The protobuf messages are few and simple enough to be encoded by hand.
+"""
+
+def varint(n:int)->bytes :
+    out=bytearray()
+    while n>0x7f :
+        out.append((n&0x7f)|0x80)
+        n>>=7
+    out.append(n)
+    return bytes(out)
+
+def zigzag(n:int)->int :
+    return (n<<1)^(n>>63)
+
+def pb_varint(field:int,value:int)->bytes :
+    return varint(field<<3)+varint(value)
+
+def pb_bytes(field:int,data:bytes)->bytes :
+    return varint((field<<3)|2)+varint(len(data))+data
+
+def pb_packed(field:int,values:typing.Iterable[int])->bytes :
+    """ Packed repeated varints, values must already be zigzagged if signed
+    """
+    return pb_bytes(field,b''.join(map(varint,values)))
+
+def pb_packed_delta(field:int,values:typing.Iterable[int])->bytes :
+    """ Packed repeated sint64, delta-coded
+    """
+    deltas=[]
+    prev=0
+    for v in values :
+        deltas.append(zigzag(v-prev))
+        prev=v
+    return pb_packed(field,deltas)
+
+class StringTable :
+    """ Index 0 is reserved for the empty string (used as a delimiter in DenseNodes)
+    """
+    def __init__(self) :
+        self.index={'':0}
+        self.strings=[b'']
+    def get(self,s)->int :
+        s=str(s)
+        ix=self.index.get(s)
+        if ix is None :
+            ix=len(self.strings)
+            self.index[s]=ix
+            self.strings.append(s.encode('utf-8'))
+        return ix
+    def encode(self)->bytes :
+        return b''.join(pb_bytes(1,s) for s in self.strings)
+
+def coordinate_int(value)->int :
+    """ Degrees (str or float) to the PBF default granularity of 100 nanodegrees.
+    Round on the decimal string like osmium does when it reads .osm, so that the
+    .osm.pbf has the same coordinates as the .osm would have had.
+    """
+    value=str(value)
+    if 'e' in value or 'E' in value :
+        value=format(decimal.Decimal(value),'f')
+    negative=value.startswith('-')
+    int_part,_,frac=value.lstrip('-').partition('.')
+    result=int(int_part or '0')*10_000_000+int((frac+'0000000')[:7])
+    if len(frac)>7 and frac[7]>='5' :
+        result+=1
+    return -result if negative else result
+
+class PbfWriter :
+    """ Context manager writing an .osm.pbf to out_file, which can be either a filename:str
+    or an open binary file object. Same usage as XmlWriter.
+    Elements are grouped into blocks of at most block_size elements of a same type,
+    each zlib-compressed into its own Blob. debug elements are ignored.
+    With fragment=True or append=True the OSMHeader is not written, see XmlWriter.
+    """
+    member_types={'node':0,'way':1,'relation':2}
+
+    def __init__(self,out_file:typing.Union[str,typing.BinaryIO],root_attrs:dict,
+            block_size=8_000,max_block_bytes=8<<20,optional_features:typing.Collection[str]=(),
+            fragment=False,append=False) :
+        self.out_file=out_file
+        self.fragment=fragment
+        self.append=append
+        self.root_attrs=root_attrs
+        self.block_size=block_size
+        self.max_block_bytes=max_block_bytes
+        self.optional_features=optional_features
+        self.pending=[]
+        self.pending_name=None
+        self.pending_bytes=0
+
+    def __enter__(self) :
+        self.opened=isinstance(self.out_file,str)
+        self.f=open(self.out_file,'wb') if self.opened else self.out_file
+        if self.fragment or self.append :
+            return self
+        header=b''.join(pb_bytes(4,feature.encode()) for feature in ('OsmSchema-V0.6','DenseNodes'))
+        header+=b''.join(pb_bytes(5,feature.encode()) for feature in self.optional_features)
+        header+=pb_bytes(16,str(self.root_attrs.get('generator','')).encode())
+        if 'url' in self.root_attrs :
+            header+=pb_bytes(17,str(self.root_attrs['url']).encode())
+        self.write_blob('OSMHeader',header)
+        return self
+
+    def write_blob(self,blob_type:str,data:bytes) :
+        blob=pb_varint(2,len(data))+pb_bytes(3,zlib.compress(data))
+        blob_header=pb_bytes(1,blob_type.encode())+pb_varint(3,len(blob))
+        self.f.write(struct.pack('>I',len(blob_header))+blob_header+blob)
+
+    def write(self,el:OsmElement) :
+        if el.name not in ('node','way','relation') :
+            return
+        if el.name!=self.pending_name or len(self.pending)>=self.block_size \
+                or self.pending_bytes>=self.max_block_bytes :
+            self.flush()
+            self.pending_name=el.name
+        self.pending.append(el)
+        # rough estimate of the encoded size
+        self.pending_bytes+=16+6*(len(el.nds)+len(el.members))+16*len(el.tags)
+
+    def flush(self) :
+        if len(self.pending)==0 :
+            return
+        st=StringTable()
+        if self.pending_name=='node' :
+            group=pb_bytes(2,self.encode_dense(self.pending,st))
+        elif self.pending_name=='way' :
+            group=b''.join(pb_bytes(3,self.encode_way(el,st)) for el in self.pending)
+        else :
+            group=b''.join(pb_bytes(4,self.encode_relation(el,st)) for el in self.pending)
+        # the string table needs to be complete before it is written
+        self.write_blob('OSMData',pb_bytes(1,st.encode())+pb_bytes(2,group))
+        self.pending=[]
+        self.pending_bytes=0
+
+    def write_segment(self,segment:typing.BinaryIO) :
+        """ Copy the blobs of a fragment=True PbfWriter, from its current position
+        """
+        self.flush()
+        shutil.copyfileobj(segment,self.f,1<<20)
+
+    def encode_dense(self,nodes:typing.Collection[OsmElement],st:StringTable)->bytes :
+        keys_vals=[]
+        for el in nodes :
+            for k,v in el.tags :
+                keys_vals.append(st.get(k))
+                keys_vals.append(st.get(v))
+            keys_vals.append(0)
+        return pb_packed_delta(1,(int(el.attrs['id']) for el in nodes)) \
+            +pb_packed_delta(8,(coordinate_int(el.attrs['lat']) for el in nodes)) \
+            +pb_packed_delta(9,(coordinate_int(el.attrs['lon']) for el in nodes)) \
+            +pb_packed(10,keys_vals)
+
+    def encode_tags(self,el:OsmElement,st:StringTable)->bytes :
+        if len(el.tags)==0 :
+            return b''
+        return pb_packed(2,(st.get(k) for k,v in el.tags))+pb_packed(3,(st.get(v) for k,v in el.tags))
+
+    def encode_way(self,el:OsmElement,st:StringTable)->bytes :
+        return pb_varint(1,int(el.attrs['id']))+self.encode_tags(el,st) \
+            +pb_packed_delta(8,map(int,el.nds))
+
+    def encode_relation(self,el:OsmElement,st:StringTable)->bytes :
+        return pb_varint(1,int(el.attrs['id']))+self.encode_tags(el,st) \
+            +pb_packed(8,(st.get(role) for osm_type,ref,role in el.members)) \
+            +pb_packed_delta(9,(int(ref) for osm_type,ref,role in el.members)) \
+            +pb_packed(10,(self.member_types[osm_type] for osm_type,ref,role in el.members))
+
+    def __exit__(self,exc_type,exc_value,traceback) :
+        self.flush()
+        if self.opened :
+            self.f.close()
+        else :
+            self.f.flush()
+
+def open_writer(out_file:typing.Union[str,typing.BinaryIO],root_attrs:dict,
+        out_format:str='xml',**kwargs)->typing.Union[XmlWriter,PbfWriter] :
+    """ out_format is 'xml', 'pbf' or 'osc', see output_format()
+    """
+    if out_format=='pbf' :
+        return PbfWriter(out_file,root_attrs,**kwargs)
+    if out_format=='osc' :
+        return OscWriter(out_file,root_attrs,**kwargs)
+    return XmlWriter(out_file,root_attrs,**kwargs)
+
+def output_format(out_file:typing.Union[str,typing.BinaryIO],out_format:typing.Optional[str]=None)->str :
+    """ Explicit out_format if given, otherwise guess from the filename: .pbf -> 'pbf', else 'xml'.
+    A compression suffix is ignored: .osm.bz2 is xml.
+    """
+    if out_format is not None :
+        return out_format
+    if isinstance(out_file,str) and compress.strip_suffix(out_file).endswith('.pbf') :
+        return 'pbf'
+    return 'xml'
@@ -0,0 +1,10 @@
+import pytest
+
+from pgsql2osm import log
+
+@pytest.fixture(autouse=True)
+def muted_log() :
+    ''' log.l needs .set_phases() before logging, which only stream_osm_xml() does
+    '''
+    with log.l.mute() :
+        yield
@@ -0,0 +1,180 @@
+import array
+import pickle
+import random
+
+import pytest
+
+from pgsql2osm.pgsql2osm import ArrayAccumulator,DictAccumulator,SortedIds
+
+KEYS=('nodes','ways','done_ids')
+
+def filled(seed:int,block_size:int,count=3000,max_id=5000)->tuple :
+    ''' An ArrayAccumulator and a DictAccumulator with the same random adds
+    '''
+    r=random.Random(seed)
+    a=ArrayAccumulator(KEYS,block_size=block_size)
+    d=DictAccumulator(KEYS)
+    for i in range(count) :
+        k=r.choice(KEYS)
+        osm_id=r.randrange(1,max_id)
+        a.add(k,osm_id)
+        d.add(k,osm_id)
+    return a,d
+
+@pytest.mark.parametrize('block_size',(1,2,16,256))
+@pytest.mark.parametrize('seed',range(5))
+def test_same_as_dict(seed:int,block_size:int) :
+    a,d=filled(seed,block_size)
+    for k in KEYS :
+        assert list(a.all(k))==sorted(d.all(k))
+        assert a.len(k)==d.len(k)
+        assert [a.is_in(k,i) for i in range(6000)]==[d.is_in(k,i) for i in range(6000)]
+    assert list(a.all_subtract('nodes','ways'))==sorted(d.all_subtract('nodes','ways'))
+    assert list(a.all_subtract('nodes','done_ids'))==sorted(d.all_subtract('nodes','done_ids'))
+
+def test_add_many_and_duplicates() :
+    a=ArrayAccumulator(KEYS,block_size=4)
+    a.add_many('nodes',[5,3,5,1,3,3,9])
+    a.add('nodes',1)
+    assert list(a.all('nodes'))==[1,3,5,9]
+    assert a.len('nodes')==4
+
+@pytest.mark.parametrize('block_size',(1,2,16,256))
+@pytest.mark.parametrize('batch',(1,7,100,2000))
+def test_add_many_same_as_dict(batch:int,block_size:int) :
+    ''' Batches of random and of clustered ids, as ways_children_n() adds them
+    '''
+    r=random.Random(batch)
+    ids=[r.randrange(1,5000) for i in range(3000)]
+    for start in r.sample(range(1,10**6),100) :
+        ids.extend(range(start,start+r.randrange(1,40)))
+    a=ArrayAccumulator(KEYS,block_size=block_size)
+    d=DictAccumulator(KEYS)
+    for i in range(0,len(ids),batch) :
+        a.add_many('nodes',ids[i:i+batch])
+        d.add_many('nodes',ids[i:i+batch])
+        if i%(batch*10)==0 :
+            a.add('nodes',ids[i]+1)
+            d.add('nodes',ids[i]+1)
+    blocks=a.data['nodes'].blocks
+    assert list(a.all('nodes'))==sorted(d.all('nodes'))
+    assert a.len('nodes')==d.len('nodes')
+    assert all(len(block)<=2*block_size for block in blocks)
+    assert all(len(block)>=block_size for block in blocks[:-1])
+    assert a.data['nodes'].maxes==[block[-1] for block in blocks]
+    seq=a.sequence('nodes')
+    assert list(seq[5:1000])==sorted(d.all('nodes'))[5:1000]
+
+def test_update_count() :
+    ids=SortedIds(block_size=4)
+    assert ids.update([])==0
+    assert ids.update([5,3,5,1])==3
+    assert ids.update(range(1,20))==16
+    assert ids.update(range(1,20))==0
+    assert ids.update([100,0x7fffffffffffffff,7])==2
+    assert len(ids)==21
+
+def test_update_large_groups() :
+    ''' Many ids into one block, or past the last block, are split into blocks
+    '''
+    ids=SortedIds(block_size=16)
+    ids.update(range(10,20))
+    assert ids.update(range(1,5000,2))==len(set(range(1,5000,2))-set(range(10,20)))
+    expected=set(range(10,20))|set(range(1,5000,2))
+    assert ids.update(range(1,5000,3))==len(set(range(1,5000,3))-expected)
+    expected=sorted(expected|set(range(1,5000,3)))
+    assert list(ids)==expected
+    assert all(16<=len(block)<=32 for block in ids.blocks)
+    assert ids.maxes==[block[-1] for block in ids.blocks]
+    assert list(ids[100:200])==expected[100:200]
+
+@pytest.mark.parametrize('bad_id',(0,-1,2.5))
+def test_rejects_invalid_ids(bad_id) :
+    for acc in (ArrayAccumulator(KEYS),DictAccumulator(KEYS)) :
+        with pytest.raises(AssertionError) :
+            acc.add('nodes',bad_id)
+    a=ArrayAccumulator(KEYS)
+    a.add_many('nodes',[1,2])
+    with pytest.raises((AssertionError,TypeError)) :
+        a.add_many('nodes',[3,bad_id])
+
+def test_snapshots() :
+    ''' Iterators, sequences and copies keep the ids as they were
+    '''
+    a,d=filled(1,4)
+    before=list(a.all('ways'))
+    it=a.all('ways')
+    seq=a.sequence('ways')
+    a.copy('ways','nodes')
+    sub=a.subset(('ways',))
+    for i in range(1,6000,3) :
+        a.add('ways',i)
+    a.add_many('ways',range(2,6000,3))
+    assert list(it)==before
+    assert list(seq)==before
+    assert list(a.all('nodes'))==before
+    assert list(sub.all('ways'))==before
+    sub.add('ways',10**12)
+    assert not a.is_in('ways',10**12)
+
+def test_iterate_while_adding() :
+    a=ArrayAccumulator(KEYS,block_size=2)
+    a.add_many('ways',range(1,100,2))
+    for i in a.all('ways') :
+        a.add('ways',i+1)
+    assert list(a.all('ways'))==list(range(1,101))
+
+@pytest.mark.parametrize('block_size',(1,3,256))
+def test_slices(block_size:int) :
+    a,d=filled(2,block_size)
+    expected=sorted(d.all('nodes'))
+    seq=a.sequence('nodes')
+    assert len(seq)==len(expected)
+    for start in range(0,len(expected)+10,7) :
+        for length in (0,1,5,100) :
+            assert list(seq[start:start+length])==expected[start:start+length]
+            assert list(a.get_iter_slice('nodes',start,start+length))==expected[start:start+length]
+    assert isinstance(seq[0:10],array.array)
+
+def test_add_sorted() :
+    a,d=filled(3,4)
+    extra=array.array('q',sorted(random.Random(3).sample(range(1,9000),500)))
+    a.add_sorted('ways',extra)
+    d.add_sorted('ways',extra)
+    assert list(a.all('ways'))==sorted(d.all('ways'))
+    a.add_sorted('nodes',a.sequence('ways'))
+    d.add_sorted('nodes',d.sequence('ways'))
+    assert list(a.all('nodes'))==sorted(d.all('nodes'))
+
+def test_load_sorted() :
+    a=ArrayAccumulator(KEYS,block_size=4)
+    extra=array.array('q',sorted(random.Random(3).sample(range(1,9000),500)))
+    a.load_sorted('done_ids',extra)
+    assert list(a.all('done_ids'))==list(extra)
+    assert a.is_in('done_ids',extra[100])
+    a.load_sorted('done_ids',iter([2,4,6]))
+    assert list(a.all('done_ids'))==[2,4,6]
+
+def test_clear() :
+    a,d=filled(4,4)
+    a.clear('nodes')
+    assert a.len('nodes')==0
+    assert list(a.all('nodes'))==[]
+    assert not a.is_in('nodes',1)
+
+def test_sequence_pickles() :
+    ''' partition_worker() returns sequences across processes
+    '''
+    a,d=filled(5,4)
+    seq=pickle.loads(pickle.dumps(a.sequence('nodes')))
+    assert list(seq)==sorted(d.all('nodes'))
+
+def test_sorted_ids_blocks() :
+    ids=SortedIds(block_size=4)
+    for i in range(100,0,-1) :
+        assert ids.add(i)
+    assert not ids.add(50)
+    assert list(ids)==list(range(1,101))
+    assert all(4<=len(block)<=8 for block in ids.blocks)
+    assert ids.maxes==[block[-1] for block in ids.blocks]
+    assert 0 not in ids and 101 not in ids and 50 in ids
@@ -0,0 +1,153 @@
+import collections
+import decimal
+import struct
+
+import pytest
+
+from pgsql2osm import binarycopy
+
+Column=collections.namedtuple('Column',('name','type_code'))
+HSTORE_OID=16500
+INT8_ARRAY_OID=1016
+TEXT_ARRAY_OID=1009
+
+def field(data)->bytes :
+    if data is None :
+        return struct.pack('>i',-1)
+    return struct.pack('>i',len(data))+data
+
+def encode_hstore(d:dict)->bytes :
+    out=[struct.pack('>i',len(d))]
+    for k,v in d.items() :
+        out.append(field(k.encode()))
+        out.append(field(None if v is None else v.encode()))
+    return b''.join(out)
+
+def encode_array(element_oid:int,dims:list,elements:list,encode)->bytes :
+    out=[struct.pack('>iiI',len(dims),int(None in elements),element_oid)]
+    for dim in dims :
+        out.append(struct.pack('>ii',dim,1))
+    for el in elements :
+        out.append(field(None if el is None else encode(el)))
+    return b''.join(out)
+
+def encode_numeric(digits:list,weight:int,sign:int,dscale:int)->bytes :
+    return struct.pack(f'>hhHh{len(digits)}H',len(digits),weight,sign,dscale,*digits)
+
+def test_scalars() :
+    ''' The same python values as psycopg2 parses from the text output
+    '''
+    d=binarycopy.scalar_decoders
+    assert d[16](b'\x01') is True and d[16](b'\x00') is False
+    assert d[20](struct.pack('>q',-(1<<40)))==-(1<<40)
+    assert d[21](struct.pack('>h',-7))==-7
+    assert d[23](struct.pack('>i',123456))==123456
+    assert d[25]('äöü'.encode())=='äöü'
+    assert d[701](struct.pack('>d',0.1))==0.1
+    assert d[114](b'{"a": [1, 2]}')=={'a':[1,2]}
+    assert d[3802](b'\x01{"name": "x"}')=={'name':'x'}
+
+@pytest.mark.parametrize('value',(0.1,1.5,-3.25,1e-07,3.4e+38,0.0,123456.79))
+def test_float4_shortest(value:float) :
+    ''' PostgreSQL prints float4 0.1 as 0.1, not 0.10000000149011612
+    '''
+    assert binarycopy.decode_float4(struct.pack('>f',value))==value
+
+@pytest.mark.parametrize('data,text',(
+    (encode_numeric([123,4500],0,0,4),'123.4500'),
+    (encode_numeric([10],-1,0x4000,3),'-0.001'),
+    (encode_numeric([],0,0,0),'0'),
+    (encode_numeric([],0,0,2),'0.00'),
+    (encode_numeric([1],2,0,0),'100000000'),
+    (encode_numeric([12,3456,7800],1,0,2),'123456.78'),
+))
+def test_numeric(data:bytes,text:str) :
+    value=binarycopy.decode_numeric(data)
+    assert value==decimal.Decimal(text)
+    assert str(value)==text
+
+def test_numeric_nan() :
+    assert binarycopy.decode_numeric(encode_numeric([],0,0xC000,0)).is_nan()
+
+def test_hstore() :
+    d={'name':'Zürich','empty':'','null':None}
+    assert binarycopy.decode_hstore(encode_hstore(d))==d
+    assert binarycopy.decode_hstore(encode_hstore({}))=={}
+
+def test_arrays() :
+    int8=lambda i:struct.pack('>q',i)
+    data=encode_array(20,[4],[1,-2,None,1<<50],int8)
+    assert binarycopy.decode_array(data,binarycopy.scalar_decoders)==[1,-2,None,1<<50]
+    data=encode_array(20,[2,3],[1,2,3,4,5,6],int8)
+    assert binarycopy.decode_array(data,binarycopy.scalar_decoders)==[[1,2,3],[4,5,6]]
+    data=encode_array(25,[3],['w1','outer',''],str.encode)
+    assert binarycopy.decode_array(data,binarycopy.scalar_decoders)==['w1','outer','']
+    assert binarycopy.decode_array(struct.pack('>iiI',0,0,20),binarycopy.scalar_decoders)==[]
+
+def copy_stream(rows:list,encoders:list)->bytes :
+    out=[binarycopy.SIGNATURE,struct.pack('>ii',0,4),b'ext!']
+    for row in rows :
+        out.append(struct.pack('>h',len(row)))
+        for value,encode in zip(row,encoders) :
+            out.append(field(None if value is None else encode(value)))
+    out.append(struct.pack('>h',-1))
+    return b''.join(out)
+
+class FakeConnection :
+    pass
+
+class FakeCursor :
+    ''' Answers the LIMIT 0 query, the pg_type lookup and the COPY of g_copy_binary()
+    '''
+    def __init__(self,description:list,stream:bytes,types:list) :
+        self.connection=FakeConnection()
+        self.columns=description
+        self.stream=stream
+        self.types=types
+        self.description=None
+        self.executed=[]
+        self.rows=[]
+
+    def execute(self,query,params=None) :
+        self.executed.append(query)
+        if 'pg_type' in query :
+            self.rows=[t for t in self.types if t[0] in params[0]]
+        else :
+            self.description=self.columns
+
+    def fetchall(self) :
+        return self.rows
+
+    def copy_expert(self,sql,file,size=8192) :
+        self.executed.append(sql)
+        # like psycopg2, many small writes that do not follow the row boundaries
+        for i in range(0,len(self.stream),7) :
+            file.write(self.stream[i:i+7])
+
+def test_g_copy_binary() :
+    ''' Same dicts as g_from_cursor() on the text output: NULL columns are left out
+    '''
+    description=[Column('id',20),Column('tags',HSTORE_OID),Column('nodes',INT8_ARRAY_OID),Column('name',25)]
+    rows=[(i,{'k':str(i)} if i%3 else None,list(range(i,i+i%5)),'x'*(i%50) if i%7 else None) for i in range(1,20_000)]
+    int8=lambda i:struct.pack('>q',i)
+    stream=copy_stream(rows,[int8,encode_hstore,lambda l:encode_array(20,[len(l)],l,int8) if l else struct.pack('>iiI',0,0,20),str.encode])
+    c=FakeCursor(description,stream,[(HSTORE_OID,'hstore',0),(INT8_ARRAY_OID,'_int8',20)])
+    expected=[{k:v for k,v in zip(('id','tags','nodes','name'),row) if v is not None} for row in rows]
+    assert list(binarycopy.g_copy_binary(c,'SELECT * FROM t WHERE id IN (1,2)'))==expected
+
+def test_descriptions_cached_per_template() :
+    ''' One LIMIT 0 query and one pg_type lookup per template, not per batch
+    '''
+    description=[Column('id',20),Column('tags',HSTORE_OID)]
+    stream=copy_stream([(1,{'a':'b'})],[lambda i:struct.pack('>q',i),encode_hstore])
+    c=FakeCursor(description,stream,[(HSTORE_OID,'hstore',0)])
+    for batch in range(3) :
+        assert list(binarycopy.g_copy_binary(c,f'SELECT * FROM t WHERE id IN ({batch})',
+            template='SELECT * FROM t WHERE id'))==[{'id':1,'tags':{'a':'b'}}]
+    assert sum('LIMIT 0' in q for q in c.executed)==1
+    assert sum('pg_type' in q for q in c.executed)==1
+    assert sum(q.startswith('COPY') for q in c.executed)==3
+
+def test_unsupported_type() :
+    c=FakeCursor([Column('geom',17000)],b'',[(17000,'geometry',0)])
+    assert binarycopy.get_decoders(c,c.columns) is None
@@ -0,0 +1,106 @@
+import array
+import io
+import os
+import random
+import types
+
+import pytest
+
+from pgsql2osm import checkpoint
+from pgsql2osm import writers
+from pgsql2osm.pgsql2osm import ArrayAccumulator
+
+KEYS=('nodes','nodes_within','ways','rels','done_ids')
+
+def fake_settings(**kwargs)->types.SimpleNamespace :
+    s={k:None for k in checkpoint.SETTINGS_KEYS}
+    s.update(sorted=False,out_file='out.osm')
+    s.update(kwargs)
+    return types.SimpleNamespace(**s)
+
+def accumulator(seed:int)->ArrayAccumulator :
+    r=random.Random(seed)
+    a=ArrayAccumulator(KEYS,block_size=8)
+    for k in checkpoint.ACCUMULATOR_KEYS :
+        a.add_many(k,(r.randrange(1,1<<40) for i in range(300)))
+    return a
+
+@pytest.mark.parametrize('ids',([],[1],[1,2,3,1000],[5,(1<<62)+7],list(range(1,100_000,13))))
+def test_ids_round_trip(ids:list) :
+    data=checkpoint.encode_ids(array.array('q',ids))
+    assert list(checkpoint.decode_ids(data))==ids
+
+def test_encode_accepts_sequences() :
+    ''' ArrayAccumulator.sequence() is not an array.array
+    '''
+    a=accumulator(0)
+    assert list(checkpoint.decode_ids(checkpoint.encode_ids(a.sequence('nodes'))))==list(a.all('nodes'))
+
+def test_subtract_sorted() :
+    r=random.Random(1)
+    ids=sorted(r.sample(range(1,10_000),2000))
+    remove=sorted(r.sample(range(1,10_000),2000))
+    result=checkpoint.subtract_sorted(array.array('q',ids),array.array('q',remove))
+    assert list(result)==sorted(set(ids)-set(remove))
+    assert list(checkpoint.subtract_sorted(array.array('q',ids),array.array('q')))==ids
+
+def test_save_and_load_phase(tmp_path) :
+    s=fake_settings()
+    a=accumulator(2)
+    cp=checkpoint.Checkpoint(s,str(tmp_path))
+    cp.save_phase('within',a)
+    cp.save_phase('children',a)
+    # only the files of the last generation are kept
+    assert sorted(os.listdir(tmp_path))==sorted(['state.json']+[f'{k}.1.ids' for k in checkpoint.ACCUMULATOR_KEYS])
+
+    b=ArrayAccumulator(KEYS)
+    assert checkpoint.Checkpoint(s,str(tmp_path)).load(b)=='children'
+    for k in checkpoint.ACCUMULATOR_KEYS :
+        assert list(b.all(k))==list(a.all(k))
+    assert b.len('done_ids')==0
+
+def test_load_without_checkpoint(tmp_path) :
+    assert checkpoint.Checkpoint(fake_settings(),str(tmp_path)).load(ArrayAccumulator(KEYS)) is None
+
+def test_load_other_settings(tmp_path) :
+    checkpoint.Checkpoint(fake_settings(),str(tmp_path)).save_phase('within',accumulator(3))
+    with pytest.raises(BaseException,match='other settings') :
+        checkpoint.Checkpoint(fake_settings(bounds_iso='li'),str(tmp_path)).load(ArrayAccumulator(KEYS))
+
+class Flushable :
+    def flush(self) :
+        pass
+
+def test_resume_write_phase(tmp_path) :
+    ''' Elements written before the last save are removed from the accumulator,
+    and the output resumes at the offset of that save
+    '''
+    s=fake_settings()
+    a=accumulator(4)
+    cp=checkpoint.Checkpoint(s,str(tmp_path),interval_s=3600)
+    cp.save_phase('parents',a)
+    out_f=io.BytesIO()
+    written={k:list(a.all(k))[:50] for k in ('nodes','ways','rels')}
+    for name,k in checkpoint.ELEMENT_KEYS.items() :
+        for osm_id in reversed(written[k]) :
+            cp.before_write(writers.OsmElement(name,{'id':str(osm_id)}),Flushable(),out_f)
+            out_f.write(b'x'*10)
+    cp.before_write(writers.OsmElement('debug',{}),Flushable(),out_f)
+    cp.save_write(Flushable(),out_f)
+    # written after the save: still to do when resuming
+    cp.before_write(writers.OsmElement('node',{'id':str(list(a.all('nodes'))[60])}),Flushable(),out_f)
+
+    b=ArrayAccumulator(KEYS)
+    resumed=checkpoint.Checkpoint(s,str(tmp_path))
+    assert resumed.load(b)=='parents'
+    assert resumed.output_offset()==len(out_f.getvalue())
+    for k in ('nodes','ways','rels') :
+        assert list(b.all(k))==[i for i in a.all(k) if i not in written[k]]
+    assert list(b.all('nodes_within'))==list(a.all('nodes_within'))
+
+def test_save_done(tmp_path) :
+    s=fake_settings()
+    cp=checkpoint.Checkpoint(s,str(tmp_path))
+    cp.save_phase('parents',accumulator(5))
+    cp.save_done()
+    assert checkpoint.Checkpoint(s,str(tmp_path)).load(ArrayAccumulator(KEYS))=='write'
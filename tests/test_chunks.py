@@ -0,0 +1,136 @@
+import json
+
+import psycopg2
+import pytest
+
+from pgsql2osm import dbutils
+from pgsql2osm import pgsql2osm as p2o
+
+def test_growth() :
+    ''' Multiplicative growth far below target, additive close to it
+    '''
+    c=dbutils.ChunkController(size=100,target_s=1)
+    assert c.update(0.1)==126
+    assert c.update(0.49)==158
+    assert c.update(0.5)==165
+    assert c.update(1)==173
+    assert c.update(0.9)==181
+    c.size=10
+    assert c.update(0.6)==11 #at least 1
+
+def test_shrink() :
+    c=dbutils.ChunkController(size=1000,target_s=1)
+    assert c.update(1.125)==800
+    # never below half, even when far over target
+    assert c.update(100)==400
+    assert c.canceled()==200
+
+def test_bounds() :
+    c=dbutils.ChunkController(size=90,target_s=1,min_size=5,max_size=100)
+    assert c.update(0)==100
+    assert c.update(0)==100
+    for i in range(10) :
+        c.update(10)
+    assert c.size==5
+    assert c.canceled()==5
+
+def test_converges() :
+    ''' Queries taking 10ms per id: the size settles just under target_s/10ms
+    '''
+    c=dbutils.ChunkController(size=1,target_s=0.25)
+    sizes=[c.update(c.size*0.01) for i in range(200)]
+    assert all(22<=size<=26 for size in sizes[-100:])
+    # only just over target before it shrinks again
+    assert max(sizes[-100:])*0.01<=0.25*1.05
+
+class FakeClock :
+    def __init__(self) :
+        self.now=0.0
+    def time(self) :
+        return self.now
+
+class FakeConnection :
+    def __init__(self) :
+        self.rollbacks=0
+    def rollback(self) :
+        self.rollbacks+=1
+
+class FakeCursor :
+    ''' Each query takes s_per_id per id of its array parameter, and is canceled
+    once over the statement_timeout
+    '''
+    def __init__(self,clock,s_per_id) :
+        self.clock=clock
+        self.s_per_id=s_per_id
+        self.connection=FakeConnection()
+        self.timeout_ms=None
+        self.timeouts=[]
+        self.chunks=[]
+        self.rowcount=0
+    def execute(self,query,params=None) :
+        if query.startswith('SET statement_timeout=') :
+            self.timeout_ms=query[len('SET statement_timeout='):-1]
+            self.timeouts.append(self.timeout_ms)
+            return
+        elapsed=len(params[0])*self.s_per_id
+        timeout_s=int(self.timeout_ms)/1000 if self.timeout_ms.isdigit() else float('inf')
+        if 0<timeout_s<elapsed :
+            self.clock.now+=timeout_s
+            raise psycopg2.errors.QueryCanceled()
+        self.clock.now+=elapsed
+        self.chunks.append(len(params[0]))
+    def __iter__(self) :
+        return iter(())
+
+def run(monkeypatch,s_per_id,size,n=1000) :
+    clock=FakeClock()
+    monkeypatch.setattr(p2o.time,'time',clock.time)
+    a=p2o.DictAccumulator(('nodes',))
+    a.add_many('nodes',range(1,n+1))
+    c=FakeCursor(clock,s_per_id)
+    controller=dbutils.ChunkController(size=size,target_s=0.25)
+    results=list(a.g_adaptive_parent_multiquery('nodes',c,[('SELECT $1',('bigint[]',))],
+        [[lambda chunk:chunk]],controller=controller,prepare=False))
+    return c,controller,results
+
+def test_multiquery(monkeypatch) :
+    c,controller,results=run(monkeypatch,0.001,50)
+    assert sum(count for count,rows in results)==1000
+    assert c.chunks[:4]==[50,63,79,99]
+    assert sum(c.chunks)==1000
+    assert c.connection.rollbacks==0
+    assert c.timeouts==['2500',"'2h'"]
+
+def test_statement_timeout(monkeypatch) :
+    ''' A chunk over the 2.5s statement_timeout is canceled and retried halved
+    '''
+    c,controller,results=run(monkeypatch,0.01,1000)
+    assert c.connection.rollbacks==2
+    assert c.chunks[0]==250
+    assert sum(c.chunks)==1000
+    assert sum(count for count,rows in results)==1000
+    assert c.timeouts[:3]==['2500','2500','2500']
+
+def test_statement_timeout_min_size(monkeypatch) :
+    ''' At min_size, the timeout is lifted instead of retrying forever
+    '''
+    c,controller,results=run(monkeypatch,10,1,n=3)
+    assert c.chunks==[1,1,1]
+    assert c.timeouts==['2500','0',"'2h'"]
+
+def test_save_load(tmp_path) :
+    filename=str(tmp_path/'cache'/'chunks.json')
+    assert dbutils.load_chunk_sizes(filename)=={}
+    assert dbutils.load_chunk_sizes(None)=={}
+    dbutils.save_chunk_sizes(filename,{'a':10,'b':20})
+    dbutils.save_chunk_sizes(filename,{'b':30,'c':40})
+    assert dbutils.load_chunk_sizes(filename)=={'a':10,'b':30,'c':40}
+    assert [p.name for p in (tmp_path/'cache').iterdir()]==['chunks.json']
+    dbutils.save_chunk_sizes(None,{'a':1})
+
+def test_load_corrupt(tmp_path) :
+    filename=tmp_path/'chunks.json'
+    filename.write_text('{"a":')
+    assert dbutils.load_chunk_sizes(str(filename))=={}
+    dbutils.save_chunk_sizes(str(filename),{'a':1})
+    assert json.loads(filename.read_text())=={'a':1}
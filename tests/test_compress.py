@@ -0,0 +1,78 @@
+import bz2
+import gzip
+import io
+import os
+import random
+
+import pytest
+
+from pgsql2osm import compress
+
+def payload(size:int)->bytes :
+    r=random.Random(size)
+    words=[b'<node id="%d"/>\n' % r.randrange(1<<40) for i in range(size//20+1)]
+    return b''.join(words)[:size]
+
+@pytest.mark.parametrize('suffix,decompress',(('.bz2',bz2.decompress),('.gz',gzip.decompress)))
+@pytest.mark.parametrize('threads',(1,4))
+def test_parallel_compressor_round_trip(suffix:str,decompress,threads:int) :
+    ''' The concatenated streams of the blocks decompress to what was written, in order
+    '''
+    data=payload(300_000)
+    out=io.BytesIO()
+    c=compress.ParallelCompressor(out,compress.codecs[suffix],threads=threads,block_size=10_000)
+    r=random.Random(threads)
+    pos=0
+    while pos<len(data) :
+        size=r.randrange(1,30_000)
+        assert c.write(data[pos:pos+size])==len(data[pos:pos+size])
+        pos+=size
+    c.flush()
+    assert decompress(out.getvalue())==data
+    c.pool.shutdown()
+
+def test_zstd_round_trip() :
+    zstandard=pytest.importorskip('zstandard')
+    data=payload(100_000)
+    out=io.BytesIO()
+    c=compress.ParallelCompressor(out,compress.codecs['.zst'],threads=2,block_size=8192)
+    c.write(data)
+    c.flush()
+    reader=zstandard.ZstdDecompressor().stream_reader(io.BytesIO(out.getvalue()),read_across_frames=True)
+    decompressed=reader.read()
+    assert decompressed==data
+    c.pool.shutdown()
+
+def test_flush_ends_a_stream() :
+    ''' After flush(), tell() is where a resumed output can append more streams
+    '''
+    out=io.BytesIO()
+    c=compress.ParallelCompressor(out,compress.codecs['.gz'],threads=2,block_size=1000)
+    c.write(b'a'*2500)
+    c.flush()
+    offset=c.tell()
+    assert gzip.decompress(out.getvalue()[:offset])==b'a'*2500
+    c.write(b'b'*10)
+    c.flush()
+    assert gzip.decompress(out.getvalue())==b'a'*2500+b'b'*10
+    c.pool.shutdown()
+
+def test_suffixes() :
+    assert compress.codec_suffix('France.osm.bz2')=='.bz2'
+    assert compress.codec_suffix('France.osm.pbf') is None
+    assert compress.strip_suffix('France.osm.gz')=='France.osm'
+    assert compress.strip_suffix('France.osm')=='France.osm'
+
+def test_open_output(tmp_path) :
+    filename=str(tmp_path/'out.osm.gz')
+    with compress.open_output(filename,threads=2) as f :
+        f.write(b'hello ')
+    with compress.open_output(filename,threads=2,offset=os.path.getsize(filename)) as f :
+        f.write(b'world')
+    with gzip.open(filename) as f :
+        assert f.read()==b'hello world'
+    # already open files are used as-is, and not closed
+    out=io.BytesIO()
+    with compress.open_output(out) as f :
+        f.write(b'x')
+    assert not out.closed and out.getvalue()==b'x'
@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+from pgsql2osm import extsort
+
+@pytest.mark.parametrize('max_bytes',(1,100,10_000,1<<30))
+def test_same_as_sorted(max_bytes:int,tmp_path) :
+    ''' Whether everything stays in memory or every item is spilled in its own run
+    '''
+    r=random.Random(max_bytes)
+    items=[(r.randrange(1000),f'payload {i}') for i in range(5000)]
+    sorter=extsort.ExternalSorter(key=lambda item:item[0],max_bytes=max_bytes,
+        size=lambda item:len(item[1]),tmp_dir=str(tmp_path))
+    for item in items :
+        sorter.add(item)
+    if max_bytes<=100 :
+        assert len(sorter.runs)>1
+    result=list(sorter.g_sorted())
+    assert [item[0] for item in result]==sorted(item[0] for item in items)
+    assert sorted(result)==sorted(items)
+    assert sorter.runs==[]
+
+def test_stable_within_runs() :
+    ''' Equal keys keep their insertion order inside each run, like sorted()
+    '''
+    items=[(i%3,i) for i in range(30)]
+    sorter=extsort.ExternalSorter(key=lambda item:item[0],max_bytes=1<<20,size=lambda item:16)
+    for item in items :
+        sorter.add(item)
+    assert list(sorter.g_sorted())==sorted(items,key=lambda item:item[0])
+
+def test_empty() :
+    sorter=extsort.ExternalSorter(key=lambda item:item,max_bytes=10,size=lambda item:1)
+    assert list(sorter.g_sorted())==[]
+
+def test_runs_closed_when_stopped_early(tmp_path) :
+    sorter=extsort.ExternalSorter(key=lambda item:item,max_bytes=10,size=lambda item:1,tmp_dir=str(tmp_path))
+    for i in range(100,0,-1) :
+        sorter.add(i)
+    runs=list(sorter.runs)
+    g=sorter.g_sorted()
+    assert [next(g) for i in range(3)]==[1,2,3]
+    g.close()
+    assert all(run.closed for run in runs)
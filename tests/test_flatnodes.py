@@ -0,0 +1,71 @@
+import array
+import re
+
+import pytest
+
+from pgsql2osm import flatnodes
+
+UNDEFINED=2**31-1
+
+def write_flatnodes(path,locations:dict,size:int) :
+    ''' A DenseFileArray of size ids, locations {id:(x,y)}
+    '''
+    coords=array.array('i',[UNDEFINED])*(2*size)
+    for osm_id,(x,y) in locations.items() :
+        coords[2*osm_id]=x
+        coords[2*osm_id+1]=y
+    with open(path,'wb') as f :
+        coords.tofile(f)
+
+@pytest.mark.parametrize('value,expected',[
+    (0,'0'),(465_000_000,'46.5'),(-62_500_000,'-6.25'),(1,'0.0000001'),(-1,'-0.0000001'),
+    (1_800_000_000,'180'),(-900_000_000,'-90'),(123_456_789,'12.3456789'),(-10_000_010,'-1.000001')])
+def test_coordinate_str(value,expected) :
+    assert flatnodes.coordinate_str(value)==expected
+
+def test_same_as_osmium(tmp_path) :
+    osmium=pytest.importorskip('osmium')
+    values=[0,1,-1,10,-10_000_000,465_000_000,-62_500_000,1_800_000_000,-1_799_999_999,123_456_789]
+    locations=[osmium.osm.Location(v/1e7,-v/2e7) for v in values]
+    path=str(tmp_path/'nodes.osm')
+    with osmium.SimpleWriter(path) as w :
+        for i,location in enumerate(locations) :
+            w.add_node(osmium.osm.mutable.Node(id=i+1,location=location))
+    with open(path) as f :
+        written=re.findall(r'lat="([^"]*)" lon="([^"]*)"',f.read())
+    assert written==[(flatnodes.coordinate_str(l.y),flatnodes.coordinate_str(l.x)) for l in locations]
+
+def test_get_latlon_str(tmp_path) :
+    path=str(tmp_path/'nodes.bin')
+    write_flatnodes(path,{1:(-62_500_000,465_000_000),2:(0,0),5:(1_800_000_000,-900_000_000),
+        6:(-1,-1),7:(1_800_000_001,0)},8)
+    nodes=flatnodes.FlatNodes(path)
+    try :
+        assert nodes.max_id==7
+        # sorted, undefined (3), out of range (7) and past the end of the file (8) skipped
+        assert list(nodes.get_latlon_str([8,6,5,3,2,1,0,-1,7,1_000_000]))==[('1','46.5','-6.25'),
+            ('2','0','0'),('5','-90','180'),('6','-0.0000001','-0.0000001')]
+        assert list(nodes.get_latlon_str(['5']))==[('5','-90','180')]
+        assert list(nodes.get_latlon_str([]))==[]
+    finally :
+        nodes.close()
+
+def test_truncated_file(tmp_path) :
+    ''' A trailing partial location is ignored
+    '''
+    path=tmp_path/'nodes.bin'
+    write_flatnodes(str(path),{1:(10,20)},2)
+    with open(path,'ab') as f :
+        f.write(b'\x00\x00\x00')
+    nodes=flatnodes.FlatNodes(str(path))
+    try :
+        assert nodes.max_id==1
+        assert list(nodes.get_latlon_str([1,2]))==[('1','0.000002','0.000001')]
+    finally :
+        nodes.close()
+
+def test_empty_file(tmp_path) :
+    path=tmp_path/'nodes.bin'
+    path.write_bytes(b'')
+    with pytest.raises(BaseException,match='too small') :
+        flatnodes.FlatNodes(str(path))
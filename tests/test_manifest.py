@@ -0,0 +1,117 @@
+import io
+import json
+
+import pytest
+
+from pgsql2osm import manifest
+from pgsql2osm import writers
+from pgsql2osm.pgsql2osm import write_tracked
+
+def element(osm_type:str,osm_id:int,**tags)->writers.OsmElement :
+    return writers.OsmElement(osm_type,{'id':str(osm_id)},tags=tuple(tags.items()))
+
+def el_hash(el:writers.OsmElement)->int :
+    return manifest.element_hash(writers.element_to_str(el))
+
+def save(filename:str,elements:list,version=0) :
+    w=manifest.ManifestWriter(version)
+    for el in elements :
+        w.add(el,el_hash(el))
+    w.save(filename,{'generator':'test','at_time':'2024-01-01_00:00:00'})
+
+OLD=[element('node',1),element('node',5,name='a'),element('node',9),
+    element('way',3,highway='path'),element('way',4),
+    element('relation',2,type='route'),element('relation',7)]
+
+@pytest.mark.parametrize('order',('sorted','unsorted'))
+def test_actions(tmp_path,order:str) :
+    filename=str(tmp_path/'old.manifest')
+    # without --sorted the elements come in any order within each type
+    save(filename,OLD if order=='sorted' else OLD[::-1])
+    m=manifest.Manifest(filename)
+    assert m.header['generator']=='test'
+    new=[element('node',1),element('node',5,name='b'),element('node',6),
+        element('way',4),element('relation',7,type='multipolygon')]
+    assert [m.action(el,el_hash(el)) for el in new]==[None,'modify','create',None,'modify']
+    assert [(el.name,el.attrs['id']) for el in m.g_deleted()]==[('relation',2),('way',3),('node',9)]
+
+def test_version(tmp_path) :
+    ''' Each osmChange gets the version of its manifest plus one, deletes included
+    '''
+    filename=str(tmp_path/'old.manifest')
+    save(filename,OLD)
+    assert manifest.Manifest(filename).change_version==1
+    save(filename,OLD,version=3)
+    m=manifest.Manifest(filename)
+    assert m.change_version==4
+    assert {el.attrs['version'] for el in m.g_deleted()}=={4}
+
+def test_older_manifest(tmp_path) :
+    ''' Manifests without a version in their header
+    '''
+    filename=tmp_path/'old.manifest'
+    save(str(filename),OLD)
+    data=filename.read_bytes().split(b'\n',2)
+    header=json.loads(data[1])
+    del header['version']
+    filename.write_bytes(b'\n'.join((data[0],json.dumps(header).encode(),data[2])))
+    assert manifest.Manifest(str(filename)).change_version==1
+
+def test_element_hash() :
+    assert el_hash(element('node',1,name='a'))==el_hash(element('node',1,name='a'))
+    assert el_hash(element('node',1,name='a'))!=el_hash(element('node',1,name='b'))
+
+def test_not_a_manifest(tmp_path) :
+    filename=tmp_path/'other'
+    filename.write_bytes(b'<osm>\n')
+    with pytest.raises(BaseException,match='Not a pgsql2osm manifest') :
+        manifest.Manifest(str(filename))
+
+def test_empty(tmp_path) :
+    filename=str(tmp_path/'empty.manifest')
+    save(filename,[])
+    m=manifest.Manifest(filename)
+    assert m.action(element('way',1),0)=='create'
+    assert list(m.g_deleted())==[]
+
+def test_apply_changes(tmp_path) :
+    ''' The osmChange of write_tracked() applies to the extract with osmium, twice
+    '''
+    osmium=pytest.importorskip('osmium')
+    def node(osm_id:int,lat:str,**tags) :
+        return writers.OsmElement('node',{'id':str(osm_id),'lat':lat,'lon':'1'},tags=tuple(tags.items()))
+    def extract(filename:str,elements:list,since:str=None)->str :
+        ''' Write elements like stream_osm_xml() does, return the output file
+        '''
+        m=None if since is None else manifest.Manifest(since)
+        out_file=str(tmp_path/filename)
+        w=manifest.ManifestWriter(0 if m is None else m.change_version)
+        writer=writers.XmlWriter if m is None else writers.OscWriter
+        with writer(out_file,{'version':'0.6'}) as out :
+            for el in elements :
+                write_tracked(el,out,w,m)
+            if m is not None :
+                for el in m.g_deleted() :
+                    out.write_action('delete',el)
+        w.save(out_file+'.manifest',{})
+        return out_file
+    def apply(base:str,*changes:str)->dict :
+        r=osmium.MergeInputReader()
+        for filename in (base,*changes) :
+            r.add_file(filename)
+        nodes={}
+        class Handler(osmium.SimpleHandler) :
+            def node(self,n) :
+                if not n.deleted :
+                    nodes[n.id]=(n.location.lat,dict(n.tags))
+        r.apply(Handler(),simplify=True)
+        return nodes
+    base=extract('base.osm',[node(1,'1'),node(2,'2'),node(3,'3')])
+    change1=extract('change1.osc',[node(1,'1'),node(2,'5',name='a'),node(4,'4')],since=base+'.manifest')
+    with open(change1) as f :
+        assert f.read().count('version="1"')==3
+    assert apply(base,change1)=={1:(1.0,{}),2:(5.0,{'name':'a'}),4:(4.0,{})}
+    change2=extract('change2.osc',[node(2,'5',name='b'),node(4,'4')],since=change1+'.manifest')
+    with open(change2) as f :
+        assert f.read().count('version="2"')==2
+    assert apply(base,change1,change2)=={2:(5.0,{'name':'b'}),4:(4.0,{})}
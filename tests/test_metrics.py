@@ -0,0 +1,53 @@
+import time
+
+from pgsql2osm import memprofile
+from pgsql2osm import metrics
+
+class FakeSampler(metrics.RssSampler) :
+    ''' Samples from a list instead of the process, and no thread
+    '''
+    def __init__(self,values) :
+        super().__init__(interval_s=60)
+        self.values=iter(values)
+    def add_listener(self,f) :
+        with self.lock :
+            self.listeners.append(f)
+    def sample(self) :
+        rss=next(self.values)
+        for f in list(self.listeners) :
+            f(rss)
+        return rss
+
+def test_one_thread() :
+    ''' --metrics and --profile-memory share one sampling thread, stopped with the last listener
+    '''
+    sampler=metrics.RssSampler(interval_s=0.01)
+    m=metrics.Metrics(sampler)
+    thread=sampler.thread
+    p=memprofile.MemoryProfiler(sampler=sampler)
+    assert sampler.thread is thread and thread.is_alive()
+    time.sleep(0.05)
+    m.sampler.remove_listener(m.rss)
+    assert sampler.thread is thread and thread.is_alive()
+    p.finish()
+    assert sampler.thread is None and not thread.is_alive()
+    assert m.current.peak_rss>0
+    assert p.phases[0]['peak_rss_bytes']>0
+
+def test_phase_peaks(tmp_path) :
+    ''' Both listeners see all the samples, including those the other one takes
+    '''
+    sampler=FakeSampler([100,300,200,150,500,400,450,50])
+    m=metrics.Metrics(sampler) #100
+    p=memprofile.MemoryProfiler(sampler=sampler)
+    sampler.sample() #300
+    m.phase('one') #200
+    p.phase('one') #150
+    sampler.sample() #500
+    m.phase('two') #400
+    p.phase('two') #450
+    m.save(str(tmp_path/'metrics.json'),True) #50
+    assert [phase.peak_rss for phase in m.phases]==[300,500,450]
+    assert [record['peak_rss_bytes'] for record in p.phases]==[300,500]
+    assert [record['end_rss_bytes'] for record in p.phases]==[150,450]
+    assert sampler.listeners==[p.rss]
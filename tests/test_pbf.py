@@ -0,0 +1,180 @@
+import io
+import struct
+import zlib
+
+import pytest
+
+from pgsql2osm import writers
+from pgsql2osm.writers import OsmElement
+
+def read_varint(data:bytes,pos:int) :
+    result=shift=0
+    while True :
+        b=data[pos]
+        pos+=1
+        result|=(b&0x7f)<<shift
+        shift+=7
+        if b<0x80 :
+            return result,pos
+
+def fields(data:bytes)->dict :
+    ''' Decode one protobuf message to {field:[values]}, with bytes for length-delimited fields
+    '''
+    out={}
+    pos=0
+    while pos<len(data) :
+        key,pos=read_varint(data,pos)
+        if key&7==0 :
+            value,pos=read_varint(data,pos)
+        elif key&7==2 :
+            length,pos=read_varint(data,pos)
+            value=data[pos:pos+length]
+            pos+=length
+        else :
+            raise ValueError(f'unexpected wire type {key&7}')
+        out.setdefault(key>>3,[]).append(value)
+    return out
+
+def packed(data:bytes)->list :
+    values=[]
+    pos=0
+    while pos<len(data) :
+        value,pos=read_varint(data,pos)
+        values.append(value)
+    return values
+
+def unzigzag(n:int)->int :
+    return (n>>1)^-(n&1)
+
+def undelta(values:list)->list :
+    out=[]
+    prev=0
+    for v in values :
+        prev+=unzigzag(v)
+        out.append(prev)
+    return out
+
+def read_blobs(data:bytes)->list :
+    ''' [(blob type,decompressed data)] of a .osm.pbf
+    '''
+    blobs=[]
+    pos=0
+    while pos<len(data) :
+        (header_len,)=struct.unpack('>I',data[pos:pos+4])
+        header=fields(data[pos+4:pos+4+header_len])
+        pos+=4+header_len
+        blob=fields(data[pos:pos+header[3][0]])
+        pos+=header[3][0]
+        raw=zlib.decompress(blob[3][0])
+        assert len(raw)==blob[2][0]
+        blobs.append((header[1][0].decode(),raw))
+    return blobs
+
+def write_pbf(elements,**kwargs)->bytes :
+    f=io.BytesIO()
+    with writers.PbfWriter(f,{'generator':'test'},**kwargs) as w :
+        for el in elements :
+            w.write(el)
+    return f.getvalue()
+
+def primitive_groups(data:bytes) :
+    ''' Yield (string table,PrimitiveGroup fields) of each OSMData blob
+    '''
+    for blob_type,raw in read_blobs(data) :
+        if blob_type=='OSMData' :
+            block=fields(raw)
+            yield fields(block[1][0]).get(1,[]),fields(block[2][0])
+
+@pytest.mark.parametrize('n',[0,1,127,128,300,2**31,2**63-1])
+def test_varint(n) :
+    assert read_varint(writers.varint(n),0)==(n,len(writers.varint(n)))
+
+def test_varint_bytes() :
+    assert writers.varint(0)==b'\x00'
+    assert writers.varint(300)==b'\xac\x02'
+
+@pytest.mark.parametrize('n',[0,1,-1,2,-2,2**31,-2**31,2**63-1,-2**63])
+def test_zigzag(n) :
+    z=writers.zigzag(n)
+    assert 0<=z<2**64
+    assert unzigzag(z)==n
+
+def test_zigzag_values() :
+    assert [writers.zigzag(n) for n in (0,-1,1,-2,2)]==[0,1,2,3,4]
+
+@pytest.mark.parametrize('value,expected',[
+    ('46.5',465_000_000),('-6.25',-62_500_000),('0',0),('180',1_800_000_000),
+    ('-0.00000004',0),('-0.00000005',-1),('1.00000005',10_000_001),('1.00000004999',10_000_000),
+    ('1e-7',1),('-1.5E-6',-15),(12.3456789,123_456_789),('.5',5_000_000)])
+def test_coordinate_int(value,expected) :
+    assert writers.coordinate_int(value)==expected
+
+def test_header() :
+    (blob_type,raw),=read_blobs(write_pbf([]))
+    assert blob_type=='OSMHeader'
+    header=fields(raw)
+    assert header[4]==[b'OsmSchema-V0.6',b'DenseNodes']
+    assert header[16]==[b'test']
+
+def test_dense_nodes() :
+    nodes=[OsmElement('node',{'id':'10','lat':'46.5','lon':'-6.25'},tags=[('name','A'),('note','')]),
+        OsmElement('node',{'id':'7','lat':'-90','lon':'180'}),
+        OsmElement('node',{'id':str(2**40),'lat':'0.0000001','lon':'-0.0000001'},tags=[('name','B')])]
+    (strings,group),=primitive_groups(write_pbf(nodes))
+    assert strings[0]==b''
+    dense=fields(group[2][0])
+    assert undelta(packed(dense[1][0]))==[10,7,2**40]
+    assert undelta(packed(dense[8][0]))==[465_000_000,-900_000_000,1]
+    assert undelta(packed(dense[9][0]))==[-62_500_000,1_800_000_000,-1]
+    keys_vals=[strings[ix] for ix in packed(dense[10][0])]
+    # the empty tag value is string 0, same as the delimiter
+    assert keys_vals==[b'name',b'A',b'note',b'',b'',b'',b'name',b'B',b'']
+
+def test_way() :
+    way=OsmElement('way',{'id':'5'},nds=[3,1,2**35],tags=[('highway','path'),('name','Genève')])
+    (strings,group),=primitive_groups(write_pbf([way]))
+    (way_fields,)=map(fields,group[3])
+    assert way_fields[1]==[5]
+    assert [strings[ix] for ix in packed(way_fields[2][0])]==[b'highway',b'name']
+    assert [strings[ix] for ix in packed(way_fields[3][0])]==[b'path','Genève'.encode()]
+    assert undelta(packed(way_fields[8][0]))==[3,1,2**35]
+
+def test_relation() :
+    rel=OsmElement('relation',{'id':'9'},members=[('way',5,'outer'),('node',3,''),('relation',1,'sub')])
+    (strings,group),=primitive_groups(write_pbf([rel]))
+    (rel_fields,)=map(fields,group[4])
+    assert rel_fields[1]==[9]
+    assert 2 not in rel_fields
+    assert [strings[ix] for ix in packed(rel_fields[8][0])]==[b'outer',b'',b'sub']
+    assert undelta(packed(rel_fields[9][0]))==[5,3,1]
+    assert packed(rel_fields[10][0])==[1,0,2]
+
+def test_blocks() :
+    ''' A new block on every type change and every block_size elements, debug ignored
+    '''
+    elements=[OsmElement('node',{'id':str(i),'lat':'0','lon':'0'}) for i in range(1,6)] \
+        +[OsmElement('debug',{})]+[OsmElement('way',{'id':'1'},nds=[1,2])]
+    groups=[group for strings,group in primitive_groups(write_pbf(elements,block_size=2))]
+    assert [sorted(group) for group in groups]==[[2],[2],[2],[3]]
+
+def test_fragment() :
+    assert write_pbf([],fragment=True)==b''
+
+def test_osmium(tmp_path) :
+    osmium=pytest.importorskip('osmium')
+    path=str(tmp_path/'out.osm.pbf')
+    with writers.PbfWriter(path,{'generator':'test'}) as w :
+        w.write(OsmElement('node',{'id':'1','lat':'-33.8688197','lon':'151.2092955'},tags=[('name','Sydney'),('x','')]))
+        w.write(OsmElement('way',{'id':'2'},nds=[1,1],tags=[('area','no')]))
+        w.write(OsmElement('relation',{'id':'3'},members=[('way',2,'outer'),('node',1,'')]))
+    nodes,ways,rels=[],[],[]
+    for obj in osmium.FileProcessor(path) :
+        if obj.is_node() :
+            nodes.append((obj.id,str(obj.location.lat),str(obj.location.lon),dict(obj.tags)))
+        elif obj.is_way() :
+            ways.append((obj.id,[n.ref for n in obj.nodes],dict(obj.tags)))
+        else :
+            rels.append((obj.id,[(m.type,m.ref,m.role) for m in obj.members]))
+    assert nodes==[(1,'-33.8688197','151.2092955',{'name':'Sydney','x':''})]
+    assert ways==[(2,[1,1],{'area':'no'})]
+    assert rels==[(3,[('w',2,'outer'),('n',1,'')])]
@@ -0,0 +1,82 @@
+import gc
+
+import pytest
+
+from pgsql2osm import dbutils
+from pgsql2osm import metrics
+
+class FakeConnection :
+    pass
+
+class FakeCursor :
+    ''' Records the executed (query,params)
+    '''
+    def __init__(self,connection) :
+        self.connection=connection
+        self.executed=[]
+    def execute(self,query,params=None) :
+        self.executed.append((query,params))
+
+def test_inline() :
+    p=dbutils.PreparedStatements()
+    c=FakeCursor(FakeConnection())
+    p.execute(c,"SELECT * FROM t WHERE id=ANY($1) AND name LIKE 'a%' AND x>$2 OR y<$2;",
+        ('bigint[]','int'),([1,2],3),prepare=False)
+    assert c.executed==[("SELECT * FROM t WHERE id=ANY(%s::bigint[]) AND name LIKE 'a%%' "
+        "AND x>%s::int OR y<%s::int;",([1,2],3,3))]
+    assert p.names=={}
+
+def test_prepare_once_per_connection() :
+    p=dbutils.PreparedStatements()
+    conn1,conn2=FakeConnection(),FakeConnection()
+    c1,c2=FakeCursor(conn1),FakeCursor(conn1)
+    p.execute(c1,'SELECT * FROM t WHERE id=ANY($1)',('bigint[]',),([1,2],))
+    p.execute(c2,'SELECT * FROM t WHERE id=ANY($1);',('bigint[]',),([3],))
+    assert c1.executed==[('PREPARE pgsql2osm_prepared_0 (bigint[]) AS SELECT * FROM t WHERE id=ANY($1);',None),
+        ('EXECUTE pgsql2osm_prepared_0 (%s);',([1,2],))]
+    # another cursor of the same connection: already prepared
+    assert c2.executed==[('EXECUTE pgsql2osm_prepared_0 (%s);',([3],))]
+    c3=FakeCursor(conn2)
+    p.execute(c3,'SELECT * FROM t WHERE id=ANY($1)',('bigint[]',),([4],))
+    assert [q for q,params in c3.executed]==['PREPARE pgsql2osm_prepared_0 (bigint[]) AS SELECT * FROM t WHERE id=ANY($1);',
+        'EXECUTE pgsql2osm_prepared_0 (%s);']
+
+def test_names() :
+    ''' One name per (template,types), the same on all connections
+    '''
+    p=dbutils.PreparedStatements()
+    c=FakeCursor(FakeConnection())
+    p.execute(c,'SELECT $1',('int',),(1,))
+    p.execute(c,'SELECT $1',('bigint',),(1,))
+    p.execute(c,'SELECT $1, $2',('int','int'),(1,2))
+    assert p.names=={('SELECT $1',('int',)):'pgsql2osm_prepared_0',('SELECT $1',('bigint',)):'pgsql2osm_prepared_1',
+        ('SELECT $1, $2',('int','int')):'pgsql2osm_prepared_2'}
+    assert sorted(p.templates.items())==[('pgsql2osm_prepared_0','SELECT $1'),
+        ('pgsql2osm_prepared_1','SELECT $1'),('pgsql2osm_prepared_2','SELECT $1, $2')]
+    assert c.executed[-1]==('EXECUTE pgsql2osm_prepared_2 (%s,%s);',(1,2))
+    assert p.template('pgsql2osm_prepared_2')=='SELECT $1, $2'
+    assert p.template('pgsql2osm_prepared_3') is None
+
+def test_closed_connections_forgotten() :
+    p=dbutils.PreparedStatements()
+    conn=FakeConnection()
+    p.execute(FakeCursor(conn),'SELECT $1',('int',),(1,))
+    assert len(p.prepared)==1
+    del conn
+    gc.collect()
+    assert len(p.prepared)==0
+    assert p.template('pgsql2osm_prepared_0')=='SELECT $1'
+
+def test_metrics_template(monkeypatch) :
+    ''' EXECUTEs count under the template of the prepared statement
+    '''
+    p=dbutils.PreparedStatements()
+    monkeypatch.setattr(dbutils,'prepared',p)
+    p.execute(FakeCursor(FakeConnection()),'SELECT * FROM t WHERE id=ANY($1) AND k=\'v\'',('bigint[]',),([1],))
+    m=metrics.Metrics(metrics.RssSampler(interval_s=60))
+    try :
+        assert m.template('EXECUTE pgsql2osm_prepared_0 (ARRAY[1,2]);')=='SELECT * FROM t WHERE id=ANY($?) AND k=?'
+        assert m.template('EXECUTE pgsql2osm_prepared_5 (1);')=='EXECUTE pgsql2osm_prepared_5 (?);'
+        assert m.template('SELECT 1 FROM t WHERE id IN (1,2,3)')=='SELECT ? FROM t WHERE id IN (?,...)'
+    finally :
+        m.sampler.remove_listener(m.rss)
@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+from pgsql2osm import writers
+from pgsql2osm.writers import OsmElement
+
+def write_xml(elements,**kwargs)->bytes :
+    f=io.BytesIO()
+    with writers.XmlWriter(f,{'version':'0.6','generator':'test'},**kwargs) as w :
+        for el in elements :
+            w.write(el)
+    return f.getvalue()
+
+def test_node() :
+    el=OsmElement('node',{'id':'1','lat':'46.5','lon':'-6.25','version':'1'},tags=[('name','A')])
+    assert writers.element_to_str(el)== \
+        '<node id="1" lat="46.5" lon="-6.25" version="1"><tag k="name" v="A"/></node>'
+
+def test_way() :
+    el=OsmElement('way',{'id':'2','version':'1'},nds=[1,3],tags=[('highway','path')])
+    assert writers.element_to_str(el)== \
+        '<way id="2" version="1"><nd ref="1"/><nd ref="3"/><tag k="highway" v="path"/></way>'
+
+def test_relation() :
+    el=OsmElement('relation',{'id':'3','version':'1'},
+        members=[('way',2,'outer'),('node',1,'')],tags=[('type','multipolygon')])
+    assert writers.element_to_str(el)=='<relation id="3" version="1">' \
+        '<member type="way" ref="2" role="outer"/><member type="node" ref="1" role=""/>' \
+        '<tag k="type" v="multipolygon"/></relation>'
+
+def test_attribute_order() :
+    ''' Attributes in the order of the attrs dict, not sorted
+    '''
+    el=OsmElement('node',{'version':'2','lon':'1','id':'4','lat':'2'})
+    assert writers.element_to_str(el)=='<node version="2" lon="1" id="4" lat="2"/>'
+
+def test_empty_elements() :
+    assert writers.element_to_str(OsmElement('way',{'id':'1'}))=='<way id="1"/>'
+    assert writers.element_to_str(OsmElement('relation',{'id':'1'},members=(),tags=()))=='<relation id="1"/>'
+
+def test_escaping() :
+    el=OsmElement('node',{'id':'1'},tags=[('a&b','<"x">\n\r\t')])
+    assert writers.element_to_str(el)== \
+        '<node id="1"><tag k="a&amp;b" v="&lt;&quot;x&quot;&gt;&#10;&#13;&#9;"/></node>'
+    assert writers.escape_attr("it's fine")=="it's fine"
+
+@pytest.mark.parametrize('value',['a\x00b','\x08','\x1f','\ud800','￿'])
+def test_invalid_chars(value) :
+    with pytest.raises(ValueError) :
+        writers.escape_attr(value)
+
+def test_document() :
+    assert write_xml([OsmElement('node',{'id':'1','lat':'0','lon':'0'})])== \
+        b"<?xml version='1.0' encoding='utf-8'?>\n<osm version=\"0.6\" generator=\"test\">" \
+        b'<node id="1" lat="0" lon="0"/></osm>'
+
+def test_utf8() :
+    el=OsmElement('node',{'id':'1'},tags=[('name','Genève')])
+    assert write_xml([el]).endswith('<node id="1"><tag k="name" v="Genève"/></node></osm>'.encode())
+
+def test_small_flush_size() :
+    elements=[OsmElement('node',{'id':str(i)}) for i in range(100)]
+    assert write_xml(elements,flush_size=10)==write_xml(elements)
+
+def test_fragment_and_segment() :
+    ''' A fragment has no declaration nor root, and splices into the document
+    '''
+    segment=io.BytesIO()
+    with writers.XmlWriter(segment,{},fragment=True) as w :
+        w.write(OsmElement('way',{'id':'2'}))
+    assert segment.getvalue()==b'<way id="2"/>'
+    segment.seek(0)
+    f=io.BytesIO()
+    with writers.XmlWriter(f,{'version':'0.6'}) as w :
+        w.write(OsmElement('node',{'id':'1'}))
+        w.write_segment(segment)
+        w.write(OsmElement('relation',{'id':'3'}))
+    assert f.getvalue()==b"<?xml version='1.0' encoding='utf-8'?>\n<osm version=\"0.6\">" \
+        b'<node id="1"/><way id="2"/><relation id="3"/></osm>'
+
+def test_append() :
+    f=io.BytesIO(b"<?xml version='1.0' encoding='utf-8'?>\n<osm><node id=\"1\"/>")
+    f.seek(0,io.SEEK_END)
+    with writers.XmlWriter(f,{},append=True) as w :
+        w.write(OsmElement('node',{'id':'2'}))
+    assert f.getvalue()==b"<?xml version='1.0' encoding='utf-8'?>\n<osm><node id=\"1\"/><node id=\"2\"/></osm>"
+
+def test_no_root_close_on_error() :
+    f=io.BytesIO()
+    with pytest.raises(KeyError) :
+        with writers.XmlWriter(f,{}) as w :
+            w.write(OsmElement('node',{'id':'1'}))
+            raise KeyError()
+    assert f.getvalue()==b"<?xml version='1.0' encoding='utf-8'?>\n<osm><node id=\"1\"/>"
+
+def test_file_name(tmp_path) :
+    path=str(tmp_path/'out.osm')
+    with writers.XmlWriter(path,{}) as w :
+        w.write(OsmElement('node',{'id':'1'}))
+    with open(path,'rb') as f :
+        assert f.read()==b"<?xml version='1.0' encoding='utf-8'?>\n<osm><node id=\"1\"/></osm>"
+
+def test_osc() :
+    f=io.BytesIO()
+    with writers.OscWriter(f,{'version':'0.6'}) as w :
+        w.write_action('create',OsmElement('node',{'id':'1'}))
+        w.write_action('create',OsmElement('node',{'id':'2'}))
+        w.write_action('delete',OsmElement('way',{'id':'3'}))
+    assert f.getvalue()==b"<?xml version='1.0' encoding='utf-8'?>\n<osmChange version=\"0.6\">" \
+        b'<create><node id="1"/><node id="2"/></create><delete><way id="3"/></delete></osmChange>'
+
+def test_same_as_lxml() :
+    ET=pytest.importorskip('lxml.etree')
+    el=OsmElement('way',{'id':'2','user':'a "b" & <c>\t'},nds=[1],tags=[('k','\n\r\'é')])
+    et=ET.Element('way',{'id':'2','user':'a "b" & <c>\t'})
+    ET.SubElement(et,'nd',{'ref':'1'})
+    ET.SubElement(et,'tag',{'k':'k','v':'\n\r\'é'})
+    assert writers.element_to_str(el)==ET.tostring(et,encoding='unicode')
+    with pytest.raises(ValueError) :
+        ET.Element('tag',{'v':'\x01'})